@@ -1,18 +1,20 @@
 # %%
 import logging
 import os
-import pickle
-import re
+import shutil
 from collections import defaultdict
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
-import tifffile
+from chalign.batch import register_batch
 from chalign.io import setup_logging
+from chalign.manifest import BatchManifest
+from chalign.ometiff import export_masked_ometiff
+from chalign.profiling import summarize_profiles
 from chalign.valisaligner import ValisAligner
 from IPython.core.interactiveshell import InteractiveShell
-from pyqupath.ometiff import export_ometiff_pyramid, export_ometiff_pyramid_from_dict
+from pyqupath.ometiff import export_ometiff_pyramid
 from tqdm import tqdm
 
 InteractiveShell.ast_node_interactivity = "all"
@@ -24,51 +26,20 @@ TQDM_FORMAT = "{desc}: {percentage:3.0f}%|{bar:10}| {n_fmt}/{total_fmt} [{elapse
 ###############################################################################
 
 
-def run_valis_register(row):
-    """
-    Run Valis to register destination and source images.
-    """
-    id = row["id"]
-    dst_dir = Path(row["dst_dir"])
-    src_dir = Path(row["src_dir"])
-    output_dir = Path(row["output_dir"])
-
-    dst_register_f = dst_dir / row["dst_register"]
-    src_register_f = src_dir / row["src_register"]
-
-    valis_aligner = ValisAligner(
-        dst_register_f=dst_register_f,
-        src_register_f=src_register_f,
-        output_dir=output_dir,
-    )
-
-    overlap_dir = output_dir / "overlap"
-    overlap_dir.mkdir(exist_ok=True, parents=True)
-    fig, axs = valis_aligner.plot_overlap()
-    fig.savefig(overlap_dir / f"{id}.png")
-
-    error_df_dir = output_dir / "error_df"
-    error_df_dir.mkdir(exist_ok=True, parents=True)
-    valis_aligner.error_df.assign(id=id).to_csv(error_df_dir / f"{id}.csv", index=False)
-
-
 def run_valis_apply(row):
     """
     Run Valis to apply registration on destination and source images.
     """
     output_dir = Path(row["output_dir"])
-
-    valis_aligner_f = output_dir / "valis" / "intermediate" / "valis_aligner.pkl"
-    with open(valis_aligner_f, "rb") as f:
-        valis_aligner = pickle.load(f)
+    valis_aligner = ValisAligner.load(output_dir)
 
     dst_dir = Path(row["dst_dir"])
     src_dir = Path(row["src_dir"])
     dst_apply_fl = list(dst_dir.glob("*.tif"))
     src_apply_fl = list(src_dir.glob("*.tif"))
 
-    valis_aligner.rigid.apply(dst_apply_fl=dst_apply_fl, src_apply_fl=src_apply_fl)
-    valis_aligner.non_rigid.apply(dst_apply_fl=dst_apply_fl, src_apply_fl=src_apply_fl)
+    valis_aligner.apply_all(dst_apply_fl=dst_apply_fl, src_apply_fl=src_apply_fl)
+    valis_aligner.write_profile(output_dir / "profile" / f"{row['id']}_apply")
 
 
 ###############################################################################
@@ -80,47 +51,11 @@ def parse_metadata_keyence(output_dir, non_rigid=True):
     """
     Parse metadata from output directory for Keyence data.
     """
-    id = Path(output_dir).name
-    tag = "non_rigid" if non_rigid else "rigid"
-    ometiff_dir = Path(output_dir) / f"registered_{tag}" / "ometiff"
-
-    # Marker metadata
-    img_fl = list(ometiff_dir.glob("*.ome.tiff"))
-    filenames, extensions = zip(
-        *[re.match(r"([^.]+)(.*)", img_f.name).groups() for img_f in img_fl]
-    )
-
-    metadata_file = pd.DataFrame(
-        {
-            "id": id,
-            "img_f": img_fl,
-            "filename": filenames,
-            "extension": extensions,
-        }
-    )
-
-    ## Marker type
-    idx_dapi = metadata_file.filename.apply(
-        lambda x: re.search(r"Ch\dCy\d", x) is not None
-    )
-    idx_blank = metadata_file.filename.apply(
-        lambda x: re.search(r"blank", x, re.IGNORECASE) is not None
-    )
-    marker_type = np.full(metadata_file.shape[0], "marker")
-    marker_type[idx_dapi] = "dapi"
-    marker_type[idx_blank] = "blank"
-    metadata_file["marker_type"] = marker_type
-
-    metadata_marker = pd.DataFrame(
-        metadata_file.filename.str.split("_", n=4).tolist(),
-        columns=["prefix", "region", "cycle", "channel", "marker"],
-    )
-    metadata_marker["marker_label"] = metadata_marker.apply(
-        lambda row: f"{row['prefix']}_{row['cycle']}_{row['channel']}_{row['marker']}",
-        axis=1,
-    )
-
-    metadata = pd.concat([metadata_file, metadata_marker], axis=1)
+    mode = "non_rigid" if non_rigid else "rigid"
+    manifest = BatchManifest.from_dirs([output_dir], mode=mode)
+    metadata = manifest.df.rename(columns={"file": "img_f"})
+    metadata["img_f"] = metadata.img_f.apply(Path)
+    metadata["extension"] = ".ome.tiff"
     return metadata
 
 
@@ -192,7 +127,20 @@ def export_dapi_ometiff(row, dapi_dir, non_rigid=True):
 ###############################################################################
 
 
-def run_export_ometiff():
+def run_export_ometiff(mode="non_rigid", direct=False, extension=".ome.tiff"):
+    """
+    Export the final OME-TIFF of every region, registered in `mode`.
+
+    With `direct`, the input images are warped straight into the final
+    OME-TIFF and the per-channel registered files are not needed. The native
+    engine interpolates bilinearly where Valis is bicubic, which only matches
+    the Valis output closely for a single matrix, so `direct` is limited to
+    rigid mode. With `extension=".ome.zarr"`, chunked OME-Zarr stores are
+    written instead. The DAPI channel is the largest cycle common to every
+    region, not only to the exported ones.
+    """
+    if direct and mode != "rigid":
+        raise ValueError("Direct export is only supported in rigid mode")
     dapi_df = pd.read_excel(
         "/mnt/nfs/home/wenruiwu/projects/bidmc-jiang-rcc/output/data/20250116_ometiff/params/dapi_selection.xlsx",
         sheet_name="alignment_parameter",
@@ -213,100 +161,82 @@ def run_export_ometiff():
         "/mnt/nfs/home/wenruiwu/projects/bidmc-jiang-rcc/output/data/20250116_ometiff/"
     )
 
-    dapi_index = get_max_dst_dapi_index()
+    if direct:
+        manifest = BatchManifest.from_inputs(params_df)
+        dapi_index = manifest.get_max_common_dapi_cycle(prefix="dst", channel="Ch1")
+    else:
+        manifest = BatchManifest.from_dirs(
+            [input_dir / id for id in label_dict], mode=mode
+        )
+        dapi_index = get_max_dst_dapi_index(mode=mode)
     dapi = f"Ch1Cy{dapi_index}"
     for id, label in tqdm(
         label_dict.items(), desc="Marker Dict", bar_format=TQDM_FORMAT
     ):
         marker_df = marker_dict[label].reset_index(drop=True)
         marker_df = marker_df.iloc[: np.where(marker_df.marker_label.isna())[0][0]]
-        mask_f = (
-            input_dir
-            / id
-            / "registered_non_rigid"
-            / "temp"
-            / "src_mask_aligned.ome.tiff"
-        )
-        mask = tifffile.imread(mask_f)
-
-        im_dict = {}
-        for i, row in tqdm(
-            marker_df.iterrows(),
-            desc="Marker",
-            bar_format=TQDM_FORMAT,
-            total=marker_df.shape[0],
-        ):
-            tiff_f = list(
-                (input_dir / id / "registered_non_rigid" / "ometiff").glob(
-                    f"{row.marker_label}"[:4] + "*" + f"{row.marker_label}"[4:] + "*"
-                )
-            )[0]
-            im = tifffile.imread(tiff_f)
-            im_dict[row.marker_name] = im * mask
+        aligner = getattr(ValisAligner.load(input_dir / id), mode)
+
+        img_f_dict = {
+            row.marker_name: manifest.get_file(id, marker_label=row.marker_label)
+            for _, row in marker_df.iterrows()
+        }
 
         dapi_df_id = dapi_df[dapi_df.id == id]
-        dapi_f = [
-            f
-            for f in (input_dir / id / "registered_non_rigid" / "ometiff").glob("*")
-            if re.search(f"dst.+{dapi}", f.name)
-        ][0]
-        dst_dapi_f = (
-            input_dir
-            / id
-            / "registered_non_rigid"
-            / "ometiff"
-            / f"dst_{dapi_df_id.dst_register.str.replace('tif', 'ome.tiff').values[0]}"
+        dapi_f = manifest.query(id=id, prefix="dst", marker_type="dapi")
+        dapi_f = Path(dapi_f[dapi_f.filename.str.contains(dapi)].file.iloc[0])
+        dst_dapi_f = manifest.get_file(
+            id,
+            filename=f"dst_{Path(dapi_df_id.dst_register.values[0]).stem}",
         )
-        src_dapi_f = (
-            input_dir
-            / id
-            / "registered_non_rigid"
-            / "ometiff"
-            / f"src_{dapi_df_id.src_register.str.replace('tif', 'ome.tiff').values[0]}"
+        src_dapi_f = manifest.get_file(
+            id,
+            filename=f"src_{Path(dapi_df_id.src_register.values[0]).stem}",
         )
-        im_dict["DAPI"] = tifffile.imread(dapi_f) * mask
-        im_dict["dst_register"] = tifffile.imread(dst_dapi_f) * mask
-        im_dict["src_register"] = tifffile.imread(src_dapi_f) * mask
+        img_f_dict["DAPI"] = dapi_f
+        img_f_dict["dst_register"] = dst_dapi_f
+        img_f_dict["src_register"] = src_dapi_f
 
-        output_f = output_dir / id / f"{id}.ome.tiff"
+        output_f = output_dir / id / f"{id}{extension}"
         output_f.parent.mkdir(parents=True, exist_ok=True)
-        if output_f.exists():
+        if output_f.is_dir():
+            shutil.rmtree(output_f)
+        elif output_f.exists():
             os.remove(output_f)
-        export_ometiff_pyramid_from_dict(
-            im_dict,
-            str(output_f),
-            ["dst_register", "src_register", "DAPI"] + marker_df.marker_name.tolist(),
-        )
-
-
-def get_max_dst_dapi_index():
+        channel_names = [
+            "dst_register",
+            "src_register",
+            "DAPI",
+        ] + marker_df.marker_name.tolist()
+        img_fl = [img_f_dict[channel_name] for channel_name in channel_names]
+        if direct:
+            prefixes = ["dst", "src", "dst"] + [
+                marker_label.split("_")[0] for marker_label in marker_df.marker_label
+            ]
+            aligner.apply_ometiff(
+                output_f,
+                list(zip(prefixes, img_fl)),
+                channel_names,
+                n_workers=8,
+            )
+        else:
+            export_masked_ometiff(
+                img_fl,
+                output_f,
+                channel_names,
+                mask=aligner.get_overlap_mask(),
+            )
+
+
+def get_max_dst_dapi_index(mode="non_rigid"):
     """
-    Get the maximum index of dst DAPI channel.
+    Get the maximum index of dst DAPI channel common to all registered regions.
     """
     valis_dir = Path(
         "/mnt/nfs/home/wenruiwu/projects/bidmc-jiang-rcc/output/data/20250112_alignment_valis/valis"
     )
-    all_index = []
-    all_dir = list(valis_dir.glob("*/"))
-    for region_dir in tqdm(
-        all_dir,
-        desc="Get max dst dapi index",
-        bar_format=TQDM_FORMAT,
-    ):
-        file_names = [
-            f.name
-            for f in (region_dir / "registered_non_rigid/ometiff").glob("*.ome.tiff")
-        ]
-        dapi_index = [
-            re.search(r"dst_.+Ch1Cy(\d+)", name).group(1)
-            for name in file_names
-            if re.search(r"dst_.+Ch1Cy(\d+)", name)
-        ]
-        dapi_index = [int(i) for i in dapi_index]
-        all_index += dapi_index
-    dapi_index, n = np.unique(all_index, return_counts=True)
-    max_dapi = dapi_index[n == len(all_dir)].max()
-    return max_dapi
+    manifest = BatchManifest.from_dirs(valis_dir.glob("*/"), mode=mode)
+    return manifest.get_max_common_dapi_cycle(prefix="dst", channel="Ch1")
 
 
 ###############################################################################
@@ -314,22 +244,29 @@ def get_max_dst_dapi_index():
 ###############################################################################
 
 
+def main_valis_preview():
+    setup_logging(
+        "/mnt/nfs/home/wenruiwu/projects/bidmc-jiang-rcc/output/data/20250112_alignment_valis/log/valis_preview.log"
+    )
+    error_dfs = [
+        error_df
+        for _, error_df, e in register_batch(params_df, n_workers=8, preview=True)
+        if e is None
+    ]
+    preview_df = pd.concat(error_dfs, ignore_index=True)
+    logging.info(f"Preview errors:\n{preview_df.to_string(index=False)}")
+
+
 def main_valis_register():
     setup_logging(
         "/mnt/nfs/home/wenruiwu/projects/bidmc-jiang-rcc/output/data/20250112_alignment_valis/log/valis_register.log"
     )
-    for i, row in tqdm(
-        params_df.iterrows(),
-        desc="Register",
-        bar_format=TQDM_FORMAT,
-        total=params_df.shape[0],
-    ):
-        id = row["id"]
-        try:
-            run_valis_register(row)
-            logging.info(f"Succeed: {id}.")
-        except Exception as e:
-            logging.error(f"Failed: {id} ({e}).")
+    failed = [
+        id
+        for id, _, e in register_batch(params_df, n_workers=8, init_from_preview=True)
+        if e is not None
+    ]
+    logging.info(f"Failed pairs: {failed}")
 
 
 def main_valis_apply():
@@ -350,6 +287,19 @@ def main_valis_apply():
         except Exception as e:
             logging.error(f"Failed: {id} ({e}).")
 
+    # Stage profile of the batch
+    profile_fl = [
+        Path(row["output_dir"]) / "profile" / f"{row['id']}_{step}.csv"
+        for _, row in run_df.iterrows()
+        for step in ["register", "apply"]
+    ]
+    summary_df = summarize_profiles(profile_fl)
+    summary_df.to_csv(
+        "/mnt/nfs/home/wenruiwu/projects/bidmc-jiang-rcc/output/data/20250112_alignment_valis/log/profile_summary.csv",
+        index=False,
+    )
+    logging.info(f"Stage profile:\n{summary_df.to_string(index=False)}")
+
 
 def main_valis_markerlist():
     excel_dir = "/mnt/nfs/home/wenruiwu/projects/bidmc-jiang-rcc/output/data/20250112_alignment_valis/metadata"
@@ -0,0 +1,162 @@
+import atexit
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Iterator, Optional
+
+import matplotlib.pyplot as plt
+import pandas as pd
+from tqdm import tqdm
+from valis import registration
+
+from .cache import RegistrationCache
+from .valisaligner import TQDM_FORMAT, ValisAligner
+
+
+def _init_worker():
+    """
+    Start one JVM per worker process, shared by all pairs it registers
+    """
+    registration.init_jvm()
+    atexit.register(registration.kill_jvm)
+
+
+def register_pair(
+    row: pd.Series,
+    cache: Optional[RegistrationCache] = None,
+    preview: bool = False,
+    init_from_preview: bool = False,
+) -> pd.DataFrame:
+    """
+    Register one destination and source pair, then write its overlap plot and
+    error table and stage profile. The JVM must already be running.
+
+    Parameters
+    ----------
+    row : pd.Series
+        Row of the parameter table with "id", "dst_dir", "src_dir",
+        "output_dir", "dst_register" and "src_register".
+    cache : RegistrationCache, optional
+        Cache of registration results, see `ValisAligner`.
+    preview : bool, optional
+        Whether to only register thumbnails with `ValisAligner.preview`,
+        writing the results to the "preview" subdirectory of the output
+        directory, by default False.
+    init_from_preview : bool, optional
+        Whether to initialize the registration from the preview of the pair
+        when one exists, by default False.
+
+    Returns
+    -------
+    pd.DataFrame
+        Registration error table of the pair.
+    """
+    id = row["id"]
+    dst_dir = Path(row["dst_dir"])
+    src_dir = Path(row["src_dir"])
+    output_dir = Path(row["output_dir"])
+
+    preview_dir = output_dir / "preview"
+    if preview:
+        output_dir = preview_dir
+        valis_aligner = ValisAligner.preview(
+            dst_register_f=dst_dir / row["dst_register"],
+            src_register_f=src_dir / row["src_register"],
+            output_dir=output_dir,
+        )
+    else:
+        init_transforms = None
+        if (
+            init_from_preview
+            and (preview_dir / "valis" / "intermediate" / "transforms.npz").exists()
+        ):
+            init_transforms = ValisAligner.load(preview_dir).transforms
+        valis_aligner = ValisAligner(
+            dst_register_f=dst_dir / row["dst_register"],
+            src_register_f=src_dir / row["src_register"],
+            output_dir=output_dir,
+            kill_jvm=False,
+            cache=cache,
+            init_transforms=init_transforms,
+        )
+
+    overlap_dir = output_dir / "overlap"
+    overlap_dir.mkdir(exist_ok=True, parents=True)
+    fig, axs = valis_aligner.plot_overlap()
+    fig.savefig(overlap_dir / f"{id}.png")
+    plt.close(fig)
+
+    error_df = valis_aligner.error_df.assign(id=id)
+    error_df_dir = output_dir / "error_df"
+    error_df_dir.mkdir(exist_ok=True, parents=True)
+    error_df.to_csv(error_df_dir / f"{id}.csv", index=False)
+    valis_aligner.write_profile(output_dir / "profile" / f"{id}_register")
+    return error_df
+
+
+def register_batch(
+    params_df: pd.DataFrame,
+    n_workers: int = 1,
+    cache: Optional[RegistrationCache] = None,
+    tqdm_format: str = TQDM_FORMAT,
+    preview: bool = False,
+    init_from_preview: bool = False,
+) -> Iterator[tuple[str, Optional[pd.DataFrame], Optional[Exception]]]:
+    """
+    Register every pair of a parameter table on a pool of worker processes
+
+    Each worker starts the JVM once and keeps it warm for all the pairs it
+    registers. Overlap plots and error tables are written by the workers as
+    soon as each pair finishes, and results are yielded in completion order.
+
+    Parameters
+    ----------
+    params_df : pd.DataFrame
+        Parameter table with one row per pair, see `register_pair`.
+    n_workers : int, optional
+        Number of worker processes, by default 1. Each worker holds one Valis
+        registrar and one JVM in memory.
+    cache : RegistrationCache, optional
+        Cache of registration results shared by all workers.
+    tqdm_format : str, optional
+        Format for tqdm progress bar.
+    preview : bool, optional
+        Whether to only register thumbnails, see `register_pair`. Previewing a
+        batch first helps to find bad pairs quickly.
+    init_from_preview : bool, optional
+        Whether to initialize registrations from their previews, see
+        `register_pair`.
+
+    Yields
+    ------
+    tuple[str, Optional[pd.DataFrame], Optional[Exception]]
+        Pair id, its error table if registration succeeded and the exception
+        if it failed.
+    """
+    # Spawn rather than fork, the JVM can not be shared with a forked child
+    mp_context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(
+        max_workers=n_workers, mp_context=mp_context, initializer=_init_worker
+    ) as executor:
+        futures = {
+            executor.submit(
+                register_pair, row, cache, preview, init_from_preview
+            ): row["id"]
+            for _, row in params_df.iterrows()
+        }
+        for future in tqdm(
+            as_completed(futures),
+            desc="Preview" if preview else "Register",
+            bar_format=tqdm_format,
+            total=len(futures),
+        ):
+            id = futures[future]
+            try:
+                error_df = future.result()
+            except Exception as e:
+                logging.error(f"Failed: {id} ({e}).")
+                yield id, None, e
+            else:
+                logging.info(f"Succeed: {id}.")
+                yield id, error_df, None
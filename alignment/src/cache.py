@@ -0,0 +1,196 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+from importlib import metadata
+from pathlib import Path
+from typing import Optional, Union
+
+import pandas as pd
+
+from .transform import TRANSFORMS_VERSION, RegistrationTransforms
+
+DEFAULT_CACHE_DIR = Path.home() / ".cache" / "chalign" / "registration"
+
+
+def hash_file(path: Union[str, Path], chunk_size: int = 16 * 1024**2) -> str:
+    """
+    BLAKE2b digest of a file's content, read in large chunks
+
+    Parameters
+    ----------
+    path : Union[str, Path]
+        Path to the file.
+    chunk_size : int, optional
+        Number of bytes read at a time, by default 16 MiB.
+
+    Returns
+    -------
+    str
+        Hexadecimal digest.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def fingerprint_file(
+    path: Union[str, Path], n_blocks: int = 16, block_size: int = 1024**2
+) -> str:
+    """
+    BLAKE2b digest of a file's size, modification time and sampled content
+
+    Only the first and last blocks and `n_blocks` evenly spaced blocks in
+    between are read, so large images are fingerprinted in a few reads rather
+    than a full pass. Smaller files are hashed whole.
+
+    Parameters
+    ----------
+    path : Union[str, Path]
+        Path to the file.
+    n_blocks : int, optional
+        Number of blocks sampled between the first and the last, by default 16.
+    block_size : int, optional
+        Number of bytes per block, by default 1 MiB.
+
+    Returns
+    -------
+    str
+        Hexadecimal digest.
+    """
+    stat = os.stat(path)
+    size = stat.st_size
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{size}:{stat.st_mtime_ns}".encode())
+    with open(path, "rb") as f:
+        if size <= (n_blocks + 2) * block_size:
+            h.update(f.read())
+            return h.hexdigest()
+        for i in range(n_blocks + 2):
+            f.seek(i * (size - block_size) // (n_blocks + 1))
+            h.update(f.read(block_size))
+    return h.hexdigest()
+
+
+def _get_valis_version() -> str:
+    try:
+        return metadata.version("valis-wsi")
+    except metadata.PackageNotFoundError:
+        return ""
+
+
+class RegistrationCache:
+    def __init__(
+        self,
+        cache_dir: Union[str, Path] = DEFAULT_CACHE_DIR,
+        max_bytes: int = 20 * 1024**3,
+    ):
+        """
+        Local cache of registration results keyed by the fingerprints of the
+        two registration images (see `fingerprint_file`) and the Valis
+        settings.
+
+        Entries are evicted least recently used first once the cache grows
+        beyond `max_bytes`.
+
+        Parameters
+        ----------
+        cache_dir : Union[str, Path], optional
+            Cache directory, by default ~/.cache/chalign/registration.
+        max_bytes : int, optional
+            Maximum total size of the cache, by default 20 GiB.
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+    def get_key(
+        self,
+        dst_register_f: Union[str, Path],
+        src_register_f: Union[str, Path],
+        valis_kwargs: Optional[dict] = None,
+    ) -> str:
+        """
+        Cache key of a registration
+
+        Parameters
+        ----------
+        dst_register_f : Union[str, Path]
+            Path to the destination image file for registration.
+        src_register_f : Union[str, Path]
+            Path to the source image file for registration.
+        valis_kwargs : dict, optional
+            Extra keyword arguments passed to `registration.Valis`.
+        """
+        content = {
+            "dst": fingerprint_file(dst_register_f),
+            "src": fingerprint_file(src_register_f),
+            "valis_kwargs": valis_kwargs or {},
+            "valis_version": _get_valis_version(),
+            "transforms_version": TRANSFORMS_VERSION,
+        }
+        content = json.dumps(content, sort_keys=True, default=str)
+        return hashlib.blake2b(content.encode(), digest_size=16).hexdigest()
+
+    def get(self, key: str) -> Optional[tuple[RegistrationTransforms, pd.DataFrame]]:
+        """
+        Load a cached registration, or None on a cache miss
+        """
+        entry_dir = self.cache_dir / key
+        if not (entry_dir / "transforms.npz").exists():
+            logging.info(f"Registration cache miss: {key}")
+            return None
+
+        logging.info(f"Registration cache hit: {key}")
+        os.utime(entry_dir)
+        transforms = RegistrationTransforms.load(entry_dir / "transforms.npz")
+        error_df = pd.read_csv(entry_dir / "error_df.csv")
+        return transforms, error_df
+
+    def put(
+        self, key: str, transforms: RegistrationTransforms, error_df: pd.DataFrame
+    ):
+        """
+        Store a registration, then evict old entries if the cache is too large
+        """
+        entry_dir = self.cache_dir / key
+        tmp_dir = self.cache_dir / f".{key}.{os.getpid()}.tmp"
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        transforms.save(tmp_dir / "transforms.npz")
+        error_df.to_csv(tmp_dir / "error_df.csv", index=False)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Stored concurrently by another process
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        logging.info(f"Registration cache store: {key}")
+        self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits in `max_bytes`
+        """
+        entries = []
+        for entry_dir in self.cache_dir.iterdir():
+            if entry_dir.name.startswith(".") or not entry_dir.is_dir():
+                continue
+            size = sum(f.stat().st_size for f in entry_dir.iterdir())
+            entries.append((entry_dir.stat().st_mtime, size, entry_dir))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+            logging.info(f"Registration cache evict: {entry_dir.name}")
+
+    def clear(self):
+        """
+        Remove every cached registration
+        """
+        for entry_dir in self.cache_dir.iterdir():
+            shutil.rmtree(entry_dir, ignore_errors=True)
@@ -0,0 +1,208 @@
+import os
+import threading
+from pathlib import Path
+from typing import Callable, Optional, Union
+
+import numpy as np
+import pandas as pd
+
+HISTOGRAM_VERSION = 1
+HISTOGRAM_BINS = 65536
+
+
+def quantile_from_counts(counts: np.ndarray, q: float) -> float:
+    """
+    Exact quantile of integer values from their histogram
+
+    Matches `np.quantile` with the default "linear" method: the value at
+    position (n - 1) * q of the sorted values, interpolated between its two
+    neighbours.
+
+    Parameters
+    ----------
+    counts : np.ndarray
+        Number of pixels of each value, `counts[v]` for value `v`.
+    q : float
+        Quantile between 0 and 1.
+
+    Returns
+    -------
+    float
+        Quantile.
+    """
+    cdf = np.cumsum(counts)
+    n = int(cdf[-1])
+    if n == 0:
+        raise ValueError("Quantile of an empty histogram")
+    position = (n - 1) * q
+    lower = int(np.floor(position))
+    upper = min(lower + 1, n - 1)
+    # value of the k-th sorted pixel: first value whose cdf exceeds k
+    v_lower, v_upper = np.searchsorted(cdf, [lower, upper], side="right")
+    return float(v_lower + (position - lower) * (v_upper - v_lower))
+
+
+def is_histogram_dtype(dtype: np.dtype) -> bool:
+    """
+    Whether histograms can be computed for a data type (uint8 or uint16)
+    """
+    return np.dtype(dtype) in (np.uint8, np.uint16)
+
+
+def get_histogram_path(path_ometiff: Union[str, Path]) -> Path:
+    """
+    Path of the histogram sidecar of an OME-TIFF file or OME-Zarr store
+    """
+    path_ometiff = Path(path_ometiff)
+    return path_ometiff.with_name(f"{path_ometiff.name}.histogram.npz")
+
+
+class ChannelHistograms:
+    def __init__(self, channel_names: list[str], counts: Optional[np.ndarray] = None):
+        """
+        Intensity histogram of every channel of an image, with one bin per
+        uint16 value, from which quantiles and statistics are exact and cost
+        a lookup instead of a pass over the pixels.
+
+        Histograms are accumulated tile by tile with `add` while an image is
+        exported, and saved next to it as a small sidecar (see
+        `get_histogram_path`).
+
+        Parameters
+        ----------
+        channel_names : list[str]
+            List of channel names.
+        counts : np.ndarray, optional
+            Counts of shape (n_channels, 65536). If None, empty histograms.
+        """
+        self.channel_names = list(channel_names)
+        if counts is None:
+            counts = np.zeros((len(self.channel_names), HISTOGRAM_BINS), np.int64)
+        if counts.shape != (len(self.channel_names), HISTOGRAM_BINS):
+            raise ValueError(f"Unexpected histogram shape: {counts.shape}")
+        self.counts = counts
+        self._channel_index = {name: i for i, name in enumerate(self.channel_names)}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_dict(cls, im_dict: dict[str, np.ndarray]) -> "ChannelHistograms":
+        """
+        Histograms of in-memory channels, keyed by channel name
+        """
+        histograms = cls(list(im_dict))
+        for c, im in enumerate(im_dict.values()):
+            histograms.add(c, im)
+        return histograms
+
+    def __contains__(self, channel: str) -> bool:
+        return channel in self._channel_index
+
+    def _get_index(self, channel: Union[str, int]) -> int:
+        return channel if isinstance(channel, int) else self._channel_index[channel]
+
+    def add(self, channel: Union[str, int], tile: np.ndarray):
+        """
+        Add the pixels of a tile of a uint8 or uint16 channel. Safe to call
+        from several threads.
+        """
+        if not is_histogram_dtype(tile.dtype):
+            raise ValueError(f"Histograms need uint8 or uint16 data, not {tile.dtype}")
+        counts = np.bincount(tile.ravel(), minlength=HISTOGRAM_BINS)
+        with self._lock:
+            self.counts[self._get_index(channel)] += counts
+
+    def wrap(
+        self, tile_fn: Callable[[int, int, int, int, int], np.ndarray]
+    ) -> Callable[[int, int, int, int, int], np.ndarray]:
+        """
+        Wrap the `tile_fn` of `write_pyramid_tiled` to add every tile it
+        returns. The writers request each level 0 tile once, so every pixel
+        is counted once.
+        """
+
+        def tile_fn_histogram(c, y0, y1, x0, x1):
+            tile = tile_fn(c, y0, y1, x0, x1)
+            self.add(c, tile)
+            return tile
+
+        return tile_fn_histogram
+
+    def get_counts(self, channel: Union[str, int]) -> np.ndarray:
+        """Histogram of a channel"""
+        return self.counts[self._get_index(channel)]
+
+    def quantile(self, channel: Union[str, int], q: float) -> float:
+        """
+        Quantile `q` of a channel, identical to `np.quantile(img, q)`
+        """
+        return quantile_from_counts(self.get_counts(channel), q)
+
+    def get_stats(self, channel: Union[str, int]) -> dict:
+        """
+        Number of pixels, minimum, maximum and mean of a channel
+        """
+        counts = self.get_counts(channel)
+        n = int(counts.sum())
+        if n == 0:
+            return {"n": 0, "min": np.nan, "max": np.nan, "mean": np.nan}
+        nonzero = np.flatnonzero(counts)
+        mean = float(np.dot(np.arange(HISTOGRAM_BINS), counts) / n)
+        return {
+            "n": n,
+            "min": int(nonzero[0]),
+            "max": int(nonzero[-1]),
+            "mean": mean,
+        }
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        Statistics of every channel.
+        - Columns: ["channel", "n", "min", "max", "mean"]
+        """
+        return pd.DataFrame(
+            [
+                {"channel": channel, **self.get_stats(c)}
+                for c, channel in enumerate(self.channel_names)
+            ]
+        )
+
+    def save(self, path: Union[str, Path]):
+        """
+        Save the histograms and statistics to a compressed NPZ file,
+        replaced atomically
+        """
+        path = Path(path)
+        df_stats = self.to_frame()
+        path_tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        with open(path_tmp, "wb") as f:
+            np.savez_compressed(
+                f,
+                version=HISTOGRAM_VERSION,
+                channel_names=np.array(self.channel_names),
+                counts=self.counts,
+                min=df_stats["min"].to_numpy(dtype=float),
+                max=df_stats["max"].to_numpy(dtype=float),
+                mean=df_stats["mean"].to_numpy(dtype=float),
+            )
+        os.replace(path_tmp, path)
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "ChannelHistograms":
+        """
+        Load histograms saved with `ChannelHistograms.save`
+        """
+        with np.load(path) as npz:
+            if int(npz["version"]) != HISTOGRAM_VERSION:
+                raise ValueError(f"Unsupported histogram version in {path}")
+            return cls(npz["channel_names"].tolist(), npz["counts"])
+
+
+def load_histograms(path_ometiff: Union[str, Path]) -> Optional[ChannelHistograms]:
+    """
+    Load the histogram sidecar of an OME-TIFF file or OME-Zarr store, None if
+    it has none
+    """
+    path_histogram = get_histogram_path(path_ometiff)
+    if not path_histogram.exists():
+        return None
+    return ChannelHistograms.load(path_histogram)
@@ -0,0 +1,348 @@
+import os
+import re
+import threading
+from pathlib import Path
+from typing import Iterable, Optional, Union
+
+import numpy as np
+import pandas as pd
+import tifffile
+
+MANIFEST_COLUMNS = [
+    "file",
+    "filename",
+    "prefix",
+    "region",
+    "cycle",
+    "channel",
+    "marker",
+    "marker_label",
+    "marker_type",
+    "height",
+    "width",
+    "dtype",
+    "mode",
+]
+
+
+def parse_registered_filename(filename: str) -> dict[str, str]:
+    """
+    Parse the name of a registered Keyence image
+
+    Registered images are named "{prefix}_{region}_{cycle}_{channel}_{marker}",
+    where prefix is "dst" or "src". Missing fields are left empty.
+
+    Parameters
+    ----------
+    filename : str
+        File name without the ".ome.tiff" extension.
+
+    Returns
+    -------
+    dict[str, str]
+        Fields of the name, with the marker label and marker type ("dapi",
+        "blank" or "marker").
+    """
+    parts = filename.split("_", 4)
+    parts += [""] * (5 - len(parts))
+    prefix, region, cycle, channel, marker = parts
+    if re.search(r"blank", filename, re.IGNORECASE) is not None:
+        marker_type = "blank"
+    elif re.search(r"Ch\dCy\d", filename) is not None:
+        marker_type = "dapi"
+    else:
+        marker_type = "marker"
+    return {
+        "prefix": prefix,
+        "region": region,
+        "cycle": cycle,
+        "channel": channel,
+        "marker": marker,
+        "marker_label": f"{prefix}_{cycle}_{channel}_{marker}",
+        "marker_type": marker_type,
+    }
+
+
+class RegistrationManifest:
+    def __init__(self, path: Union[str, Path], mode: str):
+        """
+        Persistent manifest of the registered images of one region and mode.
+
+        The manifest is a CSV file with one row per registered image, rewritten
+        atomically after every update so that a crashed run leaves either the
+        previous or the new manifest on disk. Updates from several threads are
+        serialized.
+
+        Parameters
+        ----------
+        path : Union[str, Path]
+            Path to the manifest CSV file.
+        mode : str
+            Registration mode of the images, "rigid" or "non_rigid".
+        """
+        self.path = Path(path)
+        self.mode = mode
+        self._lock = threading.Lock()
+        self.records = {}
+        if self.path.exists():
+            df = pd.read_csv(self.path, dtype=str, keep_default_na=False)
+            df = df.astype({"height": int, "width": int})
+            self.records = {
+                row["file"]: row for row in df.to_dict(orient="records")
+            }
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __contains__(self, registered_f: Union[str, Path]) -> bool:
+        return str(registered_f) in self.records
+
+    def get_files(self) -> list[Path]:
+        """
+        Registered files in the order they were recorded
+        """
+        return [Path(f) for f in self.records]
+
+    def add(
+        self,
+        registered_f: Union[str, Path],
+        filename: Optional[str] = None,
+        write: bool = True,
+    ):
+        """
+        Record a registered image, reading its shape and dtype from the header
+
+        Parameters
+        ----------
+        registered_f : Union[str, Path]
+            Path to the registered OME-TIFF file.
+        filename : str, optional
+            Name the image is recorded under. If None, the file name without
+            the ".ome.tiff" extension.
+        write : bool, optional
+            Whether to write the manifest to disk, by default True.
+        """
+        registered_f = Path(registered_f)
+        with tifffile.TiffFile(registered_f) as tif:
+            page = tif.pages[0]
+            height, width = page.shape[-2:]
+            dtype = str(page.dtype)
+
+        if filename is None:
+            filename = registered_f.name.replace(".ome.tiff", "")
+        record = {
+            "file": str(registered_f),
+            "filename": filename,
+            **parse_registered_filename(filename),
+            "height": height,
+            "width": width,
+            "dtype": dtype,
+            "mode": self.mode,
+        }
+        with self._lock:
+            self.records[str(registered_f)] = record
+            if write:
+                self._write()
+
+    def write(self):
+        """
+        Write the manifest to disk
+        """
+        with self._lock:
+            self._write()
+
+    def _write(self):
+        """Write to a temporary file, then replace the manifest atomically"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_f = self.path.with_name(
+            f".{self.path.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+        )
+        self.to_frame().to_csv(tmp_f, index=False)
+        os.replace(tmp_f, self.path)
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        Manifest as a DataFrame, one row per registered image
+        """
+        return pd.DataFrame(list(self.records.values()), columns=MANIFEST_COLUMNS)
+
+    @classmethod
+    def rebuild(
+        cls, path: Union[str, Path], ometiff_dir: Union[str, Path], mode: str
+    ) -> "RegistrationManifest":
+        """
+        Build the manifest of a directory registered before manifests existed
+
+        Parameters
+        ----------
+        path : Union[str, Path]
+            Path to the manifest CSV file.
+        ometiff_dir : Union[str, Path]
+            Directory of the registered OME-TIFF files.
+        mode : str
+            Registration mode of the images, "rigid" or "non_rigid".
+        """
+        manifest = cls(path, mode)
+        for registered_f in sorted(Path(ometiff_dir).glob("*.ome.tiff")):
+            if registered_f not in manifest:
+                manifest.add(registered_f, write=False)
+        manifest.write()
+        return manifest
+
+
+class BatchManifest:
+    def __init__(self, df: pd.DataFrame):
+        """
+        Query the manifests of a batch of regions.
+
+        Lookups by marker label and file name are dictionary lookups, so
+        cross-region queries do not touch the registered files.
+
+        Parameters
+        ----------
+        df : pd.DataFrame
+            Concatenated manifests with an "id" column, see `from_dirs`.
+        """
+        self.df = df.reset_index(drop=True)
+        self._by_label = {
+            (id, label): f
+            for id, label, f in zip(self.df.id, self.df.marker_label, self.df.file)
+        }
+        self._by_filename = {
+            (id, filename): f
+            for id, filename, f in zip(self.df.id, self.df.filename, self.df.file)
+        }
+
+    @classmethod
+    def from_dirs(
+        cls,
+        output_dirs: Iterable[Union[str, Path]],
+        mode: str = "non_rigid",
+        rebuild_missing: bool = True,
+    ) -> "BatchManifest":
+        """
+        Load the manifests of several regions
+
+        Parameters
+        ----------
+        output_dirs : Iterable[Union[str, Path]]
+            Output directories of `ValisAligner`, one per region. The region id
+            is the directory name.
+        mode : str, optional
+            Registration mode, by default "non_rigid".
+        rebuild_missing : bool, optional
+            Whether to build and save the manifest of regions registered
+            before manifests existed, by default True. Otherwise such regions
+            are skipped.
+        """
+        dfs = []
+        for output_dir in output_dirs:
+            registered_dir = Path(output_dir) / f"registered_{mode}"
+            manifest_f = registered_dir / "manifest.csv"
+            if manifest_f.exists():
+                manifest = RegistrationManifest(manifest_f, mode)
+            elif rebuild_missing and (registered_dir / "ometiff").exists():
+                manifest = RegistrationManifest.rebuild(
+                    manifest_f, registered_dir / "ometiff", mode
+                )
+            else:
+                continue
+            dfs.append(manifest.to_frame().assign(id=Path(output_dir).name))
+        if len(dfs) == 0:
+            return cls(pd.DataFrame(columns=["id"] + MANIFEST_COLUMNS))
+        return cls(pd.concat(dfs, ignore_index=True))
+
+    @classmethod
+    def from_inputs(cls, params_df: pd.DataFrame) -> "BatchManifest":
+        """
+        Index the input images of several regions before registration
+
+        Images are recorded under the name of their registered file
+        ("{prefix}_{stem}") with mode "input", so the same queries return the
+        image to warp, e.g. for `ValisAligner.AlignBase.apply_ometiff`. The
+        index of each region is saved to "input_manifest.csv" in its output
+        directory.
+
+        Parameters
+        ----------
+        params_df : pd.DataFrame
+            Parameter table with "id", "dst_dir", "src_dir" and "output_dir",
+            see `register_pair`.
+        """
+        dfs = []
+        for _, row in params_df.iterrows():
+            manifest = RegistrationManifest(
+                Path(row["output_dir"]) / "input_manifest.csv", "input"
+            )
+            for prefix in ["dst", "src"]:
+                for f in sorted(Path(row[f"{prefix}_dir"]).glob("*.tif")):
+                    manifest.add(f, filename=f"{prefix}_{f.stem}", write=False)
+            manifest.write()
+            dfs.append(manifest.to_frame().assign(id=row["id"]))
+        if len(dfs) == 0:
+            return cls(pd.DataFrame(columns=["id"] + MANIFEST_COLUMNS))
+        return cls(pd.concat(dfs, ignore_index=True))
+
+    @property
+    def ids(self) -> list[str]:
+        """Region ids of the batch"""
+        return self.df.id.unique().tolist()
+
+    def query(self, **filters) -> pd.DataFrame:
+        """
+        Rows whose columns equal the given values, e.g.
+        `query(id="reg001", marker_type="dapi")`
+        """
+        idx = np.ones(self.df.shape[0], dtype=bool)
+        for column, value in filters.items():
+            idx &= (self.df[column] == value).to_numpy()
+        return self.df[idx]
+
+    def get_file(
+        self,
+        id: str,
+        marker_label: Optional[str] = None,
+        filename: Optional[str] = None,
+    ) -> Path:
+        """
+        Registered file of a region by marker label or file name
+
+        Raises
+        ------
+        KeyError
+            If no registered file matches.
+        """
+        if (marker_label is None) == (filename is None):
+            raise ValueError("Specify exactly one of marker_label and filename")
+        if marker_label is not None:
+            return Path(self._by_label[(id, marker_label)])
+        return Path(self._by_filename[(id, filename)])
+
+    def get_dapi_cycles(self, prefix: str = "dst", channel: str = "Ch1") -> pd.Series:
+        """
+        DAPI cycle of every DAPI image of the given prefix and channel
+        """
+        df = self.query(prefix=prefix, marker_type="dapi")
+        cycles = df.filename.str.extract(rf"{channel}Cy(\d+)", expand=False)
+        idx = cycles.notna()
+        return pd.Series(cycles[idx].astype(int).to_numpy(), index=df.id[idx])
+
+    def get_max_common_dapi_cycle(
+        self, prefix: str = "dst", channel: str = "Ch1"
+    ) -> int:
+        """
+        Largest DAPI cycle present in every region of the batch
+
+        Parameters
+        ----------
+        prefix : str, optional
+            Image prefix, by default "dst".
+        channel : str, optional
+            DAPI channel, by default "Ch1".
+        """
+        cycles = self.get_dapi_cycles(prefix=prefix, channel=channel)
+        n_ids = cycles.groupby(cycles.values).apply(lambda x: x.index.nunique())
+        common = n_ids.index[n_ids == len(self.ids)]
+        if len(common) == 0:
+            raise ValueError("No DAPI cycle is common to all regions")
+        return int(common.max())
@@ -0,0 +1,772 @@
+import io
+import math
+import os
+import tempfile
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Optional, Union
+
+import numpy as np
+import tifffile
+
+try:
+    import zarr
+    from numcodecs import Blosc
+except ImportError:
+    zarr = None
+
+from .histogram import ChannelHistograms, get_histogram_path, is_histogram_dtype
+
+COMPRESSIONS = ["none", "zlib", "zstd", "lzw", "lzma", "jpegxl"]
+
+
+class TiffWindowReader:
+    def __init__(
+        self,
+        path: Union[str, Path, tifffile.TiffPage],
+        cache_bytes: int = 128 * 2**20,
+    ):
+        """
+        Read rectangular windows from the first page of a TIFF file, or from a
+        given page of an open TIFF file, decoding only the tiles or strips that
+        intersect the window.
+
+        Segments (tiles or strips) that extend past the right or bottom edge of
+        a window are kept in a small cache, so reading windows in row-major
+        order decodes every segment once, even when strips span many windows.
+
+        Parameters
+        ----------
+        path : Union[str, Path, tifffile.TiffPage]
+            Path to a single-channel TIFF or OME-TIFF file, or a page of an
+            open TIFF file. Readers of pages share the file handle of their
+            file, which is left open on `close`.
+        cache_bytes : int, optional
+            Maximum size of the decoded segments kept between reads, by
+            default 128 MiB. Least recently used segments are dropped first.
+        """
+        if isinstance(path, (str, Path)):
+            self.tif = tifffile.TiffFile(path)
+            self.page = self.tif.pages[0]
+            self._owns_file = True
+        else:
+            self.tif = path.parent
+            self.page = path.aspage()
+            self._owns_file = False
+        self.path = Path(self.tif.filehandle.path)
+        self.tif.filehandle.set_lock(True)
+        if self.page.samplesperpixel != 1 or len(self.page.shape) != 2:
+            raise ValueError(f"Expected a single-channel 2D image: {self.path}")
+        self.shape = self.page.shape
+        self.dtype = self.page.dtype
+        self.cache_bytes = cache_bytes
+        self._cache = OrderedDict()
+        self._cache_size = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self._cache.clear()
+            self._cache_size = 0
+        if self._owns_file:
+            self.tif.close()
+
+    def _decode_segment(self, index: int) -> np.ndarray:
+        """Decoded segment `index`, from the cache if it holds it"""
+        page = self.page
+        with self._lock:
+            segment = self._cache.get(index)
+            if segment is not None:
+                self._cache.move_to_end(index)
+                return segment
+        bytecount = page.databytecounts[index]
+        if bytecount > 0:
+            fh = self.tif.filehandle
+            with fh.lock:
+                fh.seek(page.dataoffsets[index])
+                data = fh.read(bytecount)
+        else:
+            data = None
+        segment, _, _ = page.decode(data, index, jpegtables=page.jpegtables)
+        return segment.reshape(segment.shape[-3:-1])
+
+    def _update_cache(self, index: int, segment: np.ndarray, keep: bool):
+        """Keep a segment for later reads, or drop it from the cache"""
+        with self._lock:
+            if index in self._cache:
+                if keep:
+                    return
+                self._cache_size -= self._cache.pop(index).nbytes
+            if not keep or segment.nbytes > self.cache_bytes:
+                return
+            self._cache[index] = segment
+            self._cache_size += segment.nbytes
+            while self._cache_size > self.cache_bytes:
+                _, dropped = self._cache.popitem(last=False)
+                self._cache_size -= dropped.nbytes
+
+    def read(self, y0: int, y1: int, x0: int, x1: int, step: int = 1) -> np.ndarray:
+        """
+        Read the window [y0:y1, x0:x1], subsampled every `step` pixels
+
+        Parameters
+        ----------
+        y0, y1, x0, x1 : int
+            Window bounds in level 0 pixels.
+        step : int, optional
+            Subsampling step, by default 1.
+
+        Returns
+        -------
+        np.ndarray
+            Window of shape (ceil((y1 - y0) / step), ceil((x1 - x0) / step)).
+        """
+        page = self.page
+        seg_h, seg_w = page.chunks[-2:]
+        n_cols = page.chunked[-1]
+
+        window = np.zeros(
+            (math.ceil((y1 - y0) / step), math.ceil((x1 - x0) / step)),
+            dtype=self.dtype,
+        )
+        for r in range(y0 // seg_h, (y1 - 1) // seg_h + 1):
+            for c in range(x0 // seg_w, (x1 - 1) // seg_w + 1):
+                index = r * n_cols + c
+                segment = self._decode_segment(index)
+
+                # Segments reaching past the window are read again by the
+                # windows to its right or below
+                sy0, sx0 = r * seg_h, c * seg_w
+                sy1 = min(sy0 + segment.shape[0], self.shape[0])
+                sx1 = min(sx0 + segment.shape[1], self.shape[1])
+                self._update_cache(index, segment, keep=sy1 > y1 or sx1 > x1)
+
+                # Intersection of the segment and the window, on the step grid
+                iy0, iy1 = max(y0, sy0), min(y1, sy0 + segment.shape[0])
+                ix0, ix1 = max(x0, sx0), min(x1, sx0 + segment.shape[1])
+                iy0 += (y0 - iy0) % step
+                ix0 += (x0 - ix0) % step
+                if iy0 >= iy1 or ix0 >= ix1:
+                    continue
+                part = segment[
+                    iy0 - sy0 : iy1 - sy0 : step, ix0 - sx0 : ix1 - sx0 : step
+                ]
+                wy0, wx0 = (iy0 - y0) // step, (ix0 - x0) // step
+                window[wy0 : wy0 + part.shape[0], wx0 : wx0 + part.shape[1]] = part
+        return window
+
+
+def read_thumbnail(path: Union[str, Path], max_dim_px: int) -> np.ndarray:
+    """
+    Read a downsampled copy of a single-channel image
+
+    The smallest pyramid level whose largest dimension is at least
+    `max_dim_px` is read, then subsampled to at most `max_dim_px` pixels per
+    side. Images without a pyramid are subsampled from level 0, decoding one
+    tile or strip at a time.
+
+    Parameters
+    ----------
+    path : Union[str, Path]
+        Path to a single-channel TIFF or OME-TIFF file.
+    max_dim_px : int
+        Maximum size of the largest dimension of the thumbnail.
+
+    Returns
+    -------
+    np.ndarray
+        Thumbnail image.
+    """
+    with tifffile.TiffFile(path) as tif:
+        levels = tif.series[0].levels
+        level = levels[0]
+        for candidate in levels[1:]:
+            if max(candidate.shape[-2:]) >= max_dim_px:
+                level = candidate
+        if level is not levels[0] and len(level.shape) == 2:
+            img = level.asarray()
+            step = math.ceil(max(img.shape) / max_dim_px)
+            return np.ascontiguousarray(img[::step, ::step])
+
+    with TiffWindowReader(path) as reader:
+        height, width = reader.shape
+        step = math.ceil(max(height, width) / max_dim_px)
+        return reader.read(0, height, 0, width, step)
+
+
+def get_n_levels(shape: tuple[int, int], tile_size: int) -> int:
+    """
+    Number of pyramid levels until the image fits in a single tile
+    """
+    return max(1, math.ceil(math.log2(max(shape) / tile_size)) + 1)
+
+
+def get_compression_kwargs(
+    compression: str = "zlib", level: Optional[int] = None, predictor: bool = False
+) -> dict:
+    """
+    Keyword arguments of `tifffile.TiffWriter.write` for a lossless tile
+    compression
+
+    Parameters
+    ----------
+    compression : str, optional
+        Codec, by default "zlib".
+        - "none": uncompressed.
+        - "zlib" (deflate), "zstd" and "lzma": `level` trades speed for size.
+        - "lzw": no level.
+        - "jpegxl": lossless JPEG-XL, `level` is the encoder effort (1-9).
+        Codecs other than zlib and lzma need imagecodecs, see
+        `is_compression_available`.
+    level : int, optional
+        Compression level. If None, the codec default.
+    predictor : bool, optional
+        Whether to apply horizontal differencing before compression, by
+        default False. It often shrinks microscopy images noticeably at a
+        small encoding cost. Not used with "none" and "jpegxl".
+
+    Returns
+    -------
+    dict
+        Keyword arguments "compression", "compressionargs" and "predictor".
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression: {compression}")
+    if compression == "none":
+        return {"compression": None}
+    kwargs = {"compression": compression, "compressionargs": {}}
+    if compression == "jpegxl":
+        kwargs["compressionargs"]["lossless"] = True
+        if level is not None:
+            kwargs["compressionargs"]["effort"] = level
+        return kwargs
+    if level is not None:
+        if compression == "lzw":
+            raise ValueError("LZW has no compression level")
+        kwargs["compressionargs"]["level"] = level
+    if predictor:
+        kwargs["predictor"] = True
+    return kwargs
+
+
+def is_compression_available(compression: str) -> bool:
+    """
+    Whether tifffile can encode a compression in this environment
+    """
+    try:
+        tifffile.imwrite(
+            io.BytesIO(),
+            np.zeros((16, 16), np.uint16),
+            tile=(16, 16),
+            **get_compression_kwargs(compression),
+        )
+    except (ImportError, KeyError):
+        return False
+    return True
+
+
+def write_ometiff_pyramid_tiled(
+    output_f: Union[str, Path],
+    shape: tuple[int, int],
+    dtype: np.dtype,
+    channel_names: list[str],
+    tile_fn: Callable[[int, int, int, int, int], np.ndarray],
+    tile_size: int = 512,
+    n_levels: Optional[int] = None,
+    compression: str = "zlib",
+    compression_level: Optional[int] = None,
+    predictor: bool = False,
+    n_workers: int = 1,
+    n_encode_threads: Optional[int] = None,
+):
+    """
+    Write a pyramidal OME-TIFF tile by tile and level by level
+
+    Level 0 tiles are requested from `tile_fn` once, in the order they are
+    written. With several workers, up to `2 * n_workers` tiles are computed
+    ahead of the writer; otherwise a single tile is held in memory at any
+    time. Computed tiles are compressed by a separate pool of
+    `n_encode_threads` threads.
+
+    Level k is level 0 subsampled every 2**k pixels. As TIFF stores level 0
+    of every channel before the next levels, level 1 is filled from the level
+    0 tiles into a temporary file next to the output, and the next levels are
+    subsampled from it, so `tile_fn` is never called again.
+
+    Parameters
+    ----------
+    output_f : Union[str, Path]
+        Path to the output OME-TIFF file.
+    shape : tuple[int, int]
+        Level 0 shape (height, width) of every channel.
+    dtype : np.dtype
+        Data type of every channel.
+    channel_names : list[str]
+        List of channel names.
+    tile_fn : Callable[[int, int, int, int, int], np.ndarray]
+        Function `tile_fn(c, y0, y1, x0, x1)` returning the level 0 window
+        [y0:y1, x0:x1] of channel `c`.
+    tile_size : int, optional
+        Tile size in pixels, by default 512. Must be even.
+    n_levels : int, optional
+        Number of pyramid levels. If None, levels are added until the image
+        fits in a single tile.
+    compression : str, optional
+        Tile compression, by default "zlib". See `get_compression_kwargs`.
+    compression_level : int, optional
+        Compression level. If None, the codec default.
+    predictor : bool, optional
+        Whether to apply horizontal differencing before compression, by
+        default False.
+    n_workers : int, optional
+        Number of threads calling `tile_fn`, by default 1.
+    n_encode_threads : int, optional
+        Number of threads compressing tiles. If None, tifffile decides from
+        the codec and the tile size.
+    """
+    if tile_size % 2:
+        raise ValueError(f"Tile size must be even: {tile_size}")
+    compression_kwargs = get_compression_kwargs(
+        compression, compression_level, predictor
+    )
+    height, width = shape
+    n_channels = len(channel_names)
+    if n_levels is None:
+        n_levels = get_n_levels(shape, tile_size)
+
+    def iter_windows():
+        for c in range(n_channels):
+            for y0 in range(0, height, tile_size):
+                for x0 in range(0, width, tile_size):
+                    y1, x1 = min(height, y0 + tile_size), min(width, x0 + tile_size)
+                    yield c, y0, y1, x0, x1
+
+    def iter_tiles():
+        if n_workers <= 1:
+            for window in iter_windows():
+                yield window, tile_fn(*window)
+            return
+
+        # Compute a bounded number of tiles ahead, yielding them in order
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            pending = deque()
+            for window in iter_windows():
+                pending.append((window, executor.submit(tile_fn, *window)))
+                if len(pending) >= 2 * n_workers:
+                    window, future = pending.popleft()
+                    yield window, future.result()
+            while pending:
+                window, future = pending.popleft()
+                yield window, future.result()
+
+    def iter_level0(level1):
+        for (c, y0, y1, x0, x1), tile in iter_tiles():
+            if level1 is not None:
+                sub, ly0, lx0 = tile[::2, ::2], y0 // 2, x0 // 2
+                level1[c, ly0 : ly0 + sub.shape[0], lx0 : lx0 + sub.shape[1]] = sub
+            yield tile
+
+    def iter_level(level1, step):
+        level = level1[:, ::step, ::step]
+        for c in range(n_channels):
+            for ty in range(0, level.shape[1], tile_size):
+                for tx in range(0, level.shape[2], tile_size):
+                    yield np.ascontiguousarray(
+                        level[c, ty : ty + tile_size, tx : tx + tile_size]
+                    )
+
+    output_f = Path(output_f)
+    with tempfile.TemporaryFile(dir=output_f.parent) as buffer_f:
+        level1 = None
+        if n_levels > 1:
+            level1 = np.memmap(
+                buffer_f,
+                dtype=dtype,
+                mode="w+",
+                shape=(n_channels, math.ceil(height / 2), math.ceil(width / 2)),
+            )
+        with tifffile.TiffWriter(output_f, bigtiff=True, ome=True) as tif:
+            for level in range(n_levels):
+                step = 2**level
+                level_shape = (
+                    n_channels,
+                    math.ceil(height / step),
+                    math.ceil(width / step),
+                )
+                options = dict(
+                    shape=level_shape,
+                    dtype=dtype,
+                    tile=(tile_size, tile_size),
+                    photometric="minisblack",
+                    maxworkers=n_encode_threads,
+                    **compression_kwargs,
+                )
+                if level == 0:
+                    tif.write(
+                        iter_level0(level1),
+                        subifds=n_levels - 1,
+                        metadata={"axes": "CYX", "Channel": {"Name": channel_names}},
+                        **options,
+                    )
+                else:
+                    tif.write(
+                        iter_level(level1, step // 2),
+                        subfiletype=1,
+                        metadata=None,
+                        **options,
+                    )
+
+
+def is_ngff(path: Union[str, Path]) -> bool:
+    """
+    Whether a path is an OME-Zarr store, from its ".zarr" extension
+    """
+    return Path(path).suffix == ".zarr"
+
+
+def write_ngff_pyramid_tiled(
+    output_f: Union[str, Path],
+    shape: tuple[int, int],
+    dtype: np.dtype,
+    channel_names: list[str],
+    tile_fn: Callable[[int, int, int, int, int], np.ndarray],
+    tile_size: int = 512,
+    n_levels: Optional[int] = None,
+    compression: str = "zstd",
+    compression_level: Optional[int] = None,
+    n_workers: int = 1,
+):
+    """
+    Write a multiscale OME-Zarr (OME-NGFF 0.4) store tile by tile and level by
+    level
+
+    Every tile is exactly one chunk of its level, so tiles are computed,
+    compressed and written by `n_workers` threads concurrently, without
+    locking, and readers can later fetch single tiles of any level. Levels
+    follow the same subsampling as `write_ometiff_pyramid_tiled`: level 0
+    tiles are requested from `tile_fn` once, and each next level is
+    subsampled from the chunks of the previous one. Channels are written one
+    after the other, all levels of a channel before the next one, so
+    `tile_fn` can hold a single channel in memory.
+
+    Parameters
+    ----------
+    output_f : Union[str, Path]
+        Path to the output store, a directory ending in ".zarr". An existing
+        store is overwritten.
+    shape : tuple[int, int]
+        Level 0 shape (height, width) of every channel.
+    dtype : np.dtype
+        Data type of every channel.
+    channel_names : list[str]
+        List of channel names.
+    tile_fn : Callable[[int, int, int, int, int], np.ndarray]
+        Function `tile_fn(c, y0, y1, x0, x1)` returning the level 0 window
+        [y0:y1, x0:x1] of channel `c`.
+    tile_size : int, optional
+        Tile and chunk size in pixels, by default 512.
+    n_levels : int, optional
+        Number of pyramid levels. If None, levels are added until the image
+        fits in a single tile.
+    compression : str, optional
+        Blosc compressor of the chunks, by default "zstd". One of "none",
+        "zstd", "zlib", "lz4", "lz4hc" and "blosclz".
+    compression_level : int, optional
+        Compression level from 1 to 9, by default 5.
+    n_workers : int, optional
+        Number of threads computing, compressing and writing tiles, by default
+        1.
+    """
+    if zarr is None:
+        raise ImportError("Writing OME-Zarr requires zarr: pip install 'zarr<3'")
+    if compression == "none":
+        compressor = None
+    elif compression in ["zstd", "zlib", "lz4", "lz4hc", "blosclz"]:
+        compressor = Blosc(
+            cname=compression,
+            clevel=5 if compression_level is None else compression_level,
+            shuffle=Blosc.BITSHUFFLE,
+        )
+    else:
+        raise ValueError(f"Unsupported OME-Zarr compression: {compression}")
+    height, width = shape
+    n_channels = len(channel_names)
+    if n_levels is None:
+        n_levels = get_n_levels(shape, tile_size)
+
+    root = zarr.open_group(str(output_f), mode="w")
+    arrays, datasets = [], []
+    for level in range(n_levels):
+        step = 2**level
+        arrays.append(
+            root.create_dataset(
+                str(level),
+                shape=(n_channels, math.ceil(height / step), math.ceil(width / step)),
+                chunks=(1, tile_size, tile_size),
+                dtype=dtype,
+                compressor=compressor,
+                dimension_separator="/",
+            )
+        )
+        datasets.append(
+            {
+                "path": str(level),
+                "coordinateTransformations": [
+                    {"type": "scale", "scale": [1.0, float(step), float(step)]}
+                ],
+            }
+        )
+
+    def write_tile(c, level, ty, tx):
+        array = arrays[level]
+        ty1 = min(array.shape[1], ty + tile_size)
+        tx1 = min(array.shape[2], tx + tile_size)
+        if level == 0:
+            tile = tile_fn(c, ty, ty1, tx, tx1)
+        else:
+            # Subsample the chunks of the previous level already written
+            tile = arrays[level - 1][c, 2 * ty : 2 * ty1 : 2, 2 * tx : 2 * tx1 : 2]
+        array[c, ty:ty1, tx:tx1] = tile
+
+    for c in range(n_channels):
+        for level, array in enumerate(arrays):
+            tiles = [
+                (c, level, ty, tx)
+                for ty in range(0, array.shape[1], tile_size)
+                for tx in range(0, array.shape[2], tile_size)
+            ]
+            if n_workers <= 1:
+                for tile in tiles:
+                    write_tile(*tile)
+            else:
+                with ThreadPoolExecutor(max_workers=n_workers) as executor:
+                    for _ in executor.map(lambda tile: write_tile(*tile), tiles):
+                        pass
+
+    # Metadata is written last, so an interrupted store has no multiscales
+    if np.issubdtype(dtype, np.integer):
+        value_min, value_max = int(np.iinfo(dtype).min), int(np.iinfo(dtype).max)
+    else:
+        value_min, value_max = 0.0, 1.0
+    root.attrs["omero"] = {
+        "version": "0.4",
+        "channels": [
+            {
+                "label": channel_name,
+                "active": True,
+                "color": "FFFFFF",
+                "window": {
+                    "min": value_min,
+                    "max": value_max,
+                    "start": value_min,
+                    "end": value_max,
+                },
+            }
+            for channel_name in channel_names
+        ],
+    }
+    root.attrs["multiscales"] = [
+        {
+            "version": "0.4",
+            "name": Path(output_f).name.split(".")[0],
+            "axes": [
+                {"name": "c", "type": "channel"},
+                {"name": "y", "type": "space"},
+                {"name": "x", "type": "space"},
+            ],
+            "datasets": datasets,
+            "type": "subsample",
+        }
+    ]
+
+
+def write_pyramid_tiled(output_f: Union[str, Path], *args, **kwargs):
+    """
+    Write a pyramid tile by tile with the writer of the output format: an
+    OME-Zarr store if `output_f` ends in ".zarr", an OME-TIFF otherwise
+
+    Arguments are those of `write_ometiff_pyramid_tiled`. Arguments set to
+    None take the default of the writer. OME-Zarr chunks are compressed by
+    the `n_workers` threads and stored with Blosc bit shuffling, so
+    "predictor" and "n_encode_threads" only apply to OME-TIFF.
+    """
+    kwargs = {key: value for key, value in kwargs.items() if value is not None}
+    if is_ngff(output_f):
+        kwargs.pop("predictor", None)
+        kwargs.pop("n_encode_threads", None)
+        write_ngff_pyramid_tiled(output_f, *args, **kwargs)
+    else:
+        write_ometiff_pyramid_tiled(output_f, *args, **kwargs)
+
+
+def export_masked_ometiff(
+    img_fl: list[Union[str, Path]],
+    output_f: Union[str, Path],
+    channel_names: list[str],
+    mask: Optional[Union[str, Path, object]] = None,
+    tile_size: int = 512,
+    encoding: Optional[dict] = None,
+    histogram: bool = True,
+):
+    """
+    Stream single-channel images into one multichannel pyramidal OME-TIFF,
+    applying an overlap mask tile by tile.
+
+    Peak memory is a few tiles regardless of the number of channels, as every
+    tile is read, masked in place and written before the next one is read.
+
+    Parameters
+    ----------
+    img_fl : list[Union[str, Path]]
+        Paths to the single-channel images, one per channel.
+    output_f : Union[str, Path]
+        Path to the output OME-TIFF file, or OME-Zarr store if it ends in
+        ".zarr".
+    channel_names : list[str]
+        List of channel names, in the same order as `img_fl`.
+    mask : Union[str, Path, object], optional
+        Overlap mask multiplied with every channel, either the path to a mask
+        image or an object with `shape` and a `read(y0, y1, x0, x1)` method
+        such as `OverlapMask`. If None, the images are written unmasked.
+    tile_size : int, optional
+        Tile size in pixels, by default 512.
+    encoding : dict, optional
+        Compression keywords of `write_ometiff_pyramid_tiled`, e.g.
+        {"compression": "zstd", "compression_level": 5, "predictor": True,
+        "n_encode_threads": 8}. If None, the defaults of the output format.
+    histogram : bool, optional
+        Whether to save the intensity histogram of every uint8 or uint16
+        channel next to the output, counted from the masked level 0 tiles as
+        they are written, by default True. See `ChannelHistograms`.
+    """
+    if len(img_fl) != len(channel_names):
+        raise ValueError("Number of images and channel names do not match")
+
+    readers = [TiffWindowReader(img_f) for img_f in img_fl]
+    mask_reader = TiffWindowReader(mask) if isinstance(mask, (str, Path)) else mask
+    try:
+        shape, dtype = readers[0].shape, readers[0].dtype
+        for reader in readers[1:] + ([mask_reader] if mask is not None else []):
+            if tuple(reader.shape) != tuple(shape):
+                raise ValueError(f"Shape {reader.shape} does not match {shape}")
+
+        def tile_fn(c, y0, y1, x0, x1):
+            tile = readers[c].read(y0, y1, x0, x1)
+            if mask_reader is not None:
+                mask_tile = mask_reader.read(y0, y1, x0, x1)
+                np.multiply(tile, mask_tile, out=tile, casting="unsafe")
+            return tile
+
+        histograms = None
+        if histogram and is_histogram_dtype(dtype):
+            histograms = ChannelHistograms(channel_names)
+            tile_fn = histograms.wrap(tile_fn)
+        write_pyramid_tiled(
+            output_f,
+            shape=shape,
+            dtype=dtype,
+            channel_names=channel_names,
+            tile_fn=tile_fn,
+            tile_size=tile_size,
+            **(encoding or {}),
+        )
+        if histograms is not None:
+            histograms.save(get_histogram_path(output_f))
+    finally:
+        for reader in readers:
+            reader.close()
+        if isinstance(mask_reader, TiffWindowReader):
+            mask_reader.close()
+
+
+def rewrite_ometiff(
+    src_f: Union[str, Path],
+    dst_f: Union[str, Path],
+    channel_name: Optional[str] = None,
+    tile_size: int = 512,
+):
+    """
+    Write a single-channel image to a pyramidal OME-TIFF without resampling
+
+    OME-TIFF inputs are hardlinked when the filesystem allows it, other inputs
+    are rewritten tile by tile.
+
+    Parameters
+    ----------
+    src_f : Union[str, Path]
+        Path to the input single-channel image.
+    dst_f : Union[str, Path]
+        Path to the output OME-TIFF file.
+    channel_name : str, optional
+        Channel name. If None, the input file name is used.
+    tile_size : int, optional
+        Tile size in pixels, by default 512.
+    """
+    src_f = Path(src_f)
+    if src_f.name.endswith((".ome.tif", ".ome.tiff")) and not is_ngff(dst_f):
+        try:
+            os.link(src_f, dst_f)
+            return
+        except OSError:
+            pass
+
+    if channel_name is None:
+        channel_name = src_f.name.split(".")[0]
+    with TiffWindowReader(src_f) as reader:
+        write_pyramid_tiled(
+            dst_f,
+            shape=reader.shape,
+            dtype=reader.dtype,
+            channel_names=[channel_name],
+            tile_fn=lambda c, y0, y1, x0, x1: reader.read(y0, y1, x0, x1),
+            tile_size=tile_size,
+        )
+
+
+def compare_ometiff(
+    f1: Union[str, Path], f2: Union[str, Path], tile_size: int = 2048
+) -> dict[str, float]:
+    """
+    Compare the level 0 pixels of two single-channel images tile by tile
+
+    Parameters
+    ----------
+    f1, f2 : Union[str, Path]
+        Paths to the images to compare, which must have the same shape.
+    tile_size : int, optional
+        Tile size in pixels, by default 2048.
+
+    Returns
+    -------
+    dict[str, float]
+        Maximum and mean absolute difference, and fraction of differing pixels.
+    """
+    with TiffWindowReader(f1) as reader1, TiffWindowReader(f2) as reader2:
+        if reader1.shape != reader2.shape:
+            raise ValueError(f"Shapes differ: {reader1.shape} and {reader2.shape}")
+        height, width = reader1.shape
+        max_diff, sum_diff, n_diff = 0.0, 0.0, 0
+        for y0 in range(0, height, tile_size):
+            for x0 in range(0, width, tile_size):
+                y1, x1 = min(height, y0 + tile_size), min(width, x0 + tile_size)
+                diff = np.abs(
+                    reader1.read(y0, y1, x0, x1).astype(np.float64)
+                    - reader2.read(y0, y1, x0, x1)
+                )
+                max_diff = max(max_diff, float(diff.max()))
+                sum_diff += float(diff.sum())
+                n_diff += int(np.count_nonzero(diff))
+    n_pixels = height * width
+    return {
+        "max_abs_diff": max_diff,
+        "mean_abs_diff": sum_diff / n_pixels,
+        "frac_diff": n_diff / n_pixels,
+    }
@@ -0,0 +1,160 @@
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+from typing import Callable, Optional, Union
+
+import numpy as np
+import pandas as pd
+
+
+def _read_io_bytes() -> tuple[float, float]:
+    """Bytes read from and written to storage by this process so far"""
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+        return float(counters["read_bytes"]), float(counters["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        return np.nan, np.nan
+
+
+def _get_peak_rss_mb() -> float:
+    """Peak resident set size of this process in MiB"""
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class StageProfiler:
+    def __init__(self):
+        """
+        Record wall time, CPU time, peak RSS and I/O of pipeline stages.
+
+        CPU time and I/O counters are process-wide, so stages running
+        concurrently on a worker pool include each other's work. Peak RSS is
+        the process peak at the end of the stage.
+        """
+        self.records = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(
+        self,
+        stage: str,
+        output_f: Optional[Union[str, Path]] = None,
+        **labels,
+    ):
+        """
+        Profile the enclosed block as one stage
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage (e.g. "register" or "warp_rigid").
+        output_f : Union[str, Path], optional
+            Output file of the stage, whose size is recorded.
+        **labels
+            Extra columns of the record (e.g. the input file).
+        """
+        start = time.time()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        read_start, write_start = _read_io_bytes()
+        try:
+            yield
+        finally:
+            read_end, write_end = _read_io_bytes()
+            output_bytes = np.nan
+            if output_f is not None and Path(output_f).exists():
+                output_bytes = Path(output_f).stat().st_size
+            record = {
+                "stage": stage,
+                "start": start,
+                "wall_s": time.perf_counter() - wall_start,
+                "cpu_s": time.process_time() - cpu_start,
+                "peak_rss_mb": _get_peak_rss_mb(),
+                "read_bytes": read_end - read_start,
+                "write_bytes": write_end - write_start,
+                "output_f": None if output_f is None else str(output_f),
+                "output_bytes": output_bytes,
+                **{key: str(value) for key, value in labels.items()},
+            }
+            with self._lock:
+                self.records.append(record)
+
+    def wrap(
+        self,
+        func: Callable,
+        stage: str,
+        output_f: Optional[Union[str, Path]] = None,
+        **labels,
+    ) -> Callable:
+        """
+        Wrap a function so each call is profiled as one stage, e.g. before
+        submitting it to a worker pool
+        """
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.stage(stage, output_f=output_f, **labels):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        Records as a DataFrame, one row per stage
+        """
+        with self._lock:
+            return pd.DataFrame(self.records)
+
+    def write(self, output_f: Union[str, Path]):
+        """
+        Write the records to a CSV file and a JSON file with the same stem
+        """
+        output_f = Path(output_f)
+        output_f.parent.mkdir(parents=True, exist_ok=True)
+        df = self.to_frame()
+        df.to_csv(output_f.with_suffix(".csv"), index=False)
+        with open(output_f.with_suffix(".json"), "w") as f:
+            json.dump(json.loads(df.to_json(orient="records")), f, indent=2)
+
+
+def summarize_profiles(profile_fl: list[Union[str, Path]]) -> pd.DataFrame:
+    """
+    Summarize stage profiles of a batch of regions
+
+    Parameters
+    ----------
+    profile_fl : list[Union[str, Path]]
+        Paths to the CSV profiles written by `StageProfiler.write`.
+
+    Returns
+    -------
+    pd.DataFrame
+        Per stage: number of calls, total and maximum wall time, total CPU
+        time, maximum peak RSS, total I/O and output size.
+    """
+    profile_fl = [f for f in profile_fl if os.path.exists(f)]
+    if len(profile_fl) == 0:
+        return pd.DataFrame()
+    df = pd.concat(
+        [pd.read_csv(f).assign(profile_f=str(f)) for f in profile_fl],
+        ignore_index=True,
+    )
+    return (
+        df.groupby("stage")
+        .agg(
+            n=("wall_s", "size"),
+            wall_s_total=("wall_s", "sum"),
+            wall_s_max=("wall_s", "max"),
+            cpu_s_total=("cpu_s", "sum"),
+            peak_rss_mb_max=("peak_rss_mb", "max"),
+            read_bytes_total=("read_bytes", "sum"),
+            write_bytes_total=("write_bytes", "sum"),
+            output_bytes_total=("output_bytes", "sum"),
+        )
+        .reset_index()
+    )
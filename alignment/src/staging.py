@@ -0,0 +1,114 @@
+import logging
+import os
+import shutil
+from pathlib import Path
+from typing import Optional, Union
+
+from .cache import hash_file
+
+STAGING_METHODS = ["auto", "hardlink", "symlink", "copy"]
+
+
+class InputStager:
+    def __init__(
+        self,
+        stage_dir: Union[str, Path],
+        method: str = "auto",
+        scratch_dir: Optional[Union[str, Path]] = None,
+        verify: bool = True,
+    ):
+        """
+        Stage input images under the file names a tool expects without
+        copying them when the filesystem allows it.
+
+        Parameters
+        ----------
+        stage_dir : Union[str, Path]
+            Directory the staged files are exposed in.
+        method : str, optional
+            Staging method, by default "auto".
+            - "auto": hardlink, then symlink, then copy, whichever works first.
+            - "hardlink", "symlink" or "copy": only this method.
+        scratch_dir : Union[str, Path], optional
+            Local directory copies are written to, exposed in `stage_dir` by a
+            symlink. If None, copies are written to `stage_dir`.
+        verify : bool, optional
+            Whether to compare the checksum of copies with their source, by
+            default True.
+        """
+        if method not in STAGING_METHODS:
+            raise ValueError(f"Unknown staging method: {method}")
+        self.stage_dir = Path(stage_dir)
+        self.stage_dir.mkdir(parents=True, exist_ok=True)
+        self.method = method
+        self.scratch_dir = None if scratch_dir is None else Path(scratch_dir).resolve()
+        self.verify = verify
+        self.staged = []
+
+    def stage(self, src_f: Union[str, Path], name: str) -> Path:
+        """
+        Expose a file in the staging directory under a new name
+
+        Parameters
+        ----------
+        src_f : Union[str, Path]
+            Path to the file to stage.
+        name : str
+            File name in the staging directory (e.g. "dst.tiff").
+
+        Returns
+        -------
+        Path
+            Path to the staged file.
+        """
+        src_f = Path(src_f).resolve()
+        staged_f = self.stage_dir / name
+        self._remove(staged_f)
+
+        methods = (
+            ["hardlink", "symlink", "copy"] if self.method == "auto" else [self.method]
+        )
+        for method in methods:
+            try:
+                if method == "hardlink":
+                    os.link(src_f, staged_f)
+                elif method == "symlink":
+                    os.symlink(src_f, staged_f)
+                else:
+                    self._copy(src_f, staged_f)
+            except OSError as e:
+                if method == methods[-1]:
+                    raise
+                logging.info(f"Staging by {method} failed for {src_f} ({e}).")
+                continue
+            logging.info(f"Staged by {method}: {src_f} -> {staged_f}")
+            self.staged.append(staged_f)
+            return staged_f
+
+    def _copy(self, src_f: Path, staged_f: Path):
+        """Copy to the scratch directory, verify and expose the copy"""
+        if self.scratch_dir is None:
+            copy_f = staged_f
+        else:
+            self.scratch_dir.mkdir(parents=True, exist_ok=True)
+            copy_f = self.scratch_dir / f"{os.getpid()}_{id(self)}_{staged_f.name}"
+        shutil.copyfile(src_f, copy_f)
+        if self.verify and hash_file(src_f) != hash_file(copy_f):
+            copy_f.unlink()
+            raise OSError(f"Checksum of the copy of {src_f} does not match")
+        if copy_f != staged_f:
+            self.staged.append(copy_f)
+            os.symlink(copy_f, staged_f)
+
+    @staticmethod
+    def _remove(f: Path):
+        if f.is_symlink() or f.exists():
+            f.unlink()
+
+    def cleanup(self):
+        """
+        Remove the staged files and scratch copies, leaving the sources intact
+        """
+        for f in self.staged:
+            self._remove(f)
+        self.staged = []
@@ -0,0 +1,813 @@
+import json
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+import pyvips
+from valis import slide_io, warp_tools
+
+from .histogram import ChannelHistograms, get_histogram_path, is_histogram_dtype
+from .ometiff import TiffWindowReader, write_pyramid_tiled
+
+# Version of the on-disk transform format, bump when the layout changes
+TRANSFORMS_VERSION = 1
+
+
+@dataclass
+class SlideTransform:
+    """
+    Registration transform of one slide, detached from the Valis registrar.
+
+    Only the reference crop is stored, which is the crop used by
+    `ValisAligner.AlignBase`.
+
+    Attributes
+    ----------
+    name : str
+        Name of the slide in the registrar (e.g. "dst" or "src").
+    M : np.ndarray
+        3x3 rigid transformation matrix in processed image coordinates.
+    bk_dxdy : np.ndarray or None
+        Backward non-rigid displacement field, shape (2, h, w).
+    processed_img_shape_rc : tuple[int, int]
+        Shape of the processed image used to find `M`.
+    reg_img_shape_rc : tuple[int, int]
+        Shape of the registered processed image.
+    slide_shape_rc : tuple[int, int]
+        Shape of the level 0 slide.
+    aligned_slide_shape_rc : tuple[int, int]
+        Shape of the level 0 aligned slide before cropping.
+    crop_xywh : tuple[int, int, int, int]
+        Bounding box of the reference crop in the aligned slide.
+    """
+
+    name: str
+    M: np.ndarray
+    bk_dxdy: Optional[np.ndarray]
+    processed_img_shape_rc: tuple[int, int]
+    reg_img_shape_rc: tuple[int, int]
+    slide_shape_rc: tuple[int, int]
+    aligned_slide_shape_rc: tuple[int, int]
+    crop_xywh: tuple[int, int, int, int]
+
+    @classmethod
+    def from_slide(cls, slide) -> "SlideTransform":
+        """
+        Extract the transform of a registered `valis.registration.Slide`
+        """
+        aligned_slide_shape_rc = slide.val_obj.get_aligned_slide_shape(0)
+        crop_xywh, _ = slide.get_crop_xywh(
+            crop="reference", out_shape_rc=aligned_slide_shape_rc
+        )
+        bk_dxdy = slide.bk_dxdy
+        return cls(
+            name=slide.name,
+            M=np.asarray(slide.M, dtype=np.float64),
+            bk_dxdy=None if bk_dxdy is None else np.asarray(bk_dxdy, np.float32),
+            processed_img_shape_rc=_to_shape(slide.processed_img_shape_rc),
+            reg_img_shape_rc=_to_shape(slide.reg_img_shape_rc),
+            slide_shape_rc=_to_shape(slide.slide_dimensions_wh[0][::-1]),
+            aligned_slide_shape_rc=_to_shape(aligned_slide_shape_rc),
+            crop_xywh=tuple(int(round(v)) for v in crop_xywh),
+        )
+
+    def _check_crop(self, crop):
+        if crop != "reference":
+            raise ValueError(f"Only the reference crop is stored, got: {crop}")
+
+    def warp_slide(
+        self, src_f: Union[str, Path], non_rigid: bool = True
+    ) -> pyvips.Image:
+        """
+        Warp a level 0 slide with the same shape as the registered slide
+        """
+        return warp_tools.warp_slide(
+            str(src_f),
+            transformation_src_shape_rc=self.processed_img_shape_rc,
+            transformation_dst_shape_rc=self.reg_img_shape_rc,
+            aligned_slide_shape_rc=self.aligned_slide_shape_rc,
+            M=self.M,
+            dxdy=self.bk_dxdy if non_rigid else None,
+            bbox_xywh=self.crop_xywh,
+        )
+
+    def warp_and_save_slide(
+        self,
+        src_f: Union[str, Path],
+        dst_f: Union[str, Path],
+        crop: str = "reference",
+        non_rigid: bool = True,
+    ):
+        """
+        Warp a slide and save it as OME-TIFF, mirroring
+        `valis.registration.Slide.warp_and_save_slide`
+        """
+        self._check_crop(crop)
+        warped = self.warp_slide(src_f, non_rigid=non_rigid)
+        slide_io.save_ome_tiff(warped, dst_f=str(dst_f))
+
+    def warp_img(
+        self,
+        img: Union[np.ndarray, pyvips.Image],
+        non_rigid: bool = True,
+        crop: str = "reference",
+    ) -> Union[np.ndarray, pyvips.Image]:
+        """
+        Warp an in-memory level 0 image, mirroring
+        `valis.registration.Slide.warp_img`
+        """
+        self._check_crop(crop)
+        img_shape_rc = tuple(warp_tools.get_shape(img)[0:2])
+        if img_shape_rc != self.slide_shape_rc:
+            raise ValueError(
+                f"Image shape {img_shape_rc} does not match the level 0 slide "
+                f"shape {self.slide_shape_rc}"
+            )
+        return warp_tools.warp_img(
+            img,
+            M=self.M,
+            bk_dxdy=self.bk_dxdy if non_rigid else None,
+            out_shape_rc=self.aligned_slide_shape_rc,
+            transformation_src_shape_rc=self.processed_img_shape_rc,
+            transformation_dst_shape_rc=self.reg_img_shape_rc,
+            bbox_xywh=self.crop_xywh,
+        )
+
+    def _scales(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Scales (x, y) from processed to level 0 source coordinates and from
+        registered to level 0 aligned coordinates
+        """
+        src_scale = np.array(self.slide_shape_rc[::-1]) / np.array(
+            self.processed_img_shape_rc[::-1]
+        )
+        out_scale = np.array(self.aligned_slide_shape_rc[::-1]) / np.array(
+            self.reg_img_shape_rc[::-1]
+        )
+        return src_scale, out_scale
+
+    def backward_map(
+        self, ys: np.ndarray, xs: np.ndarray, non_rigid: bool = True
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Map level 0 pixels of the cropped output to level 0 source pixels
+
+        Parameters
+        ----------
+        ys, xs : np.ndarray
+            Row and column coordinates in the cropped aligned slide.
+        non_rigid : bool, optional
+            Whether to apply the non-rigid displacement, by default True.
+
+        Returns
+        -------
+        tuple[np.ndarray, np.ndarray]
+            Row and column coordinates in the level 0 source slide.
+        """
+        src_scale, out_scale = self._scales()
+        xr = (xs + self.crop_xywh[0]) / out_scale[0]
+        yr = (ys + self.crop_xywh[1]) / out_scale[1]
+
+        if non_rigid and self.bk_dxdy is not None:
+            dxdy_h, dxdy_w = self.bk_dxdy.shape[1:]
+            fx = dxdy_w / self.reg_img_shape_rc[1]
+            fy = dxdy_h / self.reg_img_shape_rc[0]
+            dx = _bilinear(self.bk_dxdy[0], yr * fy, xr * fx) / fx
+            dy = _bilinear(self.bk_dxdy[1], yr * fy, xr * fx) / fy
+            xr, yr = xr + dx, yr + dy
+
+        M_inv = np.linalg.inv(self.M)
+        w = M_inv[2, 0] * xr + M_inv[2, 1] * yr + M_inv[2, 2]
+        xp = (M_inv[0, 0] * xr + M_inv[0, 1] * yr + M_inv[0, 2]) / w
+        yp = (M_inv[1, 0] * xr + M_inv[1, 1] * yr + M_inv[1, 2]) / w
+        return yp * src_scale[1], xp * src_scale[0]
+
+    def forward_map(self, xy: np.ndarray) -> np.ndarray:
+        """
+        Map level 0 source points (x, y) to the cropped output with the rigid
+        transform
+        """
+        src_scale, out_scale = self._scales()
+        xy = np.asarray(xy, dtype=np.float64) / src_scale
+        xyw = np.column_stack([xy, np.ones(len(xy))]) @ self.M.T
+        xy = xyw[:, :2] / xyw[:, 2:]
+        return xy * out_scale - np.array(self.crop_xywh[:2])
+
+    def is_identity(self, non_rigid: bool = True, atol: float = 0.5) -> bool:
+        """
+        Whether warping is an identity op on the level 0 slide, i.e. the output
+        has the slide's shape and no pixel moves by more than `atol` pixels
+
+        Parameters
+        ----------
+        non_rigid : bool, optional
+            Whether to include the non-rigid displacement, by default True.
+        atol : float, optional
+            Tolerance in level 0 pixels, by default 0.5.
+        """
+        h, w = self.slide_shape_rc
+        if (self.crop_xywh[3], self.crop_xywh[2]) != (h, w):
+            return False
+
+        ys = np.array([0, 0, h - 1, h - 1], dtype=np.float64)
+        xs = np.array([0, w - 1, 0, w - 1], dtype=np.float64)
+        src_ys, src_xs = self.backward_map(ys, xs, non_rigid=False)
+        if np.abs(src_ys - ys).max() > atol or np.abs(src_xs - xs).max() > atol:
+            return False
+
+        if non_rigid and self.bk_dxdy is not None:
+            _, out_scale = self._scales()
+            dxdy_scale = np.array(self.reg_img_shape_rc[::-1]) / np.array(
+                self.bk_dxdy.shape[:0:-1]
+            )
+            max_dx = np.abs(self.bk_dxdy[0]).max() * dxdy_scale[0] * out_scale[0]
+            max_dy = np.abs(self.bk_dxdy[1]).max() * dxdy_scale[1] * out_scale[1]
+            if max(max_dx, max_dy) > atol:
+                return False
+        return True
+
+    def warp_window(
+        self,
+        reader: TiffWindowReader,
+        y0: int,
+        y1: int,
+        x0: int,
+        x1: int,
+        step: int = 1,
+        non_rigid: bool = False,
+    ) -> np.ndarray:
+        """
+        Warp the output window [y0:y1, x0:x1], subsampled every `step` pixels,
+        with bilinear interpolation of the source read from `reader`
+
+        Only the source window covering the mapped output pixels is read.
+        Pixels mapped outside the source slide are set to 0.
+        """
+        ys = np.arange(y0, y1, step, dtype=np.float64)
+        xs = np.arange(x0, x1, step, dtype=np.float64)
+        grid_ys, grid_xs = np.meshgrid(ys, xs, indexing="ij")
+        src_ys, src_xs = self.backward_map(grid_ys, grid_xs, non_rigid=non_rigid)
+
+        h, w = self.slide_shape_rc
+        inside = (src_ys >= 0) & (src_ys <= h - 1) & (src_xs >= 0) & (src_xs <= w - 1)
+        tile = np.zeros(grid_ys.shape, dtype=reader.dtype)
+        if not inside.any():
+            return tile
+
+        src_ys, src_xs = src_ys[inside], src_xs[inside]
+        wy0, wx0 = int(src_ys.min()), int(src_xs.min())
+        wy1 = min(h, int(np.ceil(src_ys.max())) + step + 1)
+        wx1 = min(w, int(np.ceil(src_xs.max())) + step + 1)
+        window = reader.read(wy0, wy1, wx0, wx1, step).astype(np.float32)
+        values = _bilinear(window, (src_ys - wy0) / step, (src_xs - wx0) / step)
+
+        if np.issubdtype(tile.dtype, np.integer):
+            info = np.iinfo(tile.dtype)
+            values = np.clip(np.rint(values), info.min, info.max)
+        tile[inside] = values
+        return tile
+
+    def is_inside(
+        self, ys: np.ndarray, xs: np.ndarray, non_rigid: bool = True
+    ) -> np.ndarray:
+        """
+        Whether output pixels map inside the level 0 source slide
+        """
+        src_ys, src_xs = self.backward_map(ys, xs, non_rigid=non_rigid)
+        h, w = self.slide_shape_rc
+        return (src_ys >= 0) & (src_ys <= h - 1) & (src_xs >= 0) & (src_xs <= w - 1)
+
+
+def warp_ometiff(
+    transform: SlideTransform,
+    src_f: Union[str, Path],
+    dst_f: Union[str, Path],
+    non_rigid: bool = False,
+    channel_name: Optional[str] = None,
+    tile_size: int = 512,
+    n_workers: int = 4,
+    encoding: Optional[dict] = None,
+):
+    """
+    Warp a single-channel image tile by tile with NumPy and write it straight
+    into a pyramidal OME-TIFF, bypassing the Valis/pyvips pipeline
+
+    Meant for rigid mode, where the transform is a single matrix. Output
+    geometry matches `Slide.warp_and_save_slide` to within about one pixel;
+    intensities differ slightly as interpolation is bilinear rather than
+    bicubic, mostly at sharp edges. Use `compare_ometiff` to check a region
+    against the Valis output.
+
+    Parameters
+    ----------
+    transform : SlideTransform
+        Transform of the slide the image belongs to.
+    src_f : Union[str, Path]
+        Path to the level 0 single-channel image to warp.
+    dst_f : Union[str, Path]
+        Path to the output OME-TIFF file, or OME-Zarr store if it ends in
+        ".zarr".
+    non_rigid : bool, optional
+        Whether to apply the non-rigid displacement, by default False.
+    channel_name : str, optional
+        Channel name. If None, the input file name is used.
+    tile_size : int, optional
+        Tile size in pixels, by default 512.
+    n_workers : int, optional
+        Number of threads warping tiles, by default 4.
+    encoding : dict, optional
+        Compression keywords passed to `write_pyramid_tiled`. If None, the
+        defaults of the output format.
+    """
+    src_f = Path(src_f)
+    if channel_name is None:
+        channel_name = src_f.name.split(".")[0]
+    with TiffWindowReader(src_f) as reader:
+        if tuple(reader.shape) != tuple(transform.slide_shape_rc):
+            raise ValueError(
+                f"Image shape {reader.shape} does not match the level 0 slide "
+                f"shape {transform.slide_shape_rc}"
+            )
+        write_pyramid_tiled(
+            dst_f,
+            shape=(transform.crop_xywh[3], transform.crop_xywh[2]),
+            dtype=reader.dtype,
+            channel_names=[channel_name],
+            tile_fn=lambda c, y0, y1, x0, x1: transform.warp_window(
+                reader, y0, y1, x0, x1, non_rigid=non_rigid
+            ),
+            tile_size=tile_size,
+            n_workers=n_workers,
+            **(encoding or {}),
+        )
+
+
+def warp_multichannel_ometiff(
+    transforms: list[SlideTransform],
+    src_fl: list[Union[str, Path]],
+    dst_f: Union[str, Path],
+    channel_names: list[str],
+    non_rigid: bool = False,
+    mask: Optional["OverlapMask"] = None,
+    tile_size: int = 512,
+    n_workers: int = 4,
+    encoding: Optional[dict] = None,
+    histogram: bool = True,
+):
+    """
+    Warp single-channel images tile by tile and stream them straight into one
+    multichannel pyramidal OME-TIFF, optionally masked
+
+    Every output pixel is computed and written once, without per-channel
+    intermediate files. Resampling is the same as `warp_ometiff`.
+
+    Parameters
+    ----------
+    transforms : list[SlideTransform]
+        Transform of the slide each image belongs to, in channel order. All
+        transforms must share the reference crop.
+    src_fl : list[Union[str, Path]]
+        Paths to the level 0 single-channel images to warp, in channel order.
+    dst_f : Union[str, Path]
+        Path to the output OME-TIFF file, or OME-Zarr store if it ends in
+        ".zarr".
+    channel_names : list[str]
+        List of channel names, in the same order as `src_fl`.
+    non_rigid : bool, optional
+        Whether to apply the non-rigid displacement, by default False.
+    mask : OverlapMask, optional
+        Overlap mask multiplied with every channel. If None, the channels are
+        written unmasked.
+    tile_size : int, optional
+        Tile size in pixels, by default 512.
+    n_workers : int, optional
+        Number of threads warping tiles, by default 4.
+    encoding : dict, optional
+        Compression keywords passed to `write_pyramid_tiled`. If None, the
+        defaults of the output format.
+    histogram : bool, optional
+        Whether to save the intensity histogram of every uint8 or uint16
+        channel next to the output, counted from the warped level 0 tiles, by
+        default True. See `ChannelHistograms`.
+    """
+    if not len(transforms) == len(src_fl) == len(channel_names):
+        raise ValueError("Number of transforms, images and channel names differ")
+    crops = {tuple(transform.crop_xywh) for transform in transforms}
+    if len(crops) != 1:
+        raise ValueError(f"Transforms have different crops: {crops}")
+    _, _, width, height = crops.pop()
+    if mask is not None and tuple(mask.shape) != (height, width):
+        raise ValueError(f"Mask shape {mask.shape} does not match {(height, width)}")
+
+    readers = [TiffWindowReader(src_f) for src_f in src_fl]
+    try:
+        for transform, reader in zip(transforms, readers):
+            if tuple(reader.shape) != tuple(transform.slide_shape_rc):
+                raise ValueError(
+                    f"Image shape {reader.shape} of {reader.path} does not match "
+                    f"the level 0 slide shape {transform.slide_shape_rc}"
+                )
+        dtypes = {reader.dtype for reader in readers}
+        if len(dtypes) != 1:
+            raise ValueError(f"Images have different dtypes: {dtypes}")
+
+        def tile_fn(c, y0, y1, x0, x1):
+            tile = transforms[c].warp_window(
+                readers[c], y0, y1, x0, x1, non_rigid=non_rigid
+            )
+            if mask is not None:
+                mask_tile = mask.read(y0, y1, x0, x1)
+                np.multiply(tile, mask_tile, out=tile, casting="unsafe")
+            return tile
+
+        dtype = dtypes.pop()
+        histograms = None
+        if histogram and is_histogram_dtype(dtype):
+            histograms = ChannelHistograms(channel_names)
+            tile_fn = histograms.wrap(tile_fn)
+        write_pyramid_tiled(
+            dst_f,
+            shape=(height, width),
+            dtype=dtype,
+            channel_names=channel_names,
+            tile_fn=tile_fn,
+            tile_size=tile_size,
+            n_workers=n_workers,
+            **(encoding or {}),
+        )
+        if histograms is not None:
+            histograms.save(get_histogram_path(dst_f))
+    finally:
+        for reader in readers:
+            reader.close()
+
+
+class RegistrationTransforms:
+    """
+    Compact stand-in for `valis.registration.Valis` holding only what is
+    needed to apply a registration: the slide transforms and overlap images.
+    """
+
+    _overlap_names = [
+        "original_overlap_img",
+        "rigid_overlap_img",
+        "non_rigid_overlap_img",
+    ]
+    _shape_fields = [
+        "processed_img_shape_rc",
+        "reg_img_shape_rc",
+        "slide_shape_rc",
+        "aligned_slide_shape_rc",
+        "crop_xywh",
+    ]
+
+    def __init__(
+        self,
+        slides: dict[str, SlideTransform],
+        overlap_imgs: Optional[dict[str, np.ndarray]] = None,
+        metadata: Optional[dict] = None,
+    ):
+        """
+        Initialize RegistrationTransforms
+
+        Parameters
+        ----------
+        slides : dict[str, SlideTransform]
+            Slide transforms keyed by slide name.
+        overlap_imgs : dict[str, np.ndarray], optional
+            Overlap images keyed by registrar attribute name.
+        metadata : dict, optional
+            JSON serializable metadata stored alongside the transforms.
+        """
+        self.slides = slides
+        self.metadata = metadata or {}
+        overlap_imgs = overlap_imgs or {}
+        for overlap_name in self._overlap_names:
+            setattr(self, overlap_name, overlap_imgs.get(overlap_name))
+
+    @classmethod
+    def from_registrar(
+        cls,
+        registrar,
+        names: tuple[str] = ("dst", "src"),
+        metadata: Optional[dict] = None,
+    ) -> "RegistrationTransforms":
+        """
+        Extract the transforms of registered slides from a Valis registrar
+        """
+        slides = {
+            name: SlideTransform.from_slide(registrar.get_slide(f"{name}.tiff"))
+            for name in names
+        }
+        overlap_imgs = {
+            overlap_name: getattr(registrar, overlap_name, None)
+            for overlap_name in cls._overlap_names
+        }
+        return cls(slides, overlap_imgs, metadata)
+
+    def get_slide(self, name: str) -> SlideTransform:
+        """
+        Get the transform of a slide by name or file name (e.g. "dst.tiff")
+        """
+        return self.slides[Path(name).stem]
+
+    def get_rigid_init(self, slide_fs: dict[str, Union[str, Path]]) -> dict:
+        """
+        Rigid transforms in the form of the `do_rigid` dictionary of
+        `registration.Valis`, to initialize a registration of the same slides
+
+        Valis expects the inverse matrices, mapping the registered image to
+        the processed image, along with the shapes they were found on. As
+        Valis rescales them to its own processed images, transforms found on
+        thumbnails initialize a full resolution registration.
+
+        Parameters
+        ----------
+        slide_fs : dict[str, Union[str, Path]]
+            Image file passed to Valis for each slide name to initialize (e.g.
+            {"src": ".../src.tiff"}).
+
+        Returns
+        -------
+        dict
+            Dictionary to pass as `do_rigid`.
+        """
+        do_rigid = {}
+        for name, slide_f in slide_fs.items():
+            slide = self.get_slide(name)
+            do_rigid[str(slide_f)] = {
+                "M": np.linalg.inv(slide.M),
+                "transformation_src_shape_rc": slide.processed_img_shape_rc,
+                "transformation_dst_shape_rc": slide.reg_img_shape_rc,
+            }
+        return do_rigid
+
+    def save(self, path: Union[str, Path]):
+        """
+        Save the transforms to a compressed NPZ file
+        """
+        arrays = {
+            "version": np.array(TRANSFORMS_VERSION),
+            "names": np.array(list(self.slides)),
+            "metadata": np.array(json.dumps(self.metadata)),
+        }
+        for name, slide in self.slides.items():
+            arrays[f"{name}__M"] = slide.M
+            if slide.bk_dxdy is not None:
+                arrays[f"{name}__bk_dxdy"] = slide.bk_dxdy
+            for field in self._shape_fields:
+                arrays[f"{name}__{field}"] = np.array(getattr(slide, field))
+        for overlap_name in self._overlap_names:
+            img = getattr(self, overlap_name)
+            if img is not None:
+                arrays[overlap_name] = np.asarray(img)
+        np.savez_compressed(path, **arrays)
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "RegistrationTransforms":
+        """
+        Load transforms saved with `RegistrationTransforms.save`
+        """
+        with np.load(path, allow_pickle=False) as npz:
+            version = int(npz["version"])
+            if version != TRANSFORMS_VERSION:
+                raise ValueError(
+                    f"Unsupported transforms version {version} in {path}, "
+                    f"expected {TRANSFORMS_VERSION}"
+                )
+            slides = {}
+            for name in npz["names"].tolist():
+                bk_dxdy_key = f"{name}__bk_dxdy"
+                slides[name] = SlideTransform(
+                    name=name,
+                    M=npz[f"{name}__M"],
+                    bk_dxdy=npz[bk_dxdy_key] if bk_dxdy_key in npz else None,
+                    **{
+                        field: tuple(int(v) for v in npz[f"{name}__{field}"])
+                        for field in cls._shape_fields
+                    },
+                )
+            overlap_imgs = {
+                overlap_name: npz[overlap_name]
+                for overlap_name in cls._overlap_names
+                if overlap_name in npz
+            }
+            metadata = json.loads(str(npz["metadata"]))
+        return cls(slides, overlap_imgs, metadata)
+
+
+def _to_shape(shape) -> tuple[int, ...]:
+    """Convert an array-like shape to a tuple of Python ints"""
+    return tuple(int(round(v)) for v in shape)
+
+
+class OverlapMask:
+    """
+    Overlap mask of the warped source slide, computed from its transform
+    instead of warping a full resolution image of ones.
+
+    Rigid masks are stored as the quadrilateral of the warped source bounds.
+    Non-rigid masks are stored as a bit-packed coarse grid of inside/outside
+    nodes; cells whose corners disagree are refined with the exact backward
+    mapping when a window is read. Windows are expanded lazily, so the full
+    resolution mask is never held in memory.
+    """
+
+    dtype = np.dtype(np.uint16)
+
+    def __init__(
+        self,
+        transform: SlideTransform,
+        non_rigid: bool,
+        polygon: Optional[np.ndarray] = None,
+        nodes_y: Optional[np.ndarray] = None,
+        nodes_x: Optional[np.ndarray] = None,
+        nodes_inside: Optional[np.ndarray] = None,
+    ):
+        """
+        Initialize OverlapMask, use `OverlapMask.from_transform` to compute it.
+
+        Parameters
+        ----------
+        transform : SlideTransform
+            Transform of the source slide.
+        non_rigid : bool
+            Whether the mask follows the non-rigid transform.
+        polygon : np.ndarray, optional
+            Vertices (x, y) of the warped source bounds, for rigid masks.
+        nodes_y, nodes_x : np.ndarray, optional
+            Coordinates of the coarse grid nodes, for non-rigid masks.
+        nodes_inside : np.ndarray, optional
+            Boolean grid of nodes mapped inside the source slide.
+        """
+        self.transform = transform
+        self.non_rigid = non_rigid
+        self.polygon = polygon
+        self.nodes_y = nodes_y
+        self.nodes_x = nodes_x
+        self.nodes_inside = nodes_inside
+        self.shape = (transform.crop_xywh[3], transform.crop_xywh[2])
+
+    @classmethod
+    def from_transform(
+        cls, transform: SlideTransform, non_rigid: bool, cell_size: int = 64
+    ) -> "OverlapMask":
+        """
+        Compute the overlap mask of a slide transform
+
+        Parameters
+        ----------
+        transform : SlideTransform
+            Transform of the source slide.
+        non_rigid : bool
+            Whether the mask follows the non-rigid transform.
+        cell_size : int, optional
+            Spacing in pixels of the coarse grid for non-rigid masks, by
+            default 64.
+        """
+        if not non_rigid or transform.bk_dxdy is None:
+            h, w = transform.slide_shape_rc
+            corners = np.array([[0, 0], [w - 1, 0], [w - 1, h - 1], [0, h - 1]])
+            return cls(transform, non_rigid, polygon=transform.forward_map(corners))
+
+        height, width = transform.crop_xywh[3], transform.crop_xywh[2]
+        nodes_y = _grid_nodes(height, cell_size)
+        nodes_x = _grid_nodes(width, cell_size)
+        ys, xs = np.meshgrid(nodes_y, nodes_x, indexing="ij")
+        nodes_inside = transform.is_inside(ys, xs, non_rigid=True)
+        return cls(
+            transform,
+            non_rigid,
+            nodes_y=nodes_y,
+            nodes_x=nodes_x,
+            nodes_inside=nodes_inside,
+        )
+
+    def read(self, y0: int, y1: int, x0: int, x1: int, step: int = 1) -> np.ndarray:
+        """
+        Expand the window [y0:y1, x0:x1] of the mask, subsampled every `step`
+        pixels, as a uint16 array of zeros and ones
+        """
+        ys = np.arange(y0, y1, step)
+        xs = np.arange(x0, x1, step)
+        if self.polygon is not None:
+            inside = _inside_convex_polygon(self.polygon, ys[:, None], xs[None, :])
+            return inside.astype(self.dtype)
+
+        # Cell status: 1 if all corners inside, 0 if none, 2 to refine
+        iy = np.clip(np.searchsorted(self.nodes_y, ys, "right") - 1, 0, None)
+        ix = np.clip(np.searchsorted(self.nodes_x, xs, "right") - 1, 0, None)
+        iy = np.minimum(iy, len(self.nodes_y) - 2)
+        ix = np.minimum(ix, len(self.nodes_x) - 2)
+        status = self._get_cell_status()[iy[:, None], ix[None, :]]
+        inside = status == 1
+
+        border = status == 2
+        if border.any():
+            by, bx = np.nonzero(border)
+            inside[by, bx] = self.transform.is_inside(ys[by], xs[bx], non_rigid=True)
+        return inside.astype(self.dtype)
+
+    def _get_cell_status(self) -> np.ndarray:
+        """
+        Status of every grid cell: 0 outside, 1 inside, 2 to refine. Cells
+        with disagreeing corners and their neighbours are refined.
+        """
+        if getattr(self, "_cell_status", None) is None:
+            n = self.nodes_inside.astype(np.uint8)
+            corners = n[:-1, :-1] + n[1:, :-1] + n[:-1, 1:] + n[1:, 1:]
+            border = (corners > 0) & (corners < 4)
+            padded = np.pad(border, 1)
+            dilated = np.zeros_like(border)
+            for dy in range(3):
+                for dx in range(3):
+                    dilated |= padded[
+                        dy : dy + border.shape[0], dx : dx + border.shape[1]
+                    ]
+            status = (corners == 4).astype(np.uint8)
+            status[dilated] = 2
+            self._cell_status = status
+        return self._cell_status
+
+    def __array__(self, dtype=None, copy=None):
+        mask = self.read(0, self.shape[0], 0, self.shape[1])
+        return mask if dtype is None else mask.astype(dtype)
+
+    def save(self, path: Union[str, Path]):
+        """
+        Save the compact mask to an NPZ file
+        """
+        arrays = {
+            "version": np.array(TRANSFORMS_VERSION),
+            "non_rigid": np.array(self.non_rigid),
+        }
+        if self.polygon is not None:
+            arrays["polygon"] = self.polygon
+        else:
+            arrays["nodes_y"] = self.nodes_y
+            arrays["nodes_x"] = self.nodes_x
+            arrays["nodes_shape"] = np.array(self.nodes_inside.shape)
+            arrays["nodes_inside"] = np.packbits(self.nodes_inside)
+        np.savez_compressed(path, **arrays)
+
+    @classmethod
+    def load(cls, path: Union[str, Path], transform: SlideTransform) -> "OverlapMask":
+        """
+        Load a mask saved with `OverlapMask.save` for the given transform
+        """
+        with np.load(path, allow_pickle=False) as npz:
+            non_rigid = bool(npz["non_rigid"])
+            if "polygon" in npz:
+                return cls(transform, non_rigid, polygon=npz["polygon"])
+            nodes_shape = tuple(npz["nodes_shape"])
+            nodes_inside = np.unpackbits(npz["nodes_inside"])[: np.prod(nodes_shape)]
+            return cls(
+                transform,
+                non_rigid,
+                nodes_y=npz["nodes_y"],
+                nodes_x=npz["nodes_x"],
+                nodes_inside=nodes_inside.reshape(nodes_shape).astype(bool),
+            )
+
+
+def _grid_nodes(length: int, cell_size: int) -> np.ndarray:
+    """Grid node coordinates every `cell_size` pixels, including the last pixel"""
+    nodes = np.arange(0, length, cell_size)
+    if nodes[-1] != length - 1:
+        nodes = np.append(nodes, length - 1)
+    if len(nodes) == 1:
+        nodes = np.append(nodes, nodes)
+    return nodes
+
+
+def _bilinear(img: np.ndarray, ys: np.ndarray, xs: np.ndarray) -> np.ndarray:
+    """Bilinear interpolation of a 2D array at float coordinates, clamped"""
+    h, w = img.shape
+    ys = np.clip(ys, 0, h - 1)
+    xs = np.clip(xs, 0, w - 1)
+    y0 = np.minimum(np.floor(ys).astype(np.intp), h - 2 if h > 1 else 0)
+    x0 = np.minimum(np.floor(xs).astype(np.intp), w - 2 if w > 1 else 0)
+    y1 = np.minimum(y0 + 1, h - 1)
+    x1 = np.minimum(x0 + 1, w - 1)
+    wy = ys - y0
+    wx = xs - x0
+    top = img[y0, x0] * (1 - wx) + img[y0, x1] * wx
+    bottom = img[y1, x0] * (1 - wx) + img[y1, x1] * wx
+    return top * (1 - wy) + bottom * wy
+
+
+def _inside_convex_polygon(
+    polygon: np.ndarray, ys: np.ndarray, xs: np.ndarray
+) -> np.ndarray:
+    """Whether points lie inside (or on) a convex polygon of (x, y) vertices"""
+    area = np.sum(
+        polygon[:, 0] * np.roll(polygon[:, 1], -1)
+        - np.roll(polygon[:, 0], -1) * polygon[:, 1]
+    )
+    sign = 1 if area >= 0 else -1
+    inside = True
+    for (ax, ay), (bx, by) in zip(polygon, np.roll(polygon, -1, axis=0)):
+        cross = (bx - ax) * (ys - ay) - (by - ay) * (xs - ax)
+        inside = inside & (sign * cross >= -1e-6)
+    return inside
@@ -2,18 +2,38 @@
 import logging
 import os
 import pickle as pkl
-import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
 from pathlib import Path
-from typing import Union
+from typing import Optional, Union
 
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
+import pyvips
 import tifffile
 from matplotlib.patches import Patch
 from pyqupath.ometiff import export_ometiff_pyramid_from_dict
 from tqdm import tqdm
-from valis import registration
+from valis import registration, slide_io
+
+from .cache import RegistrationCache
+from .manifest import RegistrationManifest
+from .ometiff import (
+    export_masked_ometiff,
+    is_ngff,
+    read_thumbnail,
+    rewrite_ometiff,
+)
+from .profiling import StageProfiler
+from .staging import InputStager
+from .transform import (
+    OverlapMask,
+    RegistrationTransforms,
+    SlideTransform,
+    warp_multichannel_ometiff,
+    warp_ometiff,
+)
 
 TQDM_FORMAT = "{desc}: {percentage:3.0f}%|{bar:10}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}]"
 
@@ -93,6 +113,13 @@ class ValisAligner:
         src_register_f: Union[str, Path],
         output_dir: Union[str, Path],
         tqdm_format: str = "{desc}: {percentage:3.0f}%|{bar:30}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}]",
+        kill_jvm: bool = True,
+        valis_kwargs: Optional[dict] = None,
+        cache: Optional[RegistrationCache] = None,
+        init_transforms: Optional[RegistrationTransforms] = None,
+        staging: str = "auto",
+        scratch_dir: Optional[Union[str, Path]] = None,
+        cleanup_inputs: bool = False,
     ):
         """
         Initialize ValisAligner
@@ -108,38 +135,252 @@ class ValisAligner:
             Path to the output directory.
         tqdm_format : str, optional
             Format for tqdm progress bar.
+        kill_jvm : bool, optional
+            Whether to kill the JVM after registration, by default True. The
+            JVM can not be restarted in the same process, so keep it alive to
+            register several pairs in one process (see `register_batch`).
+        valis_kwargs : dict, optional
+            Extra keyword arguments passed to `registration.Valis`.
+        cache : RegistrationCache, optional
+            Cache of registration results. If the same pair was registered
+            with the same settings before, the cached transforms are reused and
+            registration is skipped.
+        init_transforms : RegistrationTransforms, optional
+            Transforms of a previous registration of the same pair, typically
+            a preview (see `ValisAligner.preview`), used as the initial rigid
+            transform of the source image.
+        staging : str, optional
+            How the registration images are exposed to Valis as "dst.tiff"
+            and "src.tiff", by default "auto" (hardlink, then symlink, then
+            copy). See `InputStager`.
+        scratch_dir : Union[str, Path], optional
+            Local directory for copies of the registration images, when they
+            can not be linked.
+        cleanup_inputs : bool, optional
+            Whether to remove the staged registration images after
+            registration, by default False.
         """
         self.dst_register_f = Path(dst_register_f)
         self.src_register_f = Path(src_register_f)
         self.output_dir = Path(output_dir)
         self.tqdm_format = tqdm_format
+        self._profiler = StageProfiler()
 
         # Register the source image to the destination image
         ## Initialize directories
         self.valis_dir = self.output_dir / "valis"
         self._setup_directories()
+        if init_transforms is not None:
+            valis_kwargs = {
+                **(valis_kwargs or {}),
+                "do_rigid": init_transforms.get_rigid_init(
+                    {"src": self.valis_dir / "input" / "src.tiff"}
+                ),
+            }
+
+        ## Look up cached registration
+        cached = None
+        if cache is not None:
+            cache_key = cache.get_key(
+                self.dst_register_f, self.src_register_f, valis_kwargs
+            )
+            cached = cache.get(cache_key)
+
+        if cached is not None:
+            self.transforms, self.error_df = cached
+            self.registrar = self.transforms
+        else:
+            ## Stage input files
+            stager = InputStager(
+                self.valis_dir / "input", method=staging, scratch_dir=scratch_dir
+            )
+            stager.stage(self.dst_register_f, "dst.tiff")
+            stager.stage(self.src_register_f, "src.tiff")
+
+            ## Initialize registrar
+            self.registrar = registration.Valis(
+                src_dir=str(self.valis_dir / "input"),
+                dst_dir=str(self.valis_dir / "output"),
+                reference_img_f=str(self.valis_dir / "input" / "dst.tiff"),
+                align_to_reference=True,
+                **(valis_kwargs or {}),
+            )
+            with self.profiler.stage("register", input_f=self.src_register_f):
+                _, _, self.error_df = self.registrar.register()
+            if cleanup_inputs:
+                stager.cleanup()
+            if kill_jvm:
+                registration.kill_jvm()
+            self.transforms = RegistrationTransforms.from_registrar(self.registrar)
+            if cache is not None:
+                cache.put(cache_key, self.transforms, self.error_df)
+        self.transforms.metadata = {
+            "dst_register_f": str(self.dst_register_f),
+            "src_register_f": str(self.src_register_f),
+        }
+
+        ## Initialize aligners
+        self.rigid = self.AlignBase(self, non_rigid=False)
+        self.non_rigid = self.AlignBase(self, non_rigid=True)
 
-        ## Copy input files
-        shutil.copy(self.dst_register_f, self.valis_dir / "input" / "dst.tiff")
-        shutil.copy(self.src_register_f, self.valis_dir / "input" / "src.tiff")
+        # Save the transforms
+        self.save_transforms()
+
+    @classmethod
+    def preview(
+        cls,
+        dst_register_f: Union[str, Path],
+        src_register_f: Union[str, Path],
+        output_dir: Union[str, Path],
+        max_dim_px: int = 1024,
+        tqdm_format: str = "{desc}: {percentage:3.0f}%|{bar:30}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}]",
+        kill_jvm: bool = False,
+        valis_kwargs: Optional[dict] = None,
+    ) -> "ValisAligner":
+        """
+        Register downsampled thumbnails of a pair to preview the registration
+
+        The overlap plot and error table are available in seconds, which helps
+        to spot bad pairs before running the full registration. Errors are in
+        thumbnail pixels. The preview transforms can initialize the full
+        registration through `init_transforms`.
+
+        Parameters
+        ----------
+        dst_register_f : Union[str, Path]
+            Path to the destination image file for registration.
+        src_register_f : Union[str, Path]
+            Path to the source image file for registration.
+        output_dir : Union[str, Path]
+            Path to the output directory of the preview.
+        max_dim_px : int, optional
+            Maximum size of the largest dimension of the thumbnails, by default
+            1024.
+        tqdm_format : str, optional
+            Format for tqdm progress bar.
+        kill_jvm : bool, optional
+            Whether to kill the JVM after registration, by default False so
+            that the full registration can run in the same process.
+        valis_kwargs : dict, optional
+            Extra keyword arguments passed to `registration.Valis`, overriding
+            the processed image sizes set from `max_dim_px`.
 
-        ## Initialize registrar
-        self.registrar = registration.Valis(
-            src_dir=str(self.valis_dir / "input"),
-            dst_dir=str(self.valis_dir / "output"),
-            reference_img_f=str(self.valis_dir / "input" / "dst.tiff"),
-            align_to_reference=True,
+        Returns
+        -------
+        ValisAligner
+            Aligner of the thumbnails.
+        """
+        output_dir = Path(output_dir)
+        thumbnail_dir = output_dir / "thumbnail"
+        thumbnail_dir.mkdir(parents=True, exist_ok=True)
+        thumbnail_fs = {}
+        for name, register_f in [("dst", dst_register_f), ("src", src_register_f)]:
+            thumbnail_f = thumbnail_dir / f"{name}.tiff"
+            if not thumbnail_f.exists():
+                tifffile.imwrite(thumbnail_f, read_thumbnail(register_f, max_dim_px))
+            thumbnail_fs[name] = thumbnail_f
+
+        valis_kwargs = {
+            "max_image_dim_px": max_dim_px,
+            "max_processed_image_dim_px": max_dim_px,
+            "max_non_rigid_registration_dim_px": max_dim_px,
+            **(valis_kwargs or {}),
+        }
+        return cls(
+            dst_register_f=thumbnail_fs["dst"],
+            src_register_f=thumbnail_fs["src"],
+            output_dir=output_dir,
+            tqdm_format=tqdm_format,
+            kill_jvm=kill_jvm,
+            valis_kwargs=valis_kwargs,
         )
-        _, _, self.error_df = self.registrar.register()
-        registration.kill_jvm()
 
-        ## Initialize aligners
+    @classmethod
+    def load(
+        cls,
+        output_dir: Union[str, Path],
+        tqdm_format: str = "{desc}: {percentage:3.0f}%|{bar:30}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}]",
+    ) -> "ValisAligner":
+        """
+        Load a registered ValisAligner from its saved transforms
+
+        The registrar is replaced by a `RegistrationTransforms` holding only the
+        slide transforms and overlap images, which is enough to apply the
+        registration and plot the overlap. Output directories registered before
+        the transforms were introduced fall back to the pickled instance.
+
+        Parameters
+        ----------
+        output_dir : Union[str, Path]
+            Path to the output directory used for registration.
+        tqdm_format : str, optional
+            Format for tqdm progress bar.
+
+        Returns
+        -------
+        ValisAligner
+            Aligner ready to apply the registration.
+        """
+        output_dir = Path(output_dir)
+        inter_dir = output_dir / "valis" / "intermediate"
+        transforms_f = inter_dir / "transforms.npz"
+        if not transforms_f.exists():
+            with open(inter_dir / "valis_aligner.pkl", "rb") as f:
+                return pkl.load(f)
+
+        self = cls.__new__(cls)
+        self.registrar = RegistrationTransforms.load(transforms_f)
+        self.transforms = self.registrar
+        self.dst_register_f = Path(self.registrar.metadata["dst_register_f"])
+        self.src_register_f = Path(self.registrar.metadata["src_register_f"])
+        self.output_dir = output_dir
+        self.tqdm_format = tqdm_format
+        self._profiler = StageProfiler()
+        self.valis_dir = self.output_dir / "valis"
+        self.error_df = pd.read_csv(inter_dir / "error_df.csv")
+
         self.rigid = self.AlignBase(self, non_rigid=False)
         self.non_rigid = self.AlignBase(self, non_rigid=True)
+        return self
+
+    def save_transforms(self):
+        """
+        Save the slide transforms and error table to the intermediate directory
+        """
+        inter_dir = self.valis_dir / "intermediate"
+        self.transforms.save(inter_dir / "transforms.npz")
+        self.error_df.to_csv(inter_dir / "error_df.csv", index=False)
 
-        # Save the instance
-        with open(self.valis_dir / "intermediate" / "valis_aligner.pkl", "wb") as f:
-            pkl.dump(self, f)
+    @property
+    def profiler(self) -> StageProfiler:
+        """
+        Stage profiler of the aligner, created on first use for aligners
+        pickled before profiling was added
+        """
+        if getattr(self, "_profiler", None) is None:
+            self._profiler = StageProfiler()
+        return self._profiler
+
+    def write_profile(self, output_f: Union[str, Path]):
+        """
+        Write the stage profile (wall time, CPU time, peak RSS, I/O and output
+        size of every stage run so far) to CSV and JSON files
+
+        Parameters
+        ----------
+        output_f : Union[str, Path]
+            Path to the output file, written with both .csv and .json suffixes.
+        """
+        self.profiler.write(output_f)
+
+    def get_transform(self, name: str) -> SlideTransform:
+        """
+        Get the transform of a registered slide ("dst" or "src")
+        """
+        if getattr(self, "transforms", None) is None:
+            # Instances pickled before the transforms were introduced
+            self.transforms = RegistrationTransforms.from_registrar(self.registrar)
+        return self.transforms.get_slide(name)
 
     def _setup_directories(self):
         """Create required directories"""
@@ -149,6 +390,108 @@ class ValisAligner:
         for d in [valis_dir_input, valis_dir_output, valis_dir_inter]:
             d.mkdir(parents=True, exist_ok=True)
 
+    def apply_all(
+        self,
+        dst_apply_fl: list[Union[str, Path]],
+        src_apply_fl: list[Union[str, Path]],
+        n_workers: int = 1,
+    ):
+        """
+        Apply the rigid and non-rigid registration in a single pass
+
+        Each input image is decoded once and both the rigid and non-rigid
+        outputs are warped from the same in-memory buffer. The overlap mask of
+        each mode is computed analytically from the source transform with
+        `OverlapMask.from_transform`, without warping any image.
+
+        Parameters
+        ----------
+        dst_apply_fl : list[Union[str, Path]]
+            Path to the destination image files for applying registration.
+        src_apply_fl : list[Union[str, Path]]
+            Path to the source image files for applying registration.
+        n_workers : int, optional
+            Number of images processed concurrently, by default 1. Each worker
+            holds one decoded image, so peak memory grows linearly with the
+            number of workers.
+        """
+        aligners = [self.rigid, self.non_rigid]
+        jobs = [("dst", Path(f)) for f in dst_apply_fl] + [
+            ("src", Path(f)) for f in src_apply_fl
+        ]
+
+        with tqdm(
+            total=len(jobs),
+            desc="Aligning images (rigid, non_rigid)",
+            bar_format=self.tqdm_format,
+        ) as total_pbar, ThreadPoolExecutor(max_workers=n_workers) as executor:
+            futures = [
+                executor.submit(self._apply_all_image, prefix, f, aligners)
+                for prefix, f in jobs
+            ]
+            # Record every file in the manifest as soon as its warp ends
+            for future in as_completed(futures):
+                for aligner, registered_f in future.result():
+                    aligner._record(registered_f)
+                total_pbar.update(1)
+
+        # Keep the registered files in input order
+        for aligner in aligners:
+            aligner._set_registered_fl(
+                [aligner._get_registered_f(prefix, f) for prefix, f in jobs]
+            )
+
+        # Create overlap masks
+        for aligner in aligners:
+            aligner._create_overlap_mask()
+
+    def _apply_all_image(
+        self, prefix: str, f: Path, aligners: list
+    ) -> list[tuple["ValisAligner.AlignBase", Path]]:
+        """
+        Decode one image and warp it for every aligner missing its output
+
+        Returns
+        -------
+        list[tuple[ValisAligner.AlignBase, Path]]
+            Aligner and registered file of every output of the image, existing
+            or written, recorded by the caller.
+        """
+        registered = [
+            (aligner, aligner._get_registered_f(prefix, f)) for aligner in aligners
+        ]
+        outputs = []
+        for aligner, registered_f in registered:
+            if registered_f.exists():
+                print(f"File exists and skip: {registered_f}")
+            else:
+                outputs.append((aligner, registered_f))
+        if len(outputs) == 0:
+            return registered
+
+        # Identity transforms are rewritten without resampling
+        warp_outputs = []
+        for aligner, registered_f in outputs:
+            if aligner._is_identity(prefix):
+                with self.profiler.stage(
+                    f"warp_{aligner.mode}", output_f=registered_f, input_f=f
+                ):
+                    rewrite_ometiff(f, registered_f)
+            else:
+                warp_outputs.append((aligner, registered_f))
+        if len(warp_outputs) == 0:
+            return registered
+
+        slide = self.registrar.get_slide(f"{prefix}.tiff")
+        with self.profiler.stage("decode", input_f=f):
+            img = pyvips.Image.new_from_file(str(f)).copy_memory()
+        for aligner, registered_f in warp_outputs:
+            with self.profiler.stage(
+                f"warp_{aligner.mode}", output_f=registered_f, input_f=f
+            ):
+                aligner._warp_and_save_img(slide, img, registered_f)
+        return registered
+
     # TODO: wrap into valis initialization
     def plot_overlap(
         self,
@@ -223,7 +566,10 @@ class ValisAligner:
             self.output_dir = parent.output_dir / f"registered_{self.mode}"
             self._setup_directories()
 
-            self.registered_fl = []
+            self._manifest = RegistrationManifest(
+                self.output_dir / "manifest.csv", self.mode
+            )
+            self.registered_fl = self._manifest.get_files()
 
         def _setup_directories(self):
             """Create required directories"""
@@ -236,6 +582,8 @@ class ValisAligner:
             self,
             dst_apply_fl: list[Union[str, Path]],
             src_apply_fl: list[Union[str, Path]],
+            n_workers: int = 1,
+            engine: str = "valis",
         ):
             """
             Apply the registration to the source and destination images
@@ -246,7 +594,22 @@ class ValisAligner:
                 Path to the destination image files for applying registration0
             src_apply_fl : list[Union[str, Path]]
                 Path to the source image files for applying registration.
+            n_workers : int, optional
+                Number of images warped concurrently, by default 1. Each worker
+                holds one slide being warped, so peak memory grows linearly
+                with the number of workers.
+            engine : str, optional
+                Warp engine, by default "valis".
+                - "valis": `Slide.warp_and_save_slide` through pyvips.
+                - "native": tile-by-tile NumPy resampling written straight to
+                  the pyramidal OME-TIFF (see `warp_ometiff`). Rigid mode
+                  only, where it is much faster and matches the Valis output
+                  within the tolerance documented in `warp_ometiff`.
             """
+            if engine not in ["valis", "native"]:
+                raise ValueError(f"Unknown engine: {engine}")
+            if engine == "native" and self.non_rigid:
+                raise ValueError("The native engine is only supported in rigid mode")
             dst_apply_fl = [Path(f) for f in dst_apply_fl]
             src_apply_fl = [Path(f) for f in src_apply_fl]
 
@@ -254,69 +617,172 @@ class ValisAligner:
                 total=len(dst_apply_fl) + len(src_apply_fl),
                 desc=f"Aligning images ({self.mode})",
                 bar_format=self.parent.tqdm_format,
-            ) as total_pbar:
+            ) as total_pbar, ThreadPoolExecutor(max_workers=n_workers) as executor:
                 # Align destination images
-                self._process_images(
+                dst_jobs = self._process_images(
                     slide=self.parent.registrar.get_slide("dst.tiff"),
                     input_files=dst_apply_fl,
                     prefix="dst",
                     total_pbar=total_pbar,
+                    executor=executor,
+                    engine=engine,
                 )
 
                 # Align source images
-                self._process_images(
+                src_jobs = self._process_images(
                     slide=self.parent.registrar.get_slide("src.tiff"),
                     input_files=src_apply_fl,
                     prefix="src",
                     total_pbar=total_pbar,
+                    executor=executor,
+                    engine=engine,
                 )
 
+                # Record every file in the manifest as soon as its warp ends
+                jobs = dst_jobs + src_jobs
+                futures = {
+                    future: registered_f
+                    for registered_f, future in jobs
+                    if future is not None
+                }
+                for registered_f, future in jobs:
+                    if future is None:
+                        self._record(registered_f)
+                for future in as_completed(futures):
+                    future.result()
+                    self._record(futures[future])
+                    total_pbar.update(1)
+
+                # Keep the registered files in input order
+                self._set_registered_fl([registered_f for registered_f, _ in jobs])
+
                 # Create overlap mask
                 self._create_overlap_mask()
 
-        def _process_images(self, slide, input_files, prefix, total_pbar):
+        @property
+        def manifest(self) -> RegistrationManifest:
             """
-            Process and register images
+            Persistent manifest of the registered images, created on first use
+            for aligners pickled before manifests were added
             """
+            if getattr(self, "_manifest", None) is None:
+                self._manifest = RegistrationManifest(
+                    self.output_dir / "manifest.csv", self.mode
+                )
+            return self._manifest
+
+        def _record(self, registered_f: Path):
+            """
+            Add a registered image to the manifest once its warp has finished
+            """
+            if registered_f not in self.manifest:
+                self.manifest.add(registered_f)
+
+        def _set_registered_fl(self, registered_fl: list[Path]):
+            """
+            Put the registered files of one apply call in input order, after
+            the files registered by earlier calls
+            """
+            self.registered_fl = [
+                f for f in self.registered_fl if f not in registered_fl
+            ] + registered_fl
+
+        def _process_images(
+            self, slide, input_files, prefix, total_pbar, executor, engine="valis"
+        ):
+            """
+            Submit images to the worker pool for registration
+
+            Returns
+            -------
+            list[tuple[Path, Optional[Future]]]
+                Registered file and its pending warp for each input file, in
+                input order. The future is None if the file already exists.
+            """
+            is_identity = self._is_identity(prefix)
+            jobs = []
             for f in input_files:
-                registered_f = self.ometiff_dir / f"{prefix}_{f.stem}.ome.tiff"
+                registered_f = self._get_registered_f(prefix, f)
                 if registered_f.exists():
                     print(f"File exists and skip: {registered_f}")
+                    future = None
+                    total_pbar.update(1)
                 else:
-                    slide.warp_and_save_slide(
-                        src_f=str(f),
-                        dst_f=str(registered_f),
-                        crop="reference",
-                        non_rigid=self.non_rigid,
+                    if is_identity:
+                        warp, kwargs = rewrite_ometiff, {}
+                    elif engine == "native":
+                        warp = partial(warp_ometiff, self.parent.get_transform(prefix))
+                        kwargs = {"non_rigid": self.non_rigid, "n_workers": 1}
+                    else:
+                        warp = slide.warp_and_save_slide
+                        kwargs = {"crop": "reference", "non_rigid": self.non_rigid}
+                    warp = self.parent.profiler.wrap(
+                        warp,
+                        stage=f"warp_{self.mode}",
+                        output_f=registered_f,
+                        input_f=f,
                     )
-                if registered_f not in self.registered_fl:
-                    self.registered_fl.append(registered_f)
-                total_pbar.update(1)
-            # ValisAligner.AlignBase._process_images = _process_images
+                    future = executor.submit(
+                        warp, src_f=str(f), dst_f=str(registered_f), **kwargs
+                    )
+                jobs.append((registered_f, future))
+            return jobs
+
+        def _is_identity(self, prefix: str) -> bool:
+            """
+            Whether warping the "dst" or "src" slide is an identity op, in which
+            case images are rewritten rather than resampled
+            """
+            return self.parent.get_transform(prefix).is_identity(
+                non_rigid=self.non_rigid
+            )
+
+        def _get_registered_f(self, prefix: str, f: Path) -> Path:
+            """Path of the registered OME-TIFF for an input image"""
+            return self.ometiff_dir / f"{prefix}_{f.stem}.ome.tiff"
+
+        def _warp_and_save_img(self, slide, img: pyvips.Image, registered_f: Path):
+            """
+            Warp an already decoded image and save it as OME-TIFF
+            """
+            warped = slide.warp_img(img=img, non_rigid=self.non_rigid, crop="reference")
+            slide_io.save_ome_tiff(warped, dst_f=str(registered_f))
 
         def _create_overlap_mask(self):
             """
             Create overlap mask for the region after registration
+
+            The mask is computed from the source transform rather than by
+            warping an image of ones, and saved in its compact form.
             """
-            src_mask_f = self.temp_dir / "src_mask.tiff"
-            src_mask_aligned_f = self.temp_dir / "src_mask_aligned.ome.tiff"
-            if src_mask_aligned_f.exists():
-                print(f"File exists and skip: {src_mask_aligned_f}")
+            mask_f = self.temp_dir / "overlap_mask.npz"
+            if mask_f.exists():
+                print(f"File exists and skip: {mask_f}")
             else:
-                with tifffile.TiffFile(self.parent.src_register_f) as tif:
-                    src_mask = np.ones(tif.pages[0].shape, dtype=np.uint16)
-                    tifffile.imwrite(src_mask_f, src_mask)
-
-                    src_slide = self.parent.registrar.get_slide("src.tiff")
-                    src_slide.warp_and_save_slide(
-                        src_f=str(src_mask_f),
-                        dst_f=str(src_mask_aligned_f),
-                        crop="reference",
-                        non_rigid=self.non_rigid,
+                with self.parent.profiler.stage(
+                    f"overlap_mask_{self.mode}", output_f=mask_f
+                ):
+                    mask = OverlapMask.from_transform(
+                        self.parent.get_transform("src"), non_rigid=self.non_rigid
                     )
-            self.mask_overlap = tifffile.imread(src_mask_aligned_f)
+                    mask.save(mask_f)
+            self.mask_overlap = self.get_overlap_mask()
             # ValisAligner.AlignBase._create_overlap_mask = _create_overlap_mask
 
+        def get_overlap_mask(self) -> OverlapMask:
+            """
+            Load the compact overlap mask saved by `apply`
+
+            Regions applied before compact masks were introduced only have the
+            warped mask image, their mask is computed from the saved transforms
+            and saved on first use.
+            """
+            mask_f = self.temp_dir / "overlap_mask.npz"
+            if not mask_f.exists():
+                self._create_overlap_mask()
+                return self.mask_overlap
+            return OverlapMask.load(mask_f, self.parent.get_transform("src"))
+
         def get_metadata(self) -> pd.DataFrame:
             """
             Get metadata of registered images
@@ -349,6 +815,9 @@ class ValisAligner:
             output_f: Union[str, Path],
             f_names: list[str],
             channel_names: list[str],
+            streaming: bool = False,
+            tile_size: int = 512,
+            encoding: Optional[dict] = None,
         ):
             """
             Write the registered images to an OME-TIFF file
@@ -356,20 +825,121 @@ class ValisAligner:
             Parameters
             ----------
             output_f : Union[str, Path]
-                Path to the output OME-TIFF file. If the file already exists, the
-                process will terminate to prevent overwriting.
+                Path to the output OME-TIFF file, or OME-Zarr store if it ends
+                in ".zarr". If the file already exists, the process will
+                terminate to prevent overwriting.
             f_names : list[str]
                 List of file names in the metadata you want embed in the OME-TIFF.
             channel_names : list[str]
                 List of channel names
+            streaming : bool, optional
+                Whether to read, mask and write the images tile by tile, by
+                default False. Peak memory is then a few tiles instead of all
+                channels at full resolution. OME-Zarr stores are always
+                written in streaming mode.
+            tile_size : int, optional
+                Tile size in pixels for streaming mode, by default 512.
+            encoding : dict, optional
+                Compression keywords of the pyramid writer, e.g.
+                {"compression": "zstd", "compression_level": 5,
+                "predictor": True, "n_encode_threads": 8}. Implies streaming
+                mode. If None, the defaults of the output format.
             """
             metadata_df = self.get_metadata().set_index("f_name")
             if sum(metadata_df.index.duplicated()) > 0:
                 raise ValueError("Duplicated file names in the metadata")
 
             img_fl = metadata_df.loc[f_names]["registered_f"].tolist()
-            img_dict = {
-                channel_name: tifffile.imread(img_f) * self.mask_overlap
-                for img_f, channel_name in zip(img_fl, channel_names)
-            }
-            export_ometiff_pyramid_from_dict(img_dict, str(output_f), channel_names)
+            with self.parent.profiler.stage(
+                f"export_{self.mode}", output_f=output_f, n_channels=len(img_fl)
+            ):
+                if streaming or is_ngff(output_f) or encoding is not None:
+                    export_masked_ometiff(
+                        img_fl,
+                        output_f,
+                        channel_names,
+                        mask=self.mask_overlap,
+                        tile_size=tile_size,
+                        encoding=encoding,
+                    )
+                else:
+                    mask = np.asarray(self.mask_overlap)
+                    img_dict = {
+                        channel_name: tifffile.imread(img_f) * mask
+                        for img_f, channel_name in zip(img_fl, channel_names)
+                    }
+                    export_ometiff_pyramid_from_dict(
+                        img_dict, str(output_f), channel_names
+                    )
+
+        def apply_ometiff(
+            self,
+            output_f: Union[str, Path],
+            apply_fl: list[tuple[str, Union[str, Path]]],
+            channel_names: list[str],
+            tile_size: int = 512,
+            n_workers: int = 4,
+            write_intermediates: bool = False,
+            encoding: Optional[dict] = None,
+        ):
+            """
+            Warp images straight into one masked multichannel OME-TIFF
+
+            Tiles are warped with the native engine (see `warp_ometiff`),
+            masked with the overlap mask and written in channel order, so the
+            per-channel registered files and the re-read of `write_ometiff` are
+            skipped. Only available in rigid mode: the native engine is
+            bilinear, while Valis warps non-rigid slides with bicubic
+            interpolation.
+
+            Parameters
+            ----------
+            output_f : Union[str, Path]
+                Path to the output OME-TIFF file, or OME-Zarr store if it ends
+                in ".zarr". If the file already exists, it is skipped.
+            apply_fl : list[tuple[str, Union[str, Path]]]
+                Slide ("dst" or "src") and path of the image of every channel,
+                in channel order.
+            channel_names : list[str]
+                List of channel names, in the same order as `apply_fl`.
+            tile_size : int, optional
+                Tile size in pixels, by default 512.
+            n_workers : int, optional
+                Number of threads warping tiles, by default 4.
+            write_intermediates : bool, optional
+                Whether to also write the per-channel registered files for
+                debugging, by default False.
+            encoding : dict, optional
+                Compression keywords of the pyramid writer, see
+                `write_ometiff`.
+            """
+            if self.non_rigid:
+                raise ValueError("Direct export is only supported in rigid mode")
+            output_f = Path(output_f)
+            self._create_overlap_mask()
+            if output_f.exists():
+                print(f"File exists and skip: {output_f}")
+            else:
+                with self.parent.profiler.stage(
+                    f"warp_export_{self.mode}",
+                    output_f=output_f,
+                    n_channels=len(apply_fl),
+                ):
+                    warp_multichannel_ometiff(
+                        [self.parent.get_transform(prefix) for prefix, _ in apply_fl],
+                        [Path(f) for _, f in apply_fl],
+                        output_f,
+                        channel_names,
+                        non_rigid=self.non_rigid,
+                        mask=self.mask_overlap,
+                        tile_size=tile_size,
+                        n_workers=n_workers,
+                        encoding=encoding,
+                    )
+
+            if write_intermediates:
+                self.apply(
+                    dst_apply_fl=[f for prefix, f in apply_fl if prefix == "dst"],
+                    src_apply_fl=[f for prefix, f in apply_fl if prefix == "src"],
+                    engine="native",
+                )
@@ -0,0 +1,99 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("valis")
+pytest.importorskip("pyvips")
+
+from chalign.cache import RegistrationCache, fingerprint_file, hash_file  # noqa: E402
+from chalign.transform import RegistrationTransforms, SlideTransform  # noqa: E402
+
+
+def make_transforms(dx=0.0):
+    M = np.array([[1.0, 0.0, dx], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]])
+    slide = SlideTransform(
+        name="src",
+        M=M,
+        bk_dxdy=None,
+        processed_img_shape_rc=(10, 20),
+        reg_img_shape_rc=(10, 20),
+        slide_shape_rc=(10, 20),
+        aligned_slide_shape_rc=(10, 20),
+        crop_xywh=(0, 0, 20, 10),
+    )
+    return RegistrationTransforms({"src": slide})
+
+
+@pytest.fixture
+def register_fs(tmp_path):
+    rng = np.random.default_rng(0)
+    dst_f, src_f = tmp_path / "dst.tif", tmp_path / "src.tif"
+    dst_f.write_bytes(rng.bytes(1000))
+    src_f.write_bytes(rng.bytes(1000))
+    return dst_f, src_f
+
+
+def test_fingerprint_file_samples_large_files(tmp_path):
+    path = tmp_path / "large.bin"
+    content = bytearray(np.random.default_rng(0).bytes(64 * 1024))
+    path.write_bytes(content)
+    stat = os.stat(path)
+    fingerprint = fingerprint_file(path, n_blocks=4, block_size=1024)
+    assert fingerprint == fingerprint_file(path, n_blocks=4, block_size=1024)
+
+    # The last block is always sampled
+    content[-1] ^= 0xFF
+    path.write_bytes(content)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert fingerprint_file(path, n_blocks=4, block_size=1024) != fingerprint
+
+    # The modification time is part of the fingerprint
+    fingerprint = fingerprint_file(path, n_blocks=4, block_size=1024)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert fingerprint_file(path, n_blocks=4, block_size=1024) != fingerprint
+
+
+def test_hash_file_reads_the_whole_content(tmp_path):
+    a, b = tmp_path / "a.bin", tmp_path / "b.bin"
+    a.write_bytes(b"x" * 5000)
+    b.write_bytes(b"x" * 2500 + b"y" + b"x" * 2499)
+    assert hash_file(a, chunk_size=1000) != hash_file(b, chunk_size=1000)
+    assert hash_file(a, chunk_size=1000) == hash_file(a)
+
+
+def test_get_key(tmp_path, register_fs):
+    cache = RegistrationCache(tmp_path / "cache")
+    key = cache.get_key(*register_fs, {"max_processed_image_dim_px": 512})
+    assert key == cache.get_key(*register_fs, {"max_processed_image_dim_px": 512})
+    assert key != cache.get_key(*register_fs, {"max_processed_image_dim_px": 1024})
+    assert key != cache.get_key(*register_fs[::-1], {"max_processed_image_dim_px": 512})
+
+
+def test_put_and_get(tmp_path, register_fs):
+    cache = RegistrationCache(tmp_path / "cache")
+    key = cache.get_key(*register_fs)
+    assert cache.get(key) is None
+
+    error_df = pd.DataFrame({"filename": ["src.tiff"], "rigid_D": [1.5]})
+    cache.put(key, make_transforms(dx=3.0), error_df)
+    transforms, cached_error_df = cache.get(key)
+    np.testing.assert_array_equal(
+        transforms.get_slide("src").M, make_transforms(dx=3.0).get_slide("src").M
+    )
+    pd.testing.assert_frame_equal(cached_error_df, error_df)
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache = RegistrationCache(tmp_path / "cache", max_bytes=10**9)
+    error_df = pd.DataFrame({"rigid_D": [0.0]})
+    for i, key in enumerate(["a", "b", "c"]):
+        cache.put(key, make_transforms(dx=i), error_df)
+        os.utime(cache.cache_dir / key, (i, i))
+    cache.get("a")
+
+    entry_bytes = sum(f.stat().st_size for f in (cache.cache_dir / "c").iterdir())
+    cache.max_bytes = 2 * entry_bytes + entry_bytes // 2
+    cache.evict()
+    assert sorted(p.name for p in cache.cache_dir.iterdir()) == ["a", "c"]
@@ -0,0 +1,121 @@
+import numpy as np
+import pytest
+
+from chalign.histogram import (
+    HISTOGRAM_BINS,
+    ChannelHistograms,
+    get_histogram_path,
+    is_histogram_dtype,
+    load_histograms,
+    quantile_from_counts,
+)
+
+QUANTILES = [0.0, 0.001, 0.1, 0.25, 0.5, 0.9, 0.999, 1.0]
+
+
+def make_image(shape=(37, 53), dtype=np.uint16, seed=0):
+    rng = np.random.default_rng(seed)
+    high = np.iinfo(dtype).max
+    return rng.integers(0, high, size=shape, endpoint=True).astype(dtype)
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16])
+@pytest.mark.parametrize("shape", [(1, 1), (1, 2), (37, 53)])
+def test_quantile_from_counts_matches_numpy(dtype, shape):
+    img = make_image(shape, dtype)
+    counts = np.bincount(img.ravel(), minlength=HISTOGRAM_BINS)
+    for q in QUANTILES:
+        assert quantile_from_counts(counts, q) == pytest.approx(np.quantile(img, q))
+
+
+def test_quantile_from_counts_repeated_values():
+    img = np.array([3, 3, 3, 7, 7, 1000], np.uint16)
+    counts = np.bincount(img, minlength=HISTOGRAM_BINS)
+    for q in QUANTILES:
+        assert quantile_from_counts(counts, q) == pytest.approx(np.quantile(img, q))
+
+
+def test_quantile_from_counts_empty():
+    with pytest.raises(ValueError):
+        quantile_from_counts(np.zeros(HISTOGRAM_BINS, np.int64), 0.5)
+
+
+def test_is_histogram_dtype():
+    assert is_histogram_dtype(np.uint8)
+    assert is_histogram_dtype("uint16")
+    assert not is_histogram_dtype(np.int16)
+    assert not is_histogram_dtype(np.float32)
+
+
+def test_get_histogram_path(tmp_path):
+    path = get_histogram_path(tmp_path / "region.ome.tiff")
+    assert path == tmp_path / "region.ome.tiff.histogram.npz"
+
+
+def test_add_by_tiles_matches_whole_image():
+    img = make_image()
+    histograms = ChannelHistograms(["DAPI", "CD3"])
+    for y0 in range(0, img.shape[0], 16):
+        for x0 in range(0, img.shape[1], 16):
+            histograms.add("CD3", img[y0 : y0 + 16, x0 : x0 + 16])
+    assert histograms.get_counts("DAPI").sum() == 0
+    np.testing.assert_array_equal(
+        histograms.get_counts(1), np.bincount(img.ravel(), minlength=HISTOGRAM_BINS)
+    )
+    assert histograms.quantile("CD3", 0.99) == pytest.approx(np.quantile(img, 0.99))
+    assert "CD3" in histograms and "CD8" not in histograms
+
+
+def test_add_rejects_float():
+    histograms = ChannelHistograms(["DAPI"])
+    with pytest.raises(ValueError):
+        histograms.add("DAPI", np.zeros((2, 2), np.float32))
+
+
+def test_wrap_counts_returned_tiles():
+    img = make_image(dtype=np.uint8)
+    histograms = ChannelHistograms(["DAPI"])
+    tile_fn = histograms.wrap(lambda c, y0, y1, x0, x1: img[y0:y1, x0:x1])
+    tile = tile_fn(0, 0, 10, 0, 20)
+    np.testing.assert_array_equal(tile, img[:10, :20])
+    assert histograms.get_counts(0).sum() == tile.size
+    assert histograms.get_stats(0)["max"] == tile.max()
+
+
+def test_stats():
+    img = make_image()
+    histograms = ChannelHistograms.from_dict({"DAPI": img})
+    stats = histograms.get_stats("DAPI")
+    assert stats["n"] == img.size
+    assert stats["min"] == img.min()
+    assert stats["max"] == img.max()
+    assert stats["mean"] == pytest.approx(img.mean())
+    assert list(histograms.to_frame().columns) == ["channel", "n", "min", "max", "mean"]
+
+
+def test_save_load_round_trip(tmp_path):
+    path_ometiff = tmp_path / "region.ome.tiff"
+    assert load_histograms(path_ometiff) is None
+
+    im_dict = {"DAPI": make_image(seed=1), "CD3": make_image(seed=2)}
+    histograms = ChannelHistograms.from_dict(im_dict)
+    histograms.save(get_histogram_path(path_ometiff))
+    assert [p.name for p in tmp_path.iterdir()] == ["region.ome.tiff.histogram.npz"]
+
+    loaded = load_histograms(path_ometiff)
+    assert loaded.channel_names == ["DAPI", "CD3"]
+    np.testing.assert_array_equal(loaded.counts, histograms.counts)
+    for name, img in im_dict.items():
+        assert loaded.quantile(name, 0.5) == pytest.approx(np.quantile(img, 0.5))
+
+
+def test_load_rejects_other_version(tmp_path):
+    path = tmp_path / "region.ome.tiff.histogram.npz"
+    np.savez_compressed(
+        path,
+        version=0,
+        channel_names=np.array(["DAPI"]),
+        counts=np.zeros((1, HISTOGRAM_BINS), np.int64),
+    )
+    with pytest.raises(ValueError):
+        ChannelHistograms.load(path)
@@ -0,0 +1,132 @@
+import numpy as np
+import pandas as pd
+import pytest
+import tifffile
+
+from chalign.manifest import (
+    BatchManifest,
+    RegistrationManifest,
+    parse_registered_filename,
+)
+
+
+def write_registered(ometiff_dir, filenames, suffix=".ome.tiff", shape=(8, 12)):
+    ometiff_dir.mkdir(parents=True, exist_ok=True)
+    fl = []
+    for filename in filenames:
+        registered_f = ometiff_dir / f"{filename}{suffix}"
+        tifffile.imwrite(registered_f, np.zeros(shape, np.uint16))
+        fl.append(registered_f)
+    return fl
+
+
+def test_parse_registered_filename():
+    fields = parse_registered_filename("dst_reg001_cyc002_ch002_CD45")
+    assert fields["marker_label"] == "dst_cyc002_ch002_CD45"
+    assert fields["marker_type"] == "marker"
+    assert parse_registered_filename("src_reg001_Ch1Cy3")["marker_type"] == "dapi"
+    assert parse_registered_filename("src_r_c_ch_Blank")["marker_type"] == "blank"
+
+
+def test_registration_manifest_persists_in_order(tmp_path):
+    fl = write_registered(tmp_path / "ometiff", ["dst_r_c1_ch1_B", "dst_r_c1_ch2_A"])
+    manifest = RegistrationManifest(tmp_path / "manifest.csv", "rigid")
+    for registered_f in fl:
+        manifest.add(registered_f)
+
+    reloaded = RegistrationManifest(tmp_path / "manifest.csv", "rigid")
+    assert reloaded.get_files() == fl
+    assert fl[0] in reloaded and len(reloaded) == 2
+    row = reloaded.to_frame().iloc[1]
+    assert (row["height"], row["width"], row["dtype"]) == (8, 12, "uint16")
+    assert row["mode"] == "rigid"
+
+
+def test_rebuild(tmp_path):
+    write_registered(tmp_path / "ometiff", ["dst_r_c1_ch1_B", "src_r_c1_ch2_A"])
+    manifest = RegistrationManifest.rebuild(
+        tmp_path / "manifest.csv", tmp_path / "ometiff", "non_rigid"
+    )
+    assert len(manifest) == 2
+    assert (tmp_path / "manifest.csv").exists()
+
+
+@pytest.fixture
+def batch_dirs(tmp_path):
+    cycles = {"reg001": [1, 2, 3], "reg002": [1, 2], "reg003": [2, 3]}
+    output_dirs = []
+    for region, region_cycles in cycles.items():
+        output_dir = tmp_path / region
+        ometiff_dir = output_dir / "registered_non_rigid" / "ometiff"
+        filenames = [f"dst_{region}_Ch1Cy{cycle}" for cycle in region_cycles]
+        filenames += [f"src_{region}_cyc001_ch002_CD3"]
+        write_registered(ometiff_dir, filenames)
+        output_dirs.append(output_dir)
+    # reg001 has a manifest, the others are rebuilt from their files
+    manifest = RegistrationManifest(
+        output_dirs[0] / "registered_non_rigid" / "manifest.csv", "non_rigid"
+    )
+    for registered_f in sorted(
+        (output_dirs[0] / "registered_non_rigid" / "ometiff").iterdir()
+    ):
+        manifest.add(registered_f)
+    return output_dirs
+
+
+def test_batch_manifest_queries(batch_dirs):
+    batch = BatchManifest.from_dirs(batch_dirs)
+    assert batch.ids == ["reg001", "reg002", "reg003"]
+    assert (batch_dirs[1] / "registered_non_rigid" / "manifest.csv").exists()
+
+    registered_f = batch.get_file("reg002", marker_label="src_cyc001_ch002_CD3")
+    assert registered_f.name == "src_reg002_cyc001_ch002_CD3.ome.tiff"
+    ometiff_dir = batch_dirs[2] / "registered_non_rigid" / "ometiff"
+    assert batch.get_file("reg003", filename="dst_reg003_Ch1Cy3") == (
+        ometiff_dir / "dst_reg003_Ch1Cy3.ome.tiff"
+    )
+    with pytest.raises(KeyError):
+        batch.get_file("reg002", filename="dst_reg002_Ch1Cy3")
+    with pytest.raises(ValueError):
+        batch.get_file("reg002")
+    assert len(batch.query(id="reg001", marker_type="dapi")) == 3
+
+
+def test_max_common_dapi_cycle(batch_dirs):
+    assert BatchManifest.from_dirs(batch_dirs).get_max_common_dapi_cycle() == 2
+    assert BatchManifest.from_dirs(batch_dirs[::2]).get_max_common_dapi_cycle() == 3
+    with pytest.raises(ValueError, match="No DAPI cycle"):
+        BatchManifest.from_dirs(batch_dirs).get_max_common_dapi_cycle(channel="Ch2")
+
+
+def test_skip_regions_without_manifest(batch_dirs, tmp_path):
+    batch = BatchManifest.from_dirs(
+        batch_dirs + [tmp_path / "reg004"], rebuild_missing=False
+    )
+    assert batch.ids == ["reg001"]
+
+
+def test_from_inputs(tmp_path):
+    rows = []
+    for region in ["reg001", "reg002"]:
+        for prefix in ["dst", "src"]:
+            write_registered(
+                tmp_path / "input" / region / prefix,
+                [f"{region}_Ch1Cy1", f"{region}_cyc001_ch002_CD3"],
+                suffix=".tif",
+            )
+        rows.append(
+            {
+                "id": region,
+                "dst_dir": tmp_path / "input" / region / "dst",
+                "src_dir": tmp_path / "input" / region / "src",
+                "output_dir": tmp_path / "output" / region,
+            }
+        )
+    batch = BatchManifest.from_inputs(pd.DataFrame(rows))
+
+    assert batch.ids == ["reg001", "reg002"]
+    assert batch.get_file("reg002", filename="src_reg002_Ch1Cy1") == (
+        tmp_path / "input" / "reg002" / "src" / "reg002_Ch1Cy1.tif"
+    )
+    assert (batch.df["mode"] == "input").all()
+    assert (tmp_path / "output" / "reg001" / "input_manifest.csv").exists()
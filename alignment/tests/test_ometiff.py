@@ -0,0 +1,135 @@
+import threading
+
+import numpy as np
+import pytest
+import tifffile
+
+from chalign.ometiff import (
+    TiffWindowReader,
+    export_masked_ometiff,
+    get_n_levels,
+    write_ometiff_pyramid_tiled,
+)
+
+
+@pytest.fixture
+def img():
+    return np.random.default_rng(0).integers(0, 2**16, (300, 500), dtype=np.uint16)
+
+
+@pytest.fixture(params=["tiled", "stripped"])
+def img_f(request, tmp_path, img):
+    img_f = tmp_path / f"{request.param}.tif"
+    if request.param == "tiled":
+        tifffile.imwrite(img_f, img, tile=(64, 64), compression="zlib")
+    else:
+        tifffile.imwrite(img_f, img, rowsperstrip=37, compression="zlib")
+    return img_f
+
+
+@pytest.mark.parametrize(
+    "window", [(0, 300, 0, 500), (10, 75, 33, 260), (299, 300, 499, 500)]
+)
+@pytest.mark.parametrize("step", [1, 2, 3])
+def test_read_window(img_f, img, window, step):
+    y0, y1, x0, x1 = window
+    with TiffWindowReader(img_f) as reader:
+        assert reader.shape == img.shape and reader.dtype == img.dtype
+        np.testing.assert_array_equal(
+            reader.read(y0, y1, x0, x1, step), img[y0:y1:step, x0:x1:step]
+        )
+
+
+def test_read_decodes_every_segment_once(img_f, img, monkeypatch):
+    with TiffWindowReader(img_f) as reader:
+        decoded = []
+        decode_segment = reader._decode_segment
+
+        def counting_decode_segment(index):
+            segment = decode_segment(index)
+            if index not in reader._cache:
+                decoded.append(index)
+            return segment
+
+        monkeypatch.setattr(reader, "_decode_segment", counting_decode_segment)
+        for y0 in range(0, 300, 50):
+            for x0 in range(0, 500, 50):
+                np.testing.assert_array_equal(
+                    reader.read(y0, y0 + 50, x0, x0 + 50),
+                    img[y0 : y0 + 50, x0 : x0 + 50],
+                )
+        assert sorted(decoded) == list(range(len(reader.page.dataoffsets)))
+
+
+def test_read_page_of_open_file(tmp_path, img):
+    stack = np.stack([img, img[::-1]])
+    tifffile.imwrite(tmp_path / "stack.tif", stack, photometric="minisblack")
+    with tifffile.TiffFile(tmp_path / "stack.tif") as tif:
+        readers = [TiffWindowReader(page) for page in tif.series[0].pages]
+        for reader, expected in zip(readers, stack):
+            np.testing.assert_array_equal(
+                reader.read(5, 80, 7, 90), expected[5:80, 7:90]
+            )
+            reader.close()
+        assert not tif.filehandle.closed
+
+
+def write_pyramid(output_f, img, **kwargs):
+    calls = []
+    lock = threading.Lock()
+
+    def tile_fn(c, y0, y1, x0, x1):
+        with lock:
+            calls.append((c, y0, y1, x0, x1))
+        return img[c][y0:y1, x0:x1]
+
+    write_ometiff_pyramid_tiled(
+        output_f,
+        shape=img.shape[1:],
+        dtype=img.dtype,
+        channel_names=[f"c{c}" for c in range(len(img))],
+        tile_fn=tile_fn,
+        **kwargs,
+    )
+    return calls
+
+
+@pytest.mark.parametrize("n_workers", [1, 3])
+def test_write_ometiff_pyramid_tiled(tmp_path, img, n_workers):
+    img = np.stack([img, img // 2])
+    calls = write_pyramid(
+        tmp_path / "out.ome.tiff", img, tile_size=64, n_workers=n_workers
+    )
+
+    n_tiles = 2 * len(range(0, 300, 64)) * len(range(0, 500, 64))
+    assert len(calls) == len(set(calls)) == n_tiles
+    with tifffile.TiffFile(tmp_path / "out.ome.tiff") as tif:
+        levels = tif.series[0].levels
+        assert len(levels) == get_n_levels(img.shape[1:], 64)
+        for k, level in enumerate(levels):
+            np.testing.assert_array_equal(level.asarray(), img[:, :: 2**k, :: 2**k])
+
+
+def test_write_ometiff_pyramid_tiled_rejects_odd_tiles(tmp_path, img):
+    with pytest.raises(ValueError, match="even"):
+        write_pyramid(tmp_path / "out.ome.tiff", img[None], tile_size=63)
+
+
+def test_export_masked_ometiff(tmp_path, img):
+    mask = np.zeros(img.shape, np.uint8)
+    mask[20:200, 50:400] = 1
+    tifffile.imwrite(tmp_path / "a.tif", img, tile=(64, 64))
+    tifffile.imwrite(tmp_path / "b.tif", img[::-1], rowsperstrip=16)
+    tifffile.imwrite(tmp_path / "mask.tif", mask)
+
+    export_masked_ometiff(
+        [tmp_path / "a.tif", tmp_path / "b.tif"],
+        tmp_path / "out.ome.tiff",
+        ["A", "B"],
+        mask=tmp_path / "mask.tif",
+        tile_size=128,
+        histogram=False,
+    )
+    np.testing.assert_array_equal(
+        tifffile.imread(tmp_path / "out.ome.tiff"), np.stack([img, img[::-1]]) * mask
+    )
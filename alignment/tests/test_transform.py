@@ -0,0 +1,145 @@
+import numpy as np
+import pytest
+import tifffile
+
+pytest.importorskip("valis")
+pytest.importorskip("pyvips")
+
+from chalign.ometiff import TiffWindowReader  # noqa: E402
+from chalign.transform import (  # noqa: E402
+    TRANSFORMS_VERSION,
+    OverlapMask,
+    RegistrationTransforms,
+    SlideTransform,
+)
+
+SHAPE = (90, 120)
+
+
+def make_transform(name="src", dx=0.0, dy=0.0, bk_dxdy=None, shape=SHAPE):
+    """Transform translating the slide by (dx, dy), cropped to the slide"""
+    h, w = shape
+    M = np.array([[1.0, 0.0, dx], [0.0, 1.0, dy], [0.0, 0.0, 1.0]])
+    return SlideTransform(
+        name=name,
+        M=M,
+        bk_dxdy=bk_dxdy,
+        processed_img_shape_rc=shape,
+        reg_img_shape_rc=shape,
+        slide_shape_rc=shape,
+        aligned_slide_shape_rc=shape,
+        crop_xywh=(0, 0, w, h),
+    )
+
+
+def test_backward_map_inverts_forward_map():
+    transform = make_transform(dx=5.5, dy=-3.0)
+    xy = np.array([[0.0, 0.0], [10.0, 20.0], [119.0, 89.0]])
+    out_xy = transform.forward_map(xy)
+    np.testing.assert_allclose(out_xy, xy + [5.5, -3.0])
+    ys, xs = transform.backward_map(out_xy[:, 1], out_xy[:, 0], non_rigid=False)
+    np.testing.assert_allclose(np.column_stack([xs, ys]), xy)
+
+
+def test_is_identity():
+    assert make_transform().is_identity()
+    assert make_transform(dx=0.2).is_identity()
+    assert not make_transform(dx=2.0).is_identity()
+
+    bk_dxdy = np.full((2, *SHAPE), 3.0, np.float32)
+    assert not make_transform(bk_dxdy=bk_dxdy).is_identity(non_rigid=True)
+    assert make_transform(bk_dxdy=bk_dxdy).is_identity(non_rigid=False)
+
+
+def test_warp_window_translates_the_source(tmp_path):
+    img = np.arange(np.prod(SHAPE), dtype=np.uint16).reshape(SHAPE)
+    tifffile.imwrite(tmp_path / "src.tif", img, tile=(32, 32))
+    transform = make_transform(dx=5, dy=3)
+
+    expected = np.zeros_like(img)
+    expected[3:, 5:] = img[:-3, :-5]
+    with TiffWindowReader(tmp_path / "src.tif") as reader:
+        tile = transform.warp_window(reader, 0, SHAPE[0], 0, SHAPE[1])
+        sub = transform.warp_window(reader, 10, 50, 20, 70, step=2)
+    np.testing.assert_array_equal(tile, expected)
+    np.testing.assert_array_equal(sub, expected[10:50:2, 20:70:2])
+
+
+def test_registration_transforms_roundtrip(tmp_path):
+    bk_dxdy = np.random.default_rng(0).normal(size=(2, 9, 12)).astype(np.float32)
+    transforms = RegistrationTransforms(
+        {"dst": make_transform("dst"), "src": make_transform("src", 4, 2, bk_dxdy)},
+        overlap_imgs={"rigid_overlap_img": np.ones((9, 12, 3), np.uint8)},
+        metadata={"valis_version": "1.0"},
+    )
+    transforms.save(tmp_path / "transforms.npz")
+    loaded = RegistrationTransforms.load(tmp_path / "transforms.npz")
+
+    assert loaded.metadata == {"valis_version": "1.0"}
+    assert loaded.get_slide("dst.tiff").bk_dxdy is None
+    for name in ["dst", "src"]:
+        slide, loaded_slide = transforms.get_slide(name), loaded.get_slide(name)
+        np.testing.assert_array_equal(loaded_slide.M, slide.M)
+        for field in RegistrationTransforms._shape_fields:
+            assert getattr(loaded_slide, field) == getattr(slide, field)
+    np.testing.assert_array_equal(loaded.get_slide("src").bk_dxdy, bk_dxdy)
+    np.testing.assert_array_equal(
+        loaded.rigid_overlap_img, transforms.rigid_overlap_img
+    )
+    assert loaded.original_overlap_img is None
+
+
+def test_registration_transforms_rejects_other_versions(tmp_path):
+    RegistrationTransforms({"src": make_transform()}).save(tmp_path / "t.npz")
+    with np.load(tmp_path / "t.npz") as npz:
+        arrays = dict(npz)
+    arrays["version"] = np.array(TRANSFORMS_VERSION + 1)
+    np.savez(tmp_path / "t.npz", **arrays)
+    with pytest.raises(ValueError, match="Unsupported transforms version"):
+        RegistrationTransforms.load(tmp_path / "t.npz")
+
+
+def test_get_rigid_init_inverts_the_matrices():
+    transforms = RegistrationTransforms({"src": make_transform(dx=4, dy=2)})
+    do_rigid = transforms.get_rigid_init({"src": "/data/src.tiff"})
+    np.testing.assert_allclose(
+        do_rigid["/data/src.tiff"]["M"] @ transforms.get_slide("src").M, np.eye(3)
+    )
+    assert do_rigid["/data/src.tiff"]["transformation_src_shape_rc"] == SHAPE
+
+
+def make_non_rigid_transform():
+    """Translation with a smooth sinusoidal backward displacement field"""
+    yy, xx = np.mgrid[0 : SHAPE[0] // 3, 0 : SHAPE[1] // 3]
+    bk_dxdy = np.stack([2.0 * np.sin(yy / 4.0), 1.5 * np.cos(xx / 5.0)])
+    return make_transform(dx=6, dy=-4, bk_dxdy=bk_dxdy.astype(np.float32))
+
+
+def get_exact_mask(transform, non_rigid):
+    ys, xs = np.mgrid[0 : SHAPE[0], 0 : SHAPE[1]]
+    return transform.is_inside(ys, xs, non_rigid=non_rigid).astype(np.uint16)
+
+
+@pytest.mark.parametrize("non_rigid", [False, True])
+def test_overlap_mask_matches_backward_mapping(non_rigid):
+    transform = make_non_rigid_transform()
+    mask = OverlapMask.from_transform(transform, non_rigid=non_rigid, cell_size=16)
+    expected = get_exact_mask(transform, non_rigid)
+
+    assert (mask.polygon is None) == non_rigid
+    assert mask.shape == SHAPE
+    np.testing.assert_array_equal(np.asarray(mask), expected)
+    np.testing.assert_array_equal(
+        mask.read(5, 70, 3, 110, step=3), expected[5:70:3, 3:110:3]
+    )
+
+
+@pytest.mark.parametrize("non_rigid", [False, True])
+def test_overlap_mask_roundtrip(tmp_path, non_rigid):
+    transform = make_non_rigid_transform()
+    mask = OverlapMask.from_transform(transform, non_rigid=non_rigid, cell_size=16)
+    mask.save(tmp_path / "overlap_mask.npz")
+    loaded = OverlapMask.load(tmp_path / "overlap_mask.npz", transform)
+
+    assert loaded.non_rigid == non_rigid
+    np.testing.assert_array_equal(np.asarray(loaded), np.asarray(mask))
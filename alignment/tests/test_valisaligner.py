@@ -0,0 +1,134 @@
+import threading
+import time
+from contextlib import nullcontext
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import tifffile
+
+pytest.importorskip("valis")
+pytest.importorskip("pyqupath")
+
+from chalign.transform import OverlapMask, SlideTransform  # noqa: E402
+from chalign.valisaligner import ValisAligner  # noqa: E402
+
+
+class FakeSlide:
+    """Slide whose warps finish in reverse order of submission"""
+
+    def __init__(self, delays: dict[str, float]):
+        self.delays = delays
+        self.warped = []
+        self._lock = threading.Lock()
+
+    def warp_and_save_slide(self, src_f, dst_f, crop, non_rigid):
+        time.sleep(self.delays.get(Path(src_f).stem, 0))
+        tifffile.imwrite(dst_f, np.zeros((4, 6), np.uint8))
+        with self._lock:
+            self.warped.append(Path(src_f).stem)
+
+
+def make_parent(tmp_path, slides, transform=None):
+    if transform is None:
+        transform = SimpleNamespace(is_identity=lambda non_rigid: False)
+    return SimpleNamespace(
+        output_dir=tmp_path,
+        tqdm_format="{desc}",
+        registrar=SimpleNamespace(get_slide=slides.__getitem__),
+        get_transform=lambda prefix: transform,
+        profiler=SimpleNamespace(
+            wrap=lambda fn, **kwargs: fn, stage=lambda *args, **kwargs: nullcontext()
+        ),
+    )
+
+
+def make_aligner(tmp_path, monkeypatch, slides):
+    monkeypatch.setattr(
+        ValisAligner.AlignBase, "_create_overlap_mask", lambda self: None
+    )
+    return ValisAligner.AlignBase(make_parent(tmp_path, slides), non_rigid=True)
+
+
+def get_registered_fl(aligner, prefix, names):
+    return [aligner.ometiff_dir / f"{prefix}_{name}.ome.tiff" for name in names]
+
+
+def test_apply_keeps_input_order(tmp_path, monkeypatch):
+    dst_names, src_names = ["a", "b", "c"], ["d", "e", "f"]
+    delays = {name: 0.05 * (5 - i) for i, name in enumerate(dst_names + src_names)}
+    slides = {"dst.tiff": FakeSlide(delays), "src.tiff": FakeSlide(delays)}
+    aligner = make_aligner(tmp_path, monkeypatch, slides)
+
+    aligner.apply(
+        [tmp_path / f"{name}.tif" for name in dst_names],
+        [tmp_path / f"{name}.tif" for name in src_names],
+        n_workers=4,
+    )
+
+    expected = get_registered_fl(aligner, "dst", dst_names) + get_registered_fl(
+        aligner, "src", src_names
+    )
+    assert aligner.registered_fl == expected
+    assert sorted(slides["dst.tiff"].warped) == dst_names
+    assert sorted(slides["src.tiff"].warped) == src_names
+    assert set(aligner.manifest.get_files()) == set(expected)
+    assert (aligner.output_dir / "manifest.csv").exists()
+
+
+def test_apply_skips_existing_files(tmp_path, monkeypatch):
+    slides = {"dst.tiff": FakeSlide({}), "src.tiff": FakeSlide({})}
+    aligner = make_aligner(tmp_path, monkeypatch, slides)
+    existing_f = get_registered_fl(aligner, "dst", ["a"])[0]
+    tifffile.imwrite(existing_f, np.ones((4, 6), np.uint8))
+
+    aligner.apply(
+        [tmp_path / "a.tif", tmp_path / "b.tif"], [tmp_path / "c.tif"], n_workers=2
+    )
+
+    assert slides["dst.tiff"].warped == ["b"]
+    assert slides["src.tiff"].warped == ["c"]
+    assert tifffile.imread(existing_f).max() == 1
+    assert aligner.registered_fl[0] == existing_f
+    assert existing_f in aligner.manifest
+
+
+def test_apply_again_skips_everything(tmp_path, monkeypatch):
+    slides = {"dst.tiff": FakeSlide({}), "src.tiff": FakeSlide({})}
+    aligner = make_aligner(tmp_path, monkeypatch, slides)
+    dst_apply_fl, src_apply_fl = [tmp_path / "a.tif"], [tmp_path / "b.tif"]
+    aligner.apply(dst_apply_fl, src_apply_fl, n_workers=2)
+    aligner.apply(dst_apply_fl, src_apply_fl, n_workers=2)
+
+    assert slides["dst.tiff"].warped == ["a"]
+    assert slides["src.tiff"].warped == ["b"]
+    assert len(aligner.registered_fl) == 2
+    assert len(aligner.manifest) == 2
+
+
+def test_get_overlap_mask_of_a_region_without_one(tmp_path):
+    transform = SlideTransform(
+        name="src",
+        M=np.array([[1.0, 0.0, 3.0], [0.0, 1.0, 2.0], [0.0, 0.0, 1.0]]),
+        bk_dxdy=None,
+        processed_img_shape_rc=(40, 50),
+        reg_img_shape_rc=(40, 50),
+        slide_shape_rc=(40, 50),
+        aligned_slide_shape_rc=(40, 50),
+        crop_xywh=(0, 0, 50, 40),
+    )
+    parent = make_parent(tmp_path, {}, transform)
+    aligner = ValisAligner.AlignBase(parent, non_rigid=False)
+    mask_f = aligner.temp_dir / "overlap_mask.npz"
+    assert not mask_f.exists()
+
+    mask = aligner.get_overlap_mask()
+
+    assert mask_f.exists()
+    expected = np.zeros((40, 50), np.uint16)
+    expected[2:, 3:] = 1
+    np.testing.assert_array_equal(np.asarray(mask), expected)
+    reloaded = aligner.get_overlap_mask()
+    assert isinstance(reloaded, OverlapMask)
+    np.testing.assert_array_equal(np.asarray(reloaded), expected)
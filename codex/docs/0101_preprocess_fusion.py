@@ -1,8 +1,9 @@
-import os
+import sys
 from pathlib import Path
 
-from pyqupath.geojson import crop_dict_by_geojson
-from pyqupath.ometiff import export_ometiff_pyramid_from_dict, load_tiff_to_dict
+dir_src = Path(__file__).resolve().parent.parent
+sys.path.append(str(dir_src))
+from src.fusion import preprocess_fusion
 
 ################################################################################
 # input directory
@@ -41,44 +42,15 @@ channels_order = [
     "HLA-1",
 ]
 channels_rename = None  # If None, the channels will not be renamed
+output_format = "ometiff"  # "ometiff" or "zarr" (chunked OME-Zarr)
 ################################################################################
 
-
-def preprocess_fusion(
+df_summary = preprocess_fusion(
     dir_root,
     dir_output,
     channels_order,
     channels_rename,
-):
-    dir_root = Path(dir_root)
-    dir_output = Path(dir_output)
-
-    # parse the dir_root
-    path_markerlist = dir_root / "MarkerList.txt"
-    path_geojson = dir_root / "cropping_regions.geojson"
-    paths_qptiff = list(dir_root.glob("*.qptiff"))
-    if len(paths_qptiff) == 1:
-        path_qptiff = paths_qptiff[0]
-    else:
-        raise ValueError("There should be only one qptiff file in the directory")
-
-    # load QPTIFF file
-    im_dict = load_tiff_to_dict(
-        path_qptiff,
-        filetype="qptiff",
-        channels_order=channels_order,
-        channels_rename=channels_rename,
-        path_markerlist=path_markerlist,
-    )
-
-    # crop QPTIFF file into multiple OME-TIFF files
-    for name, crop_im_dict in crop_dict_by_geojson(im_dict, path_geojson):
-        print(f"Cropping OME-TIFF for: {name}")
-        path_ometiff = dir_output / name / f"{name}.ome.tiff"
-        path_ometiff.parent.mkdir(parents=True, exist_ok=True)
-        if path_ometiff.exists():
-            os.remove(path_ometiff)
-        export_ometiff_pyramid_from_dict(crop_im_dict, str(path_ometiff))
-
-
-preprocess_fusion(dir_root, dir_output, channels_order, channels_rename)
+    n_workers=8,
+    output_format=output_format,
+)
+df_summary.to_csv(Path(dir_output) / "preprocess_summary.csv", index=False)
@@ -89,7 +89,11 @@ C1Q	C1Q
 
 keyence = KeyencePreprocessor(dir_root)
 
-# Step 1: Generate DAPI OME-TIFF and metadata
+# Step 1: Generate DAPI review thumbnails, metrics and metadata
+if False:
+    keyence.export_dapi_review_and_metadata(dir_output_review, n_workers=4)
+
+# Step 1 (alternative): Generate full resolution DAPI OME-TIFF and metadata
 if False:
     keyence.export_dapi_ometiff_and_metadata(dir_output_review)
 
@@ -97,4 +101,11 @@ if False:
 if True:
     df_metadata_dapi = pd.read_csv(StringIO(string_metadata_dapi), sep="\t")
     df_metadata_marker = pd.read_csv(StringIO(string_metadata_marker), sep="\t")
-    keyence.export_ometiff(dir_output_ometiff, df_metadata_dapi, df_metadata_marker)
+    df_summary = keyence.export_ometiff(
+        dir_output_ometiff,
+        df_metadata_dapi,
+        df_metadata_marker,
+        n_workers=4,
+        output_format="ometiff",  # or "zarr" for chunked OME-Zarr stores
+    )
+    df_summary.to_csv(Path(dir_output_ometiff) / "export_summary.csv", index=False)
@@ -1,89 +1,17 @@
 # %%
-from collections import OrderedDict
+import sys
 
-import numpy as np
 import pandas as pd
-from pyqupath.ometiff import export_ometiff_pyramid_from_dict
 from pathlib import Path
+from chalign.histogram import load_histograms
 from pyqupath.ometiff import load_tiff_to_dict
-import os
 from tqdm import tqdm
-from pycodex.segmentation import scale_marker_sum, cut_quantile
-
-
-def combine_markers(
-    marker_dict: dict[str, np.ndarray],
-    markers_list: list[list[str]],
-) -> OrderedDict:
-    """
-    Combine markers from different channels into one channel.
-
-    Parameters
-    ----------
-    marker_dict : dict[str, np.ndarray]
-        Dictionary of markers, with keys as marker names and values as marker arrays.
-    markers_list : list[list[str]]
-        List of markers to be combined.
-
-    Returns
-    -------
-    OrderedDict
-        Dictionary of combined markers.
-    """
-    marker_sum_dict = OrderedDict()
-    for markers in tqdm(markers_list, desc="Combining markers"):
-        tag = ",".join(markers)
-
-        # raw markers
-        q_min = 0.00
-        q_max = 1.00
-        marker_name = f"({q_min:.2f},{q_max:.2f}) {tag}"
-        marker_sum_dict[marker_name] = (
-            scale_marker_sum(
-                markers,
-                {
-                    key: cut_quantile(value, q_min=q_min, q_max=q_max)
-                    for key, value in marker_dict.items()
-                },
-                True,
-            )
-            * 65535
-        ).astype(np.uint16)
-
-        # cut quantile: 0.00-0.99
-        q_min = 0.00
-        q_max = 0.99
-        marker_name = f"({q_min:.2f},{q_max:.2f}) {tag}"
-        marker_sum_dict[marker_name] = (
-            scale_marker_sum(
-                markers,
-                {
-                    key: cut_quantile(value, q_min=q_min, q_max=q_max)
-                    for key, value in marker_dict.items()
-                },
-                True,
-            )
-            * 65535
-        ).astype(np.uint16)
-
-        # cut quantile: 0.00-0.90
-        q_min = 0.00
-        q_max = 0.90
-        marker_name = f"({q_min:.2f},{q_max:.2f}) {tag}"
-        marker_sum_dict[marker_name] = (
-            scale_marker_sum(
-                markers,
-                {
-                    key: cut_quantile(value, q_min=q_min, q_max=q_max)
-                    for key, value in marker_dict.items()
-                },
-                True,
-            )
-            * 65535
-        ).astype(np.uint16)
-
-    return marker_sum_dict
 
+dir_src = Path(__file__).resolve().parent.parent
+sys.path.append(str(dir_src))
+from src.export import remove_output
+from src.expression import DerivedChannels, get_combination_expressions
+from src.ngff import NgffReader, is_ngff
 
 # %%
 
@@ -97,6 +25,8 @@ markers_list = [
     ["CD45", "CD3e", "CD163", "CD45RO", "NaKATP"],
     ["CD45", "CD3e", "CD163", "CD45RO", "NaKATP", "HLA1"],
 ]
+# (q_min, q_max) of the combined channels of every group
+quantiles = [(0.00, 1.00), (0.00, 0.99), (0.00, 0.90)]
 all_markers = [marker for markers in markers_list for marker in markers]
 all_markers = pd.Series(all_markers).unique()
 
@@ -114,25 +44,37 @@ dir_output = Path(
     "/mnt/nfs/home/wenruiwu/projects/bidmc-jiang-rcc/output/data/05_marker_ometiff_combination"
 )
 dir_output.mkdir(parents=True, exist_ok=True)
+# ".ome.tiff" or ".ome.zarr" (chunked OME-Zarr)
+extension_input = ".ome.tiff"
+extension_output = ".ome.tiff"
+# Compression, e.g. {"compression": "zstd", "predictor": True, "n_encode_threads": 8}
+encoding = None
+# Threads evaluating the combined channels tile by tile
+n_workers = 4
 
 for id in tqdm(id_list, desc="Generating ome.tiff"):
-    # Load markers dictionary
-    path_ometiff = dir_id / f"{id}/{id}.ome.tiff"
-    marker_dict = load_tiff_to_dict(
-        path_ometiff,
-        "ome.tiff",
-        channels_order=all_markers,
+    # Load markers dictionary, OME-Zarr stores are read tile by tile instead
+    path_ometiff = dir_id / f"{id}/{id}{extension_input}"
+    if is_ngff(path_ometiff):
+        sources = NgffReader(path_ometiff)
+    else:
+        sources = load_tiff_to_dict(
+            path_ometiff,
+            "ome.tiff",
+            channels_order=all_markers,
+        )
+
+    # Export ome.tiff with the markers as they are, then the combined markers,
+    # computed tile by tile while the output is written, with quantiles from
+    # the histogram sidecar of the input when it has one
+    channels = {marker: marker for marker in all_markers}
+    channels.update(get_combination_expressions(markers_list, quantiles))
+    path_output = dir_output / f"{id}{extension_output}"
+    remove_output(path_output)
+    derived = DerivedChannels(
+        sources, channels, load_histograms(path_ometiff), n_workers=n_workers
     )
-
-    # Combine markers and update markers dictionary
-    marker_sum_dict = combine_markers(marker_dict, markers_list)
-    marker_dict.update(marker_sum_dict)
-
-    # Export ome.tiff
-    path_output = dir_output / f"{id}.ome.tiff"
-    if path_output.exists():
-        os.remove(path_output)
-    export_ometiff_pyramid_from_dict(marker_dict, str(path_output))
+    derived.export(path_output, encoding)
 
 
 # %%
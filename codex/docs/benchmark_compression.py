@@ -0,0 +1,143 @@
+import io
+import time
+
+import numpy as np
+import pandas as pd
+import tifffile
+from chalign.ometiff import get_compression_kwargs, is_compression_available
+
+
+def sample_tiles(
+    paths_tiff: list[str], n_tiles: int, tile_size: int, seed: int = 0
+) -> np.ndarray:
+    """
+    Sample random tiles from the first page of each image
+
+    Returns
+    -------
+    np.ndarray
+        Tiles of shape (n_images * n_tiles, tile_size, tile_size).
+    """
+    rng = np.random.default_rng(seed)
+    tiles = []
+    for path in paths_tiff:
+        with tifffile.TiffFile(path) as tif:
+            img = tif.pages[0].asarray()
+        for _ in range(n_tiles):
+            y = rng.integers(0, max(1, img.shape[0] - tile_size))
+            x = rng.integers(0, max(1, img.shape[1] - tile_size))
+            tiles.append(img[y : y + tile_size, x : x + tile_size])
+    return np.stack(tiles)
+
+
+def benchmark_compression(
+    tiles: np.ndarray,
+    configs: list[tuple[str, int, bool]],
+    n_threads: int = 8,
+    n_repeats: int = 3,
+) -> pd.DataFrame:
+    """
+    Encode and decode throughput and compression ratio of each configuration
+
+    Tiles are written as one tiled TIFF in memory, with tiles encoded and
+    decoded on `n_threads` threads, so I/O does not enter the timings. The
+    best of `n_repeats` runs is kept.
+
+    Parameters
+    ----------
+    tiles : np.ndarray
+        Tiles of shape (n, tile_size, tile_size).
+    configs : list[tuple[str, int, bool]]
+        Compression, level (None for the codec default) and predictor.
+    n_threads : int, optional
+        Number of encoding and decoding threads, by default 8.
+    n_repeats : int, optional
+        Number of runs of each configuration, by default 3.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per available configuration.
+        - Columns: ["compression", "level", "predictor", "ratio",
+          "encode_mb_s", "decode_mb_s"]
+    """
+    raw_mb = tiles.nbytes / 2**20
+    tile_shape = tiles.shape[1:]
+    results = []
+    for compression, level, predictor in configs:
+        if not is_compression_available(compression):
+            print(f"Skip {compression}: codec not available (install imagecodecs)")
+            continue
+        kwargs = get_compression_kwargs(compression, level, predictor)
+
+        encode_s, decode_s = np.inf, np.inf
+        for _ in range(n_repeats):
+            buffer = io.BytesIO()
+            start = time.perf_counter()
+            tifffile.imwrite(
+                buffer,
+                tiles,
+                tile=tile_shape,
+                photometric="minisblack",
+                maxworkers=n_threads,
+                **kwargs,
+            )
+            encode_s = min(encode_s, time.perf_counter() - start)
+
+            buffer.seek(0)
+            start = time.perf_counter()
+            decoded = tifffile.imread(buffer, maxworkers=n_threads)
+            decode_s = min(decode_s, time.perf_counter() - start)
+        if not np.array_equal(decoded, tiles):
+            raise ValueError(f"{compression} is not lossless")
+
+        results.append(
+            {
+                "compression": compression,
+                "level": level,
+                "predictor": predictor,
+                "ratio": tiles.nbytes / buffer.getbuffer().nbytes,
+                "encode_mb_s": raw_mb / encode_s,
+                "decode_mb_s": raw_mb / decode_s,
+            }
+        )
+        print(results[-1])
+    return pd.DataFrame(results)
+
+
+################################################################################
+# sample images, e.g. a few Keyence channels of one region
+paths_tiff = [
+    "/mnt/nfs/storage/RCC/RCC_formal_CODEX/RCC_TMA001-run1/reg_4x5/images/final/reg001/reg001_cyc001_ch001_DAPI.tif",
+    "/mnt/nfs/storage/RCC/RCC_formal_CODEX/RCC_TMA001-run1/reg_4x5/images/final/reg001/reg001_cyc002_ch002_CD45.tif",
+]
+
+# output file
+path_output = "/mnt/nfs/storage/wenruiwu_temp/pipeline/benchmark_compression.csv"
+
+n_tiles = 32  # tiles per image
+tile_size = 512
+n_threads = 8
+
+# (compression, level, predictor)
+configs = [
+    ("none", None, False),
+    ("zlib", 1, False),
+    ("zlib", 6, False),
+    ("zlib", 6, True),
+    ("zlib", 9, True),
+    ("zstd", 1, True),
+    ("zstd", 5, True),
+    ("zstd", 19, True),
+    ("lzw", None, False),
+    ("lzw", None, True),
+    ("lzma", None, True),
+    ("jpegxl", 3, False),
+    ("jpegxl", 7, False),
+]
+################################################################################
+
+tiles = sample_tiles(paths_tiff, n_tiles, tile_size)
+df_benchmark = benchmark_compression(tiles, configs, n_threads=n_threads)
+print(df_benchmark.to_string(index=False))
+df_benchmark.to_csv(path_output, index=False)
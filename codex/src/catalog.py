@@ -0,0 +1,302 @@
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import Optional, Union
+
+import pandas as pd
+import tifffile
+
+from pycodex.cls import MarkerMetadata
+
+CATALOG_VERSION = 1
+DEFAULT_CACHE_DIR = Path.home() / ".cache" / "codex" / "keyence_catalog"
+
+
+class KeyenceCatalog:
+    def __init__(
+        self,
+        dir_root: Union[str, Path],
+        records: dict[str, list[dict]],
+        unique_markers: list[str],
+        dir_mtimes: dict[str, int],
+    ):
+        """
+        Catalog of the images of a Keyence run: region -> marker -> path,
+        shape and dtype.
+
+        Use `KeyenceCatalog.load` to reuse the catalog saved by a previous run
+        when the directory tree did not change.
+
+        Parameters
+        ----------
+        dir_root : Union[str, Path]
+            Root directory of the organized images of the Keyence data.
+        records : dict[str, list[dict]]
+            Images of each region, with "marker", "path", "shape" and "dtype".
+        unique_markers : list[str]
+            List of unique markers across regions.
+        dir_mtimes : dict[str, int]
+            Modification time in nanoseconds of every scanned directory.
+        """
+        self.dir_root = Path(dir_root)
+        self.records = records
+        self.unique_markers = unique_markers
+        self.dir_mtimes = dir_mtimes
+
+        self.regions = list(records)
+        self.metadata = {
+            region: pd.DataFrame(
+                region_records, columns=["marker", "path", "shape", "dtype"]
+            )
+            for region, region_records in records.items()
+        }
+        self._index = {
+            region: {record["marker"]: record for record in region_records}
+            for region, region_records in records.items()
+        }
+
+    @classmethod
+    def scan(
+        cls, dir_root: Union[str, Path], region_dirs: Optional[list[str]] = None
+    ) -> "KeyenceCatalog":
+        """
+        Build the catalog by scanning the directory tree with `MarkerMetadata`
+        and reading the header of every image
+
+        Parameters
+        ----------
+        dir_root : Union[str, Path]
+            Root directory of the organized images of the Keyence data.
+        region_dirs : list[str], optional
+            Names of the region directories to scan. If None, the whole tree
+            is scanned. Otherwise `MarkerMetadata` runs on a temporary root
+            linking the images of these directories only.
+        """
+        dir_root = Path(dir_root)
+        if region_dirs is None:
+            return cls._scan(dir_root, dir_root)
+        with tempfile.TemporaryDirectory() as dir_scan:
+            for region_dir in region_dirs:
+                dir_link = Path(dir_scan) / region_dir
+                dir_link.mkdir()
+                for path in (dir_root / region_dir).iterdir():
+                    (dir_link / path.name).symlink_to(path)
+            return cls._scan(dir_root, Path(dir_scan))
+
+    @classmethod
+    def _scan(cls, dir_root: Path, dir_scan: Path) -> "KeyenceCatalog":
+        """
+        Scan `dir_scan`, a root laid out like `dir_root`, and record the paths
+        of the images under `dir_root`
+        """
+        metadatas = MarkerMetadata(dir_scan)
+        metadatas.organize_metadata(platform="keyence", subfolders=True)
+        metadatas.summary_metadata()
+
+        records = {}
+        dirs = {dir_root} | {
+            dir_root / d.name for d in dir_scan.iterdir() if d.is_dir()
+        }
+        for region in metadatas.regions:
+            metadata_region = metadatas.metadata[region]
+            records[region] = []
+            markers, paths = metadata_region["marker"], metadata_region["path"]
+            for marker, path in zip(markers, paths):
+                path = Path(path)
+                if dir_scan in path.parents:
+                    path = dir_root / path.relative_to(dir_scan)
+                with tifffile.TiffFile(path) as tif:
+                    page = tif.pages[0]
+                    shape, dtype = list(page.shape), str(page.dtype)
+                records[region].append(
+                    {
+                        "marker": marker,
+                        "path": str(path),
+                        "shape": shape,
+                        "dtype": dtype,
+                    }
+                )
+                dirs.add(path.parent)
+
+        dir_mtimes = {str(d): os.stat(d).st_mtime_ns for d in sorted(dirs)}
+        return cls(dir_root, records, list(metadatas.unique_markers), dir_mtimes)
+
+    @classmethod
+    def load(
+        cls,
+        dir_root: Union[str, Path],
+        cache_dir: Optional[Union[str, Path]] = DEFAULT_CACHE_DIR,
+    ) -> "KeyenceCatalog":
+        """
+        Load the saved catalog of a directory tree, rescanning only the region
+        directories modified, added or removed since it was saved
+
+        Parameters
+        ----------
+        dir_root : Union[str, Path]
+            Root directory of the organized images of the Keyence data.
+        cache_dir : Union[str, Path], optional
+            Directory of saved catalogs, by default
+            ~/.cache/codex/keyence_catalog. If None, the tree is always scanned
+            and nothing is saved.
+        """
+        dir_root = Path(dir_root).resolve()
+        if cache_dir is None:
+            return cls.scan(dir_root)
+
+        key = hashlib.blake2b(str(dir_root).encode(), digest_size=16).hexdigest()
+        path_catalog = Path(cache_dir) / f"{key}.json"
+        catalog = None
+        if path_catalog.exists():
+            try:
+                catalog = cls.read(path_catalog)
+            except (ValueError, KeyError):
+                catalog = None
+        if catalog is not None:
+            changed, removed = catalog.get_changed_region_dirs()
+            if not changed and not removed:
+                return catalog
+            print(f"Keyence region directories changed: {changed + removed}")
+            catalog = catalog.update(changed, removed)
+        else:
+            catalog = cls.scan(dir_root)
+        catalog.write(path_catalog)
+        return catalog
+
+    def _get_region_dir(self, path: Union[str, Path]) -> Optional[str]:
+        """Name of the region directory under the root containing a path"""
+        try:
+            parts = Path(path).relative_to(self.dir_root).parts
+        except ValueError:
+            return None
+        return parts[0] if parts else None
+
+    def get_changed_region_dirs(self) -> tuple[list[str], list[str]]:
+        """
+        Region directories changed since the scan, by comparing modification
+        times
+
+        Returns
+        -------
+        tuple[list[str], list[str]]
+            Names of the modified or added region directories, and of the
+            removed ones.
+        """
+        changed, removed, is_root_changed = set(), set(), False
+        for d, mtime in self.dir_mtimes.items():
+            region_dir = self._get_region_dir(d)
+            try:
+                if os.stat(d).st_mtime_ns == mtime:
+                    continue
+            except FileNotFoundError:
+                if Path(d).parent == self.dir_root:
+                    removed.add(region_dir)
+                    continue
+            if region_dir is None:
+                is_root_changed = True
+            else:
+                changed.add(region_dir)
+
+        # Entries of the root only change with its modification time
+        if is_root_changed:
+            known = {self._get_region_dir(d) for d in self.dir_mtimes}
+            changed.update(
+                d.name
+                for d in self.dir_root.iterdir()
+                if d.is_dir() and d.name not in known
+            )
+        return sorted(changed - removed), sorted(removed)
+
+    def update(self, changed: list[str], removed: list[str]) -> "KeyenceCatalog":
+        """
+        Catalog with the regions of the `changed` directories rescanned and
+        those of the `removed` directories dropped, the others kept as is
+        """
+        dirs_rescanned = set(changed) | set(removed)
+        scanned = KeyenceCatalog.scan(self.dir_root, changed) if changed else None
+
+        def is_kept(region_records):
+            return not any(
+                self._get_region_dir(record["path"]) in dirs_rescanned
+                for record in region_records
+            )
+
+        records = {
+            region: region_records
+            for region, region_records in self.records.items()
+            if is_kept(region_records)
+        }
+        dir_mtimes = {
+            d: mtime
+            for d, mtime in self.dir_mtimes.items()
+            if self._get_region_dir(d) not in dirs_rescanned
+        }
+        dir_mtimes[str(self.dir_root)] = os.stat(self.dir_root).st_mtime_ns
+
+        # Markers listed by MarkerMetadata, from the scan of each region
+        markers = {
+            record["marker"]
+            for region_records in records.values()
+            for record in region_records
+        } & set(self.unique_markers)
+        if scanned is not None:
+            records.update(scanned.records)
+            dir_mtimes.update(scanned.dir_mtimes)
+            markers |= {
+                record["marker"]
+                for region_records in scanned.records.values()
+                for record in region_records
+            } & set(scanned.unique_markers)
+        return KeyenceCatalog(
+            self.dir_root, dict(sorted(records.items())), sorted(markers), dir_mtimes
+        )
+
+    def get_path(self, region: str, marker: str) -> str:
+        """
+        Path of the image of a marker in a region
+
+        Raises
+        ------
+        KeyError
+            If the region or the marker is not in the catalog.
+        """
+        try:
+            return self._index[region][marker]["path"]
+        except KeyError:
+            raise KeyError(f"Marker {marker} not found in region {region}") from None
+
+    def write(self, path: Union[str, Path]):
+        """
+        Save the catalog to a JSON file, replaced atomically
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        content = {
+            "version": CATALOG_VERSION,
+            "dir_root": str(self.dir_root),
+            "records": self.records,
+            "unique_markers": self.unique_markers,
+            "dir_mtimes": self.dir_mtimes,
+        }
+        path_tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        with open(path_tmp, "w") as f:
+            json.dump(content, f)
+        os.replace(path_tmp, path)
+
+    @classmethod
+    def read(cls, path: Union[str, Path]) -> "KeyenceCatalog":
+        """
+        Read a catalog saved with `KeyenceCatalog.write`
+        """
+        with open(path) as f:
+            content = json.load(f)
+        if content.get("version") != CATALOG_VERSION:
+            raise ValueError(f"Unsupported catalog version in {path}")
+        return cls(
+            content["dir_root"],
+            content["records"],
+            content["unique_markers"],
+            content["dir_mtimes"],
+        )
@@ -0,0 +1,172 @@
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+from chalign.histogram import (
+    ChannelHistograms,
+    is_histogram_dtype,
+    quantile_from_counts,
+)
+from tqdm import tqdm
+
+# (q_min, q_max) of every combined channel of a marker group
+DEFAULT_QUANTILES = [(0.00, 1.00), (0.00, 0.99), (0.00, 0.90)]
+
+
+class QuantileCache:
+    def __init__(
+        self,
+        marker_dict: dict[str, np.ndarray],
+        histograms: Optional[ChannelHistograms] = None,
+    ):
+        """
+        Quantiles of the channels of one image, computed once per channel
+        and reused by every marker group and quantile setting.
+
+        Channels of uint8 or uint16 data are reduced once to a histogram by
+        `np.bincount`, from which any quantile is exact and costs a lookup;
+        other channels fall back to `np.quantile`, cached per quantile.
+
+        Parameters
+        ----------
+        marker_dict : dict[str, np.ndarray]
+            Image of each channel, keyed by marker name.
+        histograms : ChannelHistograms, optional
+            Histograms saved with the image (see `load_histograms`). Their
+            channels are not read again.
+        """
+        self.marker_dict = marker_dict
+        self.histograms = histograms
+        self._counts = {}
+        self._quantiles = {}
+
+    def get_counts(self, marker: str) -> Optional[np.ndarray]:
+        """
+        Histogram of a uint8 or uint16 channel, None for other dtypes
+        """
+        if marker not in self._counts:
+            if self.histograms is not None and marker in self.histograms:
+                self._counts[marker] = self.histograms.get_counts(marker)
+            elif is_histogram_dtype(self.marker_dict[marker].dtype):
+                img = self.marker_dict[marker]
+                minlength = np.iinfo(img.dtype).max + 1
+                self._counts[marker] = np.bincount(img.ravel(), minlength=minlength)
+            else:
+                self._counts[marker] = None
+        return self._counts[marker]
+
+    def get(self, marker: str, q: float) -> float:
+        """
+        Quantile `q` of a channel, identical to `np.quantile(img, q)`
+        """
+        key = (marker, q)
+        if key not in self._quantiles:
+            counts = self.get_counts(marker)
+            if counts is not None:
+                self._quantiles[key] = quantile_from_counts(counts, q)
+            else:
+                self._quantiles[key] = float(np.quantile(self.marker_dict[marker], q))
+        return self._quantiles[key]
+
+
+def scale_marker_sum_quantile(
+    markers: list[str],
+    marker_dict: dict[str, np.ndarray],
+    q_min: float,
+    q_max: float,
+    cache: Optional[QuantileCache] = None,
+) -> np.ndarray:
+    """
+    Sum of quantile-clipped markers, each scaled to [0, 1], scaled to [0, 1]
+
+    Equivalent to `scale_marker_sum(markers, {k: cut_quantile(v, q_min,
+    q_max)}, True)` with the quantiles taken from the cache, and only the
+    markers of the group are clipped. A clipped marker spans its two
+    quantiles, so it is scaled by them without another pass for its minimum
+    and maximum.
+
+    Parameters
+    ----------
+    markers : list[str]
+        Markers to combine.
+    marker_dict : dict[str, np.ndarray]
+        Image of each channel, keyed by marker name.
+    q_min, q_max : float
+        Quantiles the markers are clipped to.
+    cache : QuantileCache, optional
+        Quantiles of the channels of `marker_dict`. If None, a new cache is
+        used for this call only.
+
+    Returns
+    -------
+    np.ndarray
+        Combined marker in [0, 1] (float64).
+    """
+    if cache is None:
+        cache = QuantileCache(marker_dict)
+    marker_sum = np.zeros(marker_dict[markers[0]].shape, dtype=np.float64)
+    buffer = np.empty_like(marker_sum)
+    for marker in markers:
+        lo, hi = cache.get(marker, q_min), cache.get(marker, q_max)
+        if hi <= lo:
+            continue
+        np.clip(marker_dict[marker], lo, hi, out=buffer)
+        buffer -= lo
+        buffer /= hi - lo
+        marker_sum += buffer
+
+    lo, hi = marker_sum.min(), marker_sum.max()
+    marker_sum -= lo
+    if hi > lo:
+        marker_sum /= hi - lo
+    return marker_sum
+
+
+def combine_markers(
+    marker_dict: dict[str, np.ndarray],
+    markers_list: list[list[str]],
+    quantiles: list[tuple[float, float]] = DEFAULT_QUANTILES,
+    cache: Optional[QuantileCache] = None,
+) -> OrderedDict:
+    """
+    Combine markers from different channels into one channel, for every
+    marker group and quantile setting.
+
+    Quantiles are computed once per channel (see `QuantileCache`) and only
+    the channels of a group are clipped. Every combined channel is held in
+    memory; `get_combination_expressions` computes the same channels tile by
+    tile while they are exported.
+
+    Parameters
+    ----------
+    marker_dict : dict[str, np.ndarray]
+        Dictionary of markers, with keys as marker names and values as marker
+        arrays.
+    markers_list : list[list[str]]
+        List of markers to be combined.
+    quantiles : list[tuple[float, float]], optional
+        Quantiles (q_min, q_max) markers are clipped to, one combined channel
+        each, by default (0, 1), (0, 0.99) and (0, 0.90).
+    cache : QuantileCache, optional
+        Quantiles of the channels of `marker_dict`, e.g. shared with other
+        calls on the same image. If None, a new cache is used.
+
+    Returns
+    -------
+    OrderedDict
+        Dictionary of combined markers (uint16), named
+        "({q_min:.2f},{q_max:.2f}) {markers joined by ','}".
+    """
+    if cache is None:
+        cache = QuantileCache(marker_dict)
+    marker_sum_dict = OrderedDict()
+    for markers in tqdm(markers_list, desc="Combining markers"):
+        tag = ",".join(markers)
+        for q_min, q_max in quantiles:
+            marker_sum = scale_marker_sum_quantile(
+                markers, marker_dict, q_min, q_max, cache
+            )
+            marker_sum *= 65535
+            marker_name = f"({q_min:.2f},{q_max:.2f}) {tag}"
+            marker_sum_dict[marker_name] = marker_sum.astype(np.uint16)
+    return marker_sum_dict
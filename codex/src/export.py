@@ -0,0 +1,353 @@
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+import tifffile
+from chalign.histogram import ChannelHistograms, get_histogram_path, is_histogram_dtype
+from chalign.ometiff import TiffWindowReader, is_ngff, write_ometiff_pyramid_tiled
+from pyqupath.ometiff import export_ometiff_pyramid_from_dict
+
+from .ngff import write_ngff_from_dict, write_ngff_from_tiffs
+
+OUTPUT_EXTENSIONS = {"ometiff": ".ome.tiff", "zarr": ".ome.zarr"}
+
+
+def write_ometiff_pyramid(
+    im_dict: dict[str, np.ndarray],
+    path_ometiff: Union[str, Path],
+    tile_size: int = 512,
+    compression: str = "zlib",
+    compression_level: Optional[int] = None,
+    predictor: bool = False,
+    n_encode_threads: Optional[int] = None,
+):
+    """
+    Write in-memory channels to a pyramidal OME-TIFF with a chosen codec,
+    compressing tiles on a pool of threads.
+
+    Parameters
+    ----------
+    im_dict : dict[str, np.ndarray]
+        2D image of each channel, keyed by channel name. All images must have
+        the same shape and dtype.
+    path_ometiff : Union[str, Path]
+        Path to the output OME-TIFF file.
+    tile_size : int, optional
+        Tile size in pixels, by default 512.
+    compression : str, optional
+        Tile compression, by default "zlib". See
+        `chalign.ometiff.get_compression_kwargs`.
+    compression_level : int, optional
+        Compression level. If None, the codec default.
+    predictor : bool, optional
+        Whether to apply horizontal differencing before compression, by
+        default False.
+    n_encode_threads : int, optional
+        Number of threads compressing tiles. If None, tifffile decides from
+        the codec and the tile size.
+    """
+    images = list(im_dict.values())
+    shapes = {im.shape for im in images}
+    dtypes = {im.dtype for im in images}
+    if len(shapes) != 1 or len(dtypes) != 1:
+        raise ValueError(f"Channels differ in shape {shapes} or dtype {dtypes}")
+    write_ometiff_pyramid_tiled(
+        path_ometiff,
+        shape=shapes.pop(),
+        dtype=dtypes.pop(),
+        channel_names=list(im_dict),
+        tile_fn=lambda c, y0, y1, x0, x1: images[c][y0:y1, x0:x1],
+        tile_size=tile_size,
+        compression=compression,
+        compression_level=compression_level,
+        predictor=predictor,
+        n_encode_threads=n_encode_threads,
+    )
+
+
+def write_ometiff_from_tiffs(
+    paths_tiff: list[str],
+    path_ometiff: Union[str, Path],
+    channel_names: list[str],
+    tile_size: int = 512,
+    compression: str = "zlib",
+    compression_level: Optional[int] = None,
+    predictor: bool = False,
+    n_encode_threads: Optional[int] = None,
+    histograms: Optional[ChannelHistograms] = None,
+):
+    """
+    Stream single-channel TIFF files into a pyramidal OME-TIFF, the tiled
+    counterpart of `export_ometiff_pyramid`.
+
+    Every tile is read from its input only when it is written, so peak memory
+    is a few tiles rather than the whole region.
+
+    Parameters
+    ----------
+    paths_tiff : list[str]
+        Paths to the input TIFF files, in channel order.
+    path_ometiff : Union[str, Path]
+        Path to the output OME-TIFF file.
+    channel_names : list[str]
+        List of channel names.
+    tile_size : int, optional
+        Tile size in pixels, by default 512.
+    compression : str, optional
+        Tile compression, by default "zlib". See
+        `chalign.ometiff.get_compression_kwargs`.
+    compression_level : int, optional
+        Compression level. If None, the codec default.
+    predictor : bool, optional
+        Whether to apply horizontal differencing before compression, by
+        default False.
+    n_encode_threads : int, optional
+        Number of threads compressing tiles. If None, tifffile decides from
+        the codec and the tile size.
+    histograms : ChannelHistograms, optional
+        Histograms of `channel_names`, to which every level 0 tile is added as
+        it is written.
+    """
+    if len(paths_tiff) != len(channel_names):
+        raise ValueError("Number of TIFF files and channel names differ")
+    readers = [TiffWindowReader(path) for path in paths_tiff]
+    try:
+        shapes = {tuple(reader.shape) for reader in readers}
+        dtypes = {reader.dtype for reader in readers}
+        if len(shapes) != 1 or len(dtypes) != 1:
+            raise ValueError(f"Channels differ in shape {shapes} or dtype {dtypes}")
+
+        def tile_fn(c, y0, y1, x0, x1):
+            return readers[c].read(y0, y1, x0, x1)
+
+        if histograms is not None:
+            tile_fn = histograms.wrap(tile_fn)
+        write_ometiff_pyramid_tiled(
+            path_ometiff,
+            shape=shapes.pop(),
+            dtype=dtypes.pop(),
+            channel_names=channel_names,
+            tile_fn=tile_fn,
+            tile_size=tile_size,
+            compression=compression,
+            compression_level=compression_level,
+            predictor=predictor,
+            n_encode_threads=n_encode_threads,
+        )
+    finally:
+        for reader in readers:
+            reader.close()
+
+
+def _get_ngff_encoding(encoding: Optional[dict]) -> dict:
+    """Keywords of `encoding` understood by the OME-Zarr writer"""
+    encoding = encoding or {}
+    return {
+        key: encoding[key]
+        for key in ["compression", "compression_level"]
+        if key in encoding
+    }
+
+
+def export_pyramid_from_dict(
+    im_dict: dict[str, np.ndarray],
+    path: Union[str, Path],
+    encoding: Optional[dict] = None,
+):
+    """
+    Write in-memory channels with the writer of the output path: an OME-Zarr
+    store if it ends in ".zarr", a pyramidal OME-TIFF otherwise.
+
+    Parameters
+    ----------
+    im_dict : dict[str, np.ndarray]
+        2D image of each channel, keyed by channel name.
+    path : Union[str, Path]
+        Path to the output OME-TIFF file or OME-Zarr store.
+    encoding : dict, optional
+        Compression keywords of `write_ometiff_pyramid`, e.g.
+        {"compression": "zstd", "compression_level": 5, "predictor": True,
+        "n_encode_threads": 8}. OME-Zarr stores only use "compression" and
+        "compression_level". If None, OME-TIFF files are written by pyqupath
+        as before.
+    """
+    if is_ngff(path):
+        write_ngff_from_dict(im_dict, path, **_get_ngff_encoding(encoding))
+    elif encoding is None:
+        export_ometiff_pyramid_from_dict(im_dict, str(path))
+    else:
+        write_ometiff_pyramid(im_dict, path, **encoding)
+
+
+def get_fingerprint(
+    paths_tiff: list[str],
+    channel_names: list[str],
+    encoding: Optional[dict] = None,
+) -> str:
+    """
+    Fingerprint of an OME-TIFF export, from the path, size and modification
+    time of every input, the channel order and names, and the compression.
+
+    Parameters
+    ----------
+    paths_tiff : list[str]
+        Paths to the input TIFF files, in channel order.
+    channel_names : list[str]
+        List of channel names.
+    encoding : dict, optional
+        Compression keywords of the export, see `export_pyramid_from_dict`.
+
+    Returns
+    -------
+    str
+        Hexadecimal digest.
+    """
+    inputs = []
+    for path in paths_tiff:
+        stat = os.stat(path)
+        inputs.append([str(Path(path).resolve()), stat.st_size, stat.st_mtime_ns])
+    content = {"inputs": inputs, "channel_names": list(channel_names)}
+    if encoding is not None:
+        content["encoding"] = encoding
+    content = json.dumps(content, sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def _get_fingerprint_path(path_ometiff: Path) -> Path:
+    return path_ometiff.with_name(f".{path_ometiff.name}.fingerprint")
+
+
+def is_up_to_date(
+    path_ometiff: Union[str, Path],
+    paths_tiff: list[str],
+    channel_names: list[str],
+    encoding: Optional[dict] = None,
+) -> bool:
+    """
+    Whether an OME-TIFF exists and was exported from the same inputs with the
+    same compression
+    """
+    path_ometiff = Path(path_ometiff)
+    path_fingerprint = _get_fingerprint_path(path_ometiff)
+    if not (path_ometiff.exists() and path_fingerprint.exists()):
+        return False
+    fingerprint = get_fingerprint(paths_tiff, channel_names, encoding)
+    return path_fingerprint.read_text() == fingerprint
+
+
+def remove_output(path: Union[str, Path]):
+    """
+    Remove an output file or OME-Zarr store if it exists
+    """
+    path = Path(path)
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(path)
+    elif path.exists() or path.is_symlink():
+        os.remove(path)
+
+
+def replace_output(path_tmp: Union[str, Path], path: Union[str, Path]):
+    """
+    Move a complete output file or OME-Zarr store into place. A store cannot
+    replace a directory atomically, so an existing store is removed first.
+    """
+    if Path(path).is_dir():
+        remove_output(path)
+    os.replace(path_tmp, path)
+
+
+def export_ometiff_atomic(
+    paths_tiff: list[str],
+    path_ometiff: Union[str, Path],
+    channel_names: list[str],
+    overwrite: bool = False,
+    encoding: Optional[dict] = None,
+    histogram: bool = True,
+) -> bool:
+    """
+    Export a pyramidal OME-TIFF unless it is up to date, writing to a
+    temporary file renamed into place once complete. Paths ending in ".zarr"
+    are exported as chunked OME-Zarr stores instead.
+
+    OME-TIFF files are streamed tile by tile by `write_ometiff_from_tiffs`.
+    The intensity histogram of every channel is counted in the same pass, from
+    the tiles as they are written or the channels loaded by the OME-Zarr
+    writer, and saved next to the output (see `ChannelHistograms`), so later
+    quantiles need no pass over pixels.
+
+    A crash never leaves a partial file under the final name. The fingerprint
+    of the inputs is stored next to the output (hidden file ending in
+    ".fingerprint") and written after the output, so an interrupted export is
+    redone on the next run.
+
+    Parameters
+    ----------
+    paths_tiff : list[str]
+        Paths to the input TIFF files, in channel order.
+    path_ometiff : Union[str, Path]
+        Path to the output OME-TIFF file or OME-Zarr store.
+    channel_names : list[str]
+        List of channel names.
+    overwrite : bool, optional
+        Whether to export even if the output is up to date, by default False.
+    encoding : dict, optional
+        Compression keywords, see `export_pyramid_from_dict`. If None, the
+        defaults of the output format.
+    histogram : bool, optional
+        Whether to save the histogram sidecar of uint8 and uint16 channels, by
+        default True. An up-to-date output without one is exported again.
+
+    Returns
+    -------
+    bool
+        True if the OME-TIFF was exported, False if it was skipped.
+    """
+    path_ometiff = Path(path_ometiff)
+    fingerprint = get_fingerprint(paths_tiff, channel_names, encoding)
+    path_fingerprint = _get_fingerprint_path(path_ometiff)
+    path_histogram = get_histogram_path(path_ometiff)
+    if histogram:
+        with tifffile.TiffFile(paths_tiff[0]) as tif:
+            histogram = is_histogram_dtype(tif.pages[0].dtype)
+    if (
+        not overwrite
+        and is_up_to_date(path_ometiff, paths_tiff, channel_names, encoding)
+        and (not histogram or path_histogram.exists())
+    ):
+        return False
+
+    histograms = ChannelHistograms(channel_names) if histogram else None
+    path_tmp = path_ometiff.with_name(f".{os.getpid()}.tmp.{path_ometiff.name}")
+    try:
+        if is_ngff(path_ometiff):
+            write_ngff_from_tiffs(
+                paths_tiff,
+                path_tmp,
+                channel_names,
+                histograms=histograms,
+                **_get_ngff_encoding(encoding),
+            )
+        else:
+            write_ometiff_from_tiffs(
+                paths_tiff,
+                path_tmp,
+                channel_names,
+                histograms=histograms,
+                **(encoding or {}),
+            )
+        replace_output(path_tmp, path_ometiff)
+    finally:
+        remove_output(path_tmp)
+    if histogram:
+        histograms.save(path_histogram)
+
+    path_fingerprint_tmp = path_fingerprint.with_name(
+        f"{path_fingerprint.name}.{os.getpid()}.tmp"
+    )
+    path_fingerprint_tmp.write_text(fingerprint)
+    os.replace(path_fingerprint_tmp, path_fingerprint)
+    return True
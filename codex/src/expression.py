@@ -0,0 +1,367 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Optional, Union
+
+import numpy as np
+from chalign.histogram import ChannelHistograms, get_histogram_path
+from chalign.ometiff import write_pyramid_tiled
+
+from .combination import DEFAULT_QUANTILES, QuantileCache
+from .ngff import NgffReader
+
+
+class Expression:
+    """
+    Derived channel computed pixel by pixel from source channels.
+
+    Expressions are evaluated on one tile at a time into a float64 buffer of
+    the tile shape, with in-place NumPy operations, so no full-size image is
+    ever allocated. Expressions are only evaluated on level 0 tiles, the
+    pyramid writer subsamples the next levels from them.
+    """
+
+    def get_children(self) -> list["Expression"]:
+        """Sub-expressions"""
+        return []
+
+    def get_markers(self) -> set[str]:
+        """Source channels the expression reads"""
+        return set().union(*(child.get_markers() for child in self.get_children()))
+
+    def evaluate(self, read: Callable[[str], np.ndarray], out: np.ndarray):
+        """
+        Evaluate the expression on one tile
+
+        Parameters
+        ----------
+        read : Callable[[str], np.ndarray]
+            Function returning the tile of a source channel.
+        out : np.ndarray
+            Float64 buffer of the tile shape, overwritten with the result.
+        """
+        raise NotImplementedError
+
+
+class Marker(Expression):
+    def __init__(self, marker: str):
+        """Source channel, unscaled"""
+        self.marker = marker
+
+    def get_markers(self) -> set[str]:
+        return {self.marker}
+
+    def evaluate(self, read, out):
+        np.copyto(out, read(self.marker), casting="unsafe")
+
+
+class QuantileClip(Expression):
+    def __init__(self, marker: str, q_min: float = 0.0, q_max: float = 1.0):
+        """
+        Source channel clipped to its quantiles `q_min` and `q_max` and scaled
+        to [0, 1], like `cut_quantile` followed by min-max scaling. A channel
+        whose two quantiles are equal is 0.
+        """
+        self.marker = marker
+        self.q_min = q_min
+        self.q_max = q_max
+        self.lo = self.hi = None
+
+    def get_markers(self) -> set[str]:
+        return {self.marker}
+
+    def fit(self, cache: QuantileCache):
+        """Look up the quantiles of the channel"""
+        self.lo = cache.get(self.marker, self.q_min)
+        self.hi = cache.get(self.marker, self.q_max)
+
+    def evaluate(self, read, out):
+        if self.hi <= self.lo:
+            out.fill(0)
+            return
+        np.clip(read(self.marker), self.lo, self.hi, out=out)
+        out -= self.lo
+        out /= self.hi - self.lo
+
+
+class Sum(Expression):
+    def __init__(self, terms: list[Expression], weights: Optional[list[float]] = None):
+        """
+        Sum of expressions, weighted by `weights` if given (weighted mix)
+        """
+        if weights is not None and len(weights) != len(terms):
+            raise ValueError("Number of terms and weights differ")
+        self.terms = list(terms)
+        self.weights = weights
+
+    def get_children(self):
+        return self.terms
+
+    def evaluate(self, read, out):
+        weights = self.weights or [1] * len(self.terms)
+        buffer = np.empty_like(out)
+        out.fill(0)
+        for term, weight in zip(self.terms, weights):
+            term.evaluate(read, buffer)
+            if weight != 1:
+                buffer *= weight
+            out += buffer
+
+
+class Max(Expression):
+    def __init__(self, terms: list[Expression]):
+        """Pixel-wise maximum of expressions"""
+        self.terms = list(terms)
+
+    def get_children(self):
+        return self.terms
+
+    def evaluate(self, read, out):
+        self.terms[0].evaluate(read, out)
+        buffer = np.empty_like(out)
+        for term in self.terms[1:]:
+            term.evaluate(read, buffer)
+            np.maximum(out, buffer, out=out)
+
+
+class Normalize(Expression):
+    def __init__(self, term: Expression):
+        """
+        Expression scaled to [0, 1] by its minimum and maximum over the whole
+        image, found by a pass over the tiles before the export
+        """
+        self.term = term
+        self.lo = self.hi = None
+
+    def get_children(self):
+        return [self.term]
+
+    def evaluate(self, read, out):
+        self.term.evaluate(read, out)
+        out -= self.lo
+        if self.hi > self.lo:
+            out /= self.hi - self.lo
+
+
+def get_combination_expressions(
+    markers_list: list[list[str]],
+    quantiles: list[tuple[float, float]] = DEFAULT_QUANTILES,
+) -> dict[str, Expression]:
+    """
+    Expressions of the channels of `combine_markers`, with the same names:
+    the sum of the quantile-clipped markers of a group scaled to [0, 1], for
+    every marker group and quantile setting. Written by `DerivedChannels`,
+    they give the same pixels without holding the combined channels in
+    memory.
+    """
+    return {
+        f"({q_min:.2f},{q_max:.2f}) {','.join(markers)}": Normalize(
+            Sum([QuantileClip(marker, q_min, q_max) for marker in markers])
+        )
+        for markers in markers_list
+        for q_min, q_max in quantiles
+    }
+
+
+def _iter_nodes(expression: Expression):
+    """Nodes of an expression, children before their parent"""
+    for child in expression.get_children():
+        yield from _iter_nodes(child)
+    yield expression
+
+
+class DerivedChannels:
+    def __init__(
+        self,
+        sources: Union[dict[str, np.ndarray], NgffReader],
+        channels: dict[str, Union[str, Expression]],
+        histograms: Optional[ChannelHistograms] = None,
+        tile_size: int = 512,
+        n_workers: int = 4,
+    ):
+        """
+        Output channels declared as source channels or expressions over them,
+        evaluated lazily, tile by tile, while the output pyramid is written.
+
+        Memory does not grow with the number of derived channels: each one
+        only exists as the tiles being written. Quantiles of the sources come
+        from their histograms, and the range of `Normalize` expressions from
+        a pass over the tiles before the export.
+
+        Parameters
+        ----------
+        sources : Union[dict[str, np.ndarray], NgffReader]
+            Source channels, in memory keyed by marker name, or read chunk by
+            chunk from an OME-Zarr store.
+        channels : dict[str, Union[str, Expression]]
+            Output channels in order, keyed by output name: the name of a
+            source channel, copied as is, or an expression in [0, 1], written
+            as `expression * 65535`. The output is uint16.
+        histograms : ChannelHistograms, optional
+            Histograms of the sources (see `load_histograms`). Sources without
+            one are reduced to a histogram first.
+        tile_size : int, optional
+            Tile size in pixels, by default 512.
+        n_workers : int, optional
+            Number of threads evaluating tiles, by default 4.
+        """
+        self.sources = sources
+        self.channels = dict(channels)
+        self.histograms = histograms
+        self.tile_size = tile_size
+        self.n_workers = n_workers
+        if isinstance(sources, NgffReader):
+            self.shape = tuple(sources.shape)
+        else:
+            shapes = {im.shape for im in sources.values()}
+            if len(shapes) != 1:
+                raise ValueError(f"Source channels differ in shape: {shapes}")
+            self.shape = shapes.pop()
+        self._fitted = False
+
+    def read_source(self, marker: str, y0: int, y1: int, x0: int, x1: int):
+        """
+        Read the level 0 window [y0:y1, x0:x1] of a source channel
+        """
+        if not isinstance(self.sources, NgffReader):
+            return self.sources[marker][y0:y1, x0:x1]
+        return self.sources.read(marker, y0, y1, x0, x1)
+
+    def _get_reader(self, y0, y1, x0, x1) -> Callable[[str], np.ndarray]:
+        """Read function of one tile, reading every source channel once"""
+        tiles = {}
+
+        def read(marker):
+            if marker not in tiles:
+                tiles[marker] = self.read_source(marker, y0, y1, x0, x1)
+            return tiles[marker]
+
+        return read
+
+    def _map_windows(self, fn: Callable) -> list:
+        """Apply `fn(y0, y1, x0, x1)` to every level 0 tile"""
+        height, width = self.shape
+        windows = [
+            (y0, min(height, y0 + self.tile_size), x0, min(width, x0 + self.tile_size))
+            for y0 in range(0, height, self.tile_size)
+            for x0 in range(0, width, self.tile_size)
+        ]
+        with ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+            return list(executor.map(lambda window: fn(*window), windows))
+
+    def fit(self):
+        """
+        Resolve the quantiles and ranges the expressions need
+        """
+        expressions = [
+            expression
+            for expression in self.channels.values()
+            if isinstance(expression, Expression)
+        ]
+        nodes = [node for expression in expressions for node in _iter_nodes(expression)]
+
+        # Quantiles from the histograms of the sources
+        clips = [node for node in nodes if isinstance(node, QuantileClip)]
+        markers = sorted({clip.marker for clip in clips})
+        histograms = self.histograms
+        if isinstance(self.sources, NgffReader):
+            missing = [m for m in markers if histograms is None or m not in histograms]
+            if missing:
+                computed = ChannelHistograms(missing)
+
+                def add_tiles(y0, y1, x0, x1):
+                    for marker in missing:
+                        computed.add(marker, self.read_source(marker, y0, y1, x0, x1))
+
+                self._map_windows(add_tiles)
+                counts = [
+                    (computed if m in computed else histograms).get_counts(m)
+                    for m in markers
+                ]
+                histograms = ChannelHistograms(markers, np.stack(counts))
+            cache = QuantileCache({}, histograms)
+        else:
+            cache = QuantileCache(self.sources, histograms)
+        for clip in clips:
+            clip.fit(cache)
+
+        # Ranges of Normalize nodes, inner ones before the nodes containing them
+        pending = [node for node in nodes if isinstance(node, Normalize)]
+        while pending:
+            ready = [
+                node
+                for node in pending
+                if not any(
+                    inner in pending
+                    for inner in _iter_nodes(node.term)
+                    if isinstance(inner, Normalize)
+                )
+            ]
+
+            def get_range(y0, y1, x0, x1):
+                read = self._get_reader(y0, y1, x0, x1)
+                out = np.empty((y1 - y0, x1 - x0), dtype=np.float64)
+                ranges = []
+                for node in ready:
+                    node.term.evaluate(read, out)
+                    ranges.append((out.min(), out.max()))
+                return ranges
+
+            ranges = np.array(self._map_windows(get_range))
+            for i, node in enumerate(ready):
+                node.lo, node.hi = ranges[:, i, 0].min(), ranges[:, i, 1].max()
+            pending = [node for node in pending if node not in ready]
+        self._fitted = True
+
+    def tile_fn(self, c: int, y0: int, y1: int, x0: int, x1: int):
+        """
+        Level 0 tile of output channel `c`, see `write_pyramid_tiled`
+        """
+        expression = list(self.channels.values())[c]
+        if isinstance(expression, str):
+            tile = self.read_source(expression, y0, y1, x0, x1)
+            return tile.astype(np.uint16, copy=False)
+        read = self._get_reader(y0, y1, x0, x1)
+        out = np.empty((y1 - y0, x1 - x0), dtype=np.float64)
+        expression.evaluate(read, out)
+        out *= 65535
+        return out.astype(np.uint16)
+
+    def export(
+        self,
+        path: Union[str, Path],
+        encoding: Optional[dict] = None,
+        histogram: bool = True,
+    ):
+        """
+        Write the output channels to a pyramidal OME-TIFF, or an OME-Zarr
+        store if the path ends in ".zarr"
+
+        Parameters
+        ----------
+        path : Union[str, Path]
+            Path to the output.
+        encoding : dict, optional
+            Compression keywords, see `export_pyramid_from_dict`.
+        histogram : bool, optional
+            Whether to save the histogram sidecar of the output, counted from
+            the level 0 tiles as they are written, by default True.
+        """
+        if not self._fitted:
+            self.fit()
+        channel_names = list(self.channels)
+        tile_fn = self.tile_fn
+        if histogram:
+            histograms = ChannelHistograms(channel_names)
+            tile_fn = histograms.wrap(tile_fn)
+        write_pyramid_tiled(
+            path,
+            shape=self.shape,
+            dtype=np.uint16,
+            channel_names=channel_names,
+            tile_fn=tile_fn,
+            tile_size=self.tile_size,
+            n_workers=self.n_workers,
+            **(encoding or {}),
+        )
+        if histogram:
+            histograms.save(get_histogram_path(path))
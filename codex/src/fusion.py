@@ -0,0 +1,361 @@
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+import pandas as pd
+import tifffile
+from chalign.histogram import ChannelHistograms, get_histogram_path, is_histogram_dtype
+from chalign.ometiff import TiffWindowReader
+from tqdm import tqdm
+
+from .export import (
+    OUTPUT_EXTENSIONS,
+    export_pyramid_from_dict,
+    remove_output,
+    replace_output,
+)
+
+
+def read_markerlist(path_markerlist: Union[str, Path]) -> list[str]:
+    """
+    Read the channel names of a QPTIFF from its MarkerList.txt, one per line
+    """
+    with open(path_markerlist) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def get_geojson_bboxes(
+    path_geojson: Union[str, Path],
+) -> list[tuple[str, tuple[int, int, int, int]]]:
+    """
+    Name and bounding box of every region of a QuPath GeoJSON file
+
+    Parameters
+    ----------
+    path_geojson : Union[str, Path]
+        Path to the GeoJSON file.
+
+    Returns
+    -------
+    list[tuple[str, tuple[int, int, int, int]]]
+        Region name and bounding box (y0, y1, x0, x1) in pixels, in file order.
+        Regions without a name are named after their index. Regions are
+        cropped to these boxes as is: pixels inside the box but outside the
+        region polygon are kept, not masked.
+    """
+    with open(path_geojson) as f:
+        geojson = json.load(f)
+    features = geojson["features"] if "features" in geojson else geojson
+
+    bboxes = []
+    for i, feature in enumerate(features):
+        properties = feature.get("properties") or {}
+        name = properties.get("name")
+        if name is None:
+            name = (properties.get("classification") or {}).get("name", str(i))
+        xy = np.array(_flatten_coordinates(feature["geometry"]["coordinates"]))
+        x0, y0 = np.floor(xy.min(axis=0)).astype(int)
+        x1, y1 = np.ceil(xy.max(axis=0)).astype(int)
+        bboxes.append((name, (int(y0), int(y1), int(x0), int(x1))))
+    return bboxes
+
+
+def _flatten_coordinates(coordinates) -> list:
+    """Flatten nested GeoJSON coordinates into a list of (x, y) points"""
+    if len(coordinates) > 0 and isinstance(coordinates[0], (int, float)):
+        return [coordinates[:2]]
+    return [point for c in coordinates for point in _flatten_coordinates(c)]
+
+
+class QptiffReader:
+    def __init__(
+        self,
+        path_qptiff: Union[str, Path],
+        channel_names: Optional[list[str]] = None,
+    ):
+        """
+        Read windows of channels of a QPTIFF lazily, decoding only the tiles
+        that intersect the window.
+
+        Parameters
+        ----------
+        path_qptiff : Union[str, Path]
+            Path to the QPTIFF file, whose first series holds one full
+            resolution page per channel.
+        channel_names : list[str], optional
+            Name of each channel in page order (e.g. from MarkerList.txt). If
+            None, channels are named by index.
+        """
+        self.path = Path(path_qptiff)
+        self.tif = tifffile.TiffFile(self.path)
+        # Each region is read once, so decoded segments are not cached
+        self.readers = [
+            TiffWindowReader(page, cache_bytes=0) for page in self.tif.series[0].pages
+        ]
+        if channel_names is None:
+            channel_names = [str(i) for i in range(len(self.readers))]
+        if len(channel_names) != len(self.readers):
+            raise ValueError(
+                f"{len(channel_names)} channel names for {len(self.readers)} channels"
+            )
+        self.channel_names = list(channel_names)
+        self._channel_index = {name: i for i, name in enumerate(self.channel_names)}
+        self.shape = self.readers[0].shape
+        self.dtype = self.readers[0].dtype
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        for reader in self.readers:
+            reader.close()
+        self.tif.close()
+
+    def read(self, channel: str, y0: int, y1: int, x0: int, x1: int) -> np.ndarray:
+        """
+        Read the window [y0:y1, x0:x1] of a channel, clipped to the image
+
+        Parameters
+        ----------
+        channel : str
+            Channel name.
+        y0, y1, x0, x1 : int
+            Window bounds in full resolution pixels.
+
+        Returns
+        -------
+        np.ndarray
+            Window of the channel.
+        """
+        reader = self.readers[self._channel_index[channel]]
+        h, w = self.shape
+        y0, y1 = max(0, y0), min(h, y1)
+        x0, x1 = max(0, x0), min(w, x1)
+        if y0 >= y1 or x0 >= x1:
+            return np.zeros((max(0, y1 - y0), max(0, x1 - x0)), dtype=self.dtype)
+        return reader.read(y0, y1, x0, x1)
+
+    def read_dict(
+        self,
+        bbox: tuple[int, int, int, int],
+        channels_order: list[str],
+        channels_rename: Optional[list[str]] = None,
+    ) -> dict[str, np.ndarray]:
+        """
+        Read the bounding box (y0, y1, x0, x1) of the selected channels
+
+        Returns
+        -------
+        dict[str, np.ndarray]
+            Window of each channel in `channels_order`, keyed by its new name
+            if `channels_rename` is given.
+        """
+        if channels_rename is None:
+            channels_rename = channels_order
+        if len(channels_rename) != len(channels_order):
+            raise ValueError("Number of channels and new channel names differ")
+        return {
+            rename: self.read(channel, *bbox)
+            for channel, rename in zip(channels_order, channels_rename)
+        }
+
+
+def crop_region_ometiff(
+    reader: QptiffReader,
+    name: str,
+    bbox: tuple[int, int, int, int],
+    path_ometiff: Union[str, Path],
+    channels_order: list[str],
+    channels_rename: Optional[list[str]] = None,
+    encoding: Optional[dict] = None,
+):
+    """
+    Crop one region of a QPTIFF into a pyramidal OME-TIFF, reading only its
+    bounding box. The file is written under a temporary name and renamed
+    into place once complete. Paths ending in ".zarr" are written as chunked
+    OME-Zarr stores instead. `encoding` selects the compression, see
+    `export_pyramid_from_dict`. The histogram of each uint8 or uint16 channel
+    is saved next to the output from the cropped channels in memory.
+    """
+    path_ometiff = Path(path_ometiff)
+    path_ometiff.parent.mkdir(parents=True, exist_ok=True)
+    im_dict = reader.read_dict(bbox, channels_order, channels_rename)
+    path_tmp = path_ometiff.with_name(f".{os.getpid()}.tmp.{path_ometiff.name}")
+    try:
+        export_pyramid_from_dict(im_dict, path_tmp, encoding)
+        replace_output(path_tmp, path_ometiff)
+    finally:
+        remove_output(path_tmp)
+    if all(is_histogram_dtype(im.dtype) for im in im_dict.values()):
+        ChannelHistograms.from_dict(im_dict).save(get_histogram_path(path_ometiff))
+    print(f"Cropped {path_ometiff.name} for: {name}")
+
+
+# QPTIFF reader of each worker process, opened once by `_init_worker`
+_reader = None
+
+
+def _init_worker(path_qptiff: str, channel_names: list[str]):
+    """
+    Open the QPTIFF once per worker process. Workers read the file directly,
+    sharing the OS page cache, rather than receiving pickled image arrays.
+    """
+    global _reader
+    _reader = QptiffReader(path_qptiff, channel_names)
+
+
+def _crop_region_with_retry(
+    name: str,
+    bbox: tuple[int, int, int, int],
+    path_ometiff: str,
+    channels_order: list[str],
+    channels_rename: Optional[list[str]],
+    n_retries: int,
+    encoding: Optional[dict] = None,
+) -> dict:
+    """
+    Crop one region with the reader of the worker, retrying on failure and
+    returning its status instead of raising
+    """
+    start = time.perf_counter()
+    for attempt in range(n_retries + 1):
+        try:
+            crop_region_ometiff(
+                _reader,
+                name,
+                bbox,
+                path_ometiff,
+                channels_order,
+                channels_rename,
+                encoding,
+            )
+            status, error = "success", ""
+            break
+        except Exception:
+            status, error = "failed", traceback.format_exc()
+            print(f"Failed to crop OME-TIFF for: {name} (attempt {attempt + 1})")
+    return {
+        "region": name,
+        "status": status,
+        "error": error,
+        "attempts": attempt + 1,
+        "path_ometiff": path_ometiff,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def preprocess_fusion(
+    dir_root: Union[str, Path],
+    dir_output: Union[str, Path],
+    channels_order: list[str],
+    channels_rename: Optional[list[str]] = None,
+    n_workers: int = 1,
+    n_retries: int = 1,
+    output_format: str = "ometiff",
+    encoding: Optional[dict] = None,
+) -> pd.DataFrame:
+    """
+    Crop the regions of a Fusion QPTIFF into one OME-TIFF per region.
+
+    The input directory holds one QPTIFF file, its MarkerList.txt and the
+    regions in cropping_regions.geojson. Regions are cropped to their bounding
+    box, reading only the tiles they need, and exported on a pool of worker
+    processes. Each worker opens the QPTIFF itself, so the slide is never
+    loaded or copied as a whole.
+
+    Parameters
+    ----------
+    dir_root : Union[str, Path]
+        Input directory.
+    dir_output : Union[str, Path]
+        Output directory, with one subdirectory per region.
+    channels_order : list[str]
+        Channels to export, in order.
+    channels_rename : list[str], optional
+        New channel names, in the same order as `channels_order`. If None,
+        the channels are not renamed.
+    n_workers : int, optional
+        Number of regions exported concurrently, by default 1. Each worker
+        holds one region in memory.
+    n_retries : int, optional
+        Number of times a failed region is retried, by default 1.
+    output_format : str, optional
+        Output format, "ometiff" (pyramidal OME-TIFF) or "zarr" (chunked
+        OME-Zarr), by default "ometiff".
+    encoding : dict, optional
+        Compression keywords, e.g. {"compression": "zstd",
+        "compression_level": 5, "n_encode_threads": 4}. See
+        `export_pyramid_from_dict`. If None, the defaults of the output
+        format.
+
+    Returns
+    -------
+    pd.DataFrame
+        Summary with one row per region.
+        - Columns: ["region", "status", "error", "attempts", "path_ometiff",
+          "seconds"]
+    """
+    dir_root = Path(dir_root)
+    dir_output = Path(dir_output)
+    if output_format not in OUTPUT_EXTENSIONS:
+        raise ValueError(f"Unknown output format: {output_format}")
+    extension = OUTPUT_EXTENSIONS[output_format]
+
+    # parse the dir_root
+    path_markerlist = dir_root / "MarkerList.txt"
+    path_geojson = dir_root / "cropping_regions.geojson"
+    paths_qptiff = list(dir_root.glob("*.qptiff"))
+    if len(paths_qptiff) == 1:
+        path_qptiff = paths_qptiff[0]
+    else:
+        raise ValueError("There should be only one qptiff file in the directory")
+    channel_names = read_markerlist(path_markerlist)
+
+    jobs = [
+        (
+            name,
+            bbox,
+            str(dir_output / name / f"{name}{extension}"),
+            channels_order,
+            channels_rename,
+            n_retries,
+            encoding,
+        )
+        for name, bbox in get_geojson_bboxes(path_geojson)
+    ]
+
+    # crop QPTIFF file into multiple OME-TIFF files
+    if n_workers <= 1:
+        _init_worker(str(path_qptiff), channel_names)
+        try:
+            results = [_crop_region_with_retry(*job) for job in tqdm(jobs)]
+        finally:
+            _reader.close()
+    else:
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            initializer=_init_worker,
+            initargs=(str(path_qptiff), channel_names),
+        ) as executor:
+            futures = [executor.submit(_crop_region_with_retry, *job) for job in jobs]
+            results = [
+                future.result()
+                for future in tqdm(as_completed(futures), total=len(futures))
+            ]
+
+    df_summary = pd.DataFrame(results)
+    df_summary = df_summary.set_index("region").loc[[job[0] for job in jobs]]
+    df_summary = df_summary.reset_index()
+    print(
+        f"Cropped {(df_summary.status == 'success').sum()}"
+        f"/{df_summary.shape[0]} regions"
+    )
+    return df_summary
@@ -0,0 +1,246 @@
+import threading
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+import tifffile
+from chalign.histogram import ChannelHistograms
+from chalign.ometiff import is_ngff, write_ngff_pyramid_tiled
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+
+def _require_zarr():
+    if zarr is None:
+        raise ImportError("OME-Zarr support requires zarr: pip install 'zarr<3'")
+
+
+def write_ngff_from_dict(
+    im_dict: dict[str, np.ndarray],
+    path_zarr: Union[str, Path],
+    tile_size: int = 512,
+    compression: str = "zstd",
+    compression_level: Optional[int] = None,
+    n_workers: int = 4,
+):
+    """
+    Write in-memory channels to a multiscale OME-Zarr store, the counterpart
+    of `export_ometiff_pyramid_from_dict`.
+
+    Parameters
+    ----------
+    im_dict : dict[str, np.ndarray]
+        2D image of each channel, keyed by channel name. All images must have
+        the same shape and dtype.
+    path_zarr : Union[str, Path]
+        Path to the output store, a directory ending in ".zarr".
+    tile_size : int, optional
+        Tile and chunk size in pixels, by default 512.
+    compression : str, optional
+        Blosc compressor of the chunks, by default "zstd".
+    compression_level : int, optional
+        Compression level from 1 to 9, by default 5.
+    n_workers : int, optional
+        Number of threads writing tiles, by default 4.
+    """
+    images = list(im_dict.values())
+    shapes = {im.shape for im in images}
+    dtypes = {im.dtype for im in images}
+    if len(shapes) != 1 or len(dtypes) != 1:
+        raise ValueError(f"Channels differ in shape {shapes} or dtype {dtypes}")
+    write_ngff_pyramid_tiled(
+        path_zarr,
+        shape=shapes.pop(),
+        dtype=dtypes.pop(),
+        channel_names=list(im_dict),
+        tile_fn=lambda c, y0, y1, x0, x1: images[c][y0:y1, x0:x1],
+        tile_size=tile_size,
+        compression=compression,
+        compression_level=compression_level,
+        n_workers=n_workers,
+    )
+
+
+def write_ngff_from_tiffs(
+    paths_tiff: list[str],
+    path_zarr: Union[str, Path],
+    channel_names: list[str],
+    tile_size: int = 512,
+    compression: str = "zstd",
+    compression_level: Optional[int] = None,
+    n_workers: int = 4,
+    histograms: Optional[ChannelHistograms] = None,
+):
+    """
+    Write single-channel TIFF files to a multiscale OME-Zarr store, the
+    counterpart of `export_ometiff_pyramid`.
+
+    Channels are loaded and written one at a time, so peak memory is a single
+    channel rather than the whole region.
+
+    Parameters
+    ----------
+    paths_tiff : list[str]
+        Paths to the input TIFF files, in channel order.
+    path_zarr : Union[str, Path]
+        Path to the output store, a directory ending in ".zarr".
+    channel_names : list[str]
+        List of channel names.
+    tile_size : int, optional
+        Tile and chunk size in pixels, by default 512.
+    compression : str, optional
+        Blosc compressor of the chunks, by default "zstd".
+    compression_level : int, optional
+        Compression level from 1 to 9, by default 5.
+    n_workers : int, optional
+        Number of threads reading and writing tiles, by default 4.
+    histograms : ChannelHistograms, optional
+        Histograms of `channel_names`, to which each channel is added when it
+        is loaded.
+    """
+    if len(paths_tiff) != len(channel_names):
+        raise ValueError("Number of TIFF files and channel names differ")
+    shapes, dtypes = set(), set()
+    for path in paths_tiff:
+        with tifffile.TiffFile(path) as tif:
+            shapes.add(tuple(tif.pages[0].shape))
+            dtypes.add(tif.pages[0].dtype)
+    if len(shapes) != 1 or len(dtypes) != 1:
+        raise ValueError(f"Channels differ in shape {shapes} or dtype {dtypes}")
+    shape = shapes.pop()
+    if len(shape) != 2:
+        raise ValueError(f"Expected single-channel 2D images, got {shape}")
+
+    # Channels are written one after the other, keep only the current one
+    cache, lock = {}, threading.Lock()
+
+    def tile_fn(c, y0, y1, x0, x1):
+        with lock:
+            if c not in cache:
+                cache.clear()
+                cache[c] = tifffile.imread(paths_tiff[c])
+                if histograms is not None:
+                    histograms.add(c, cache[c])
+            image = cache[c]
+        return image[y0:y1, x0:x1]
+
+    write_ngff_pyramid_tiled(
+        path_zarr,
+        shape=shape,
+        dtype=dtypes.pop(),
+        channel_names=channel_names,
+        tile_fn=tile_fn,
+        tile_size=tile_size,
+        compression=compression,
+        compression_level=compression_level,
+        n_workers=n_workers,
+    )
+
+
+class NgffReader:
+    def __init__(self, path_zarr: Union[str, Path]):
+        """
+        Random access to the tiles and pyramid levels of a multiscale
+        OME-Zarr store, decoding only the chunks a window intersects.
+
+        Parameters
+        ----------
+        path_zarr : Union[str, Path]
+            Path to a store written by `write_ngff_pyramid_tiled` or any
+            OME-NGFF 0.4 image with axes (c, y, x).
+        """
+        _require_zarr()
+        self.path = Path(path_zarr)
+        self.root = zarr.open_group(str(self.path), mode="r")
+        multiscales = self.root.attrs["multiscales"][0]
+        self.levels = [self.root[d["path"]] for d in multiscales["datasets"]]
+        n_channels = self.levels[0].shape[0]
+        channels = self.root.attrs.get("omero", {}).get("channels", [])
+        if len(channels) == n_channels:
+            self.channel_names = [
+                channel.get("label", str(i)) for i, channel in enumerate(channels)
+            ]
+        else:
+            self.channel_names = [str(i) for i in range(n_channels)]
+        self._channel_index = {name: i for i, name in enumerate(self.channel_names)}
+        self.shape = self.levels[0].shape[-2:]
+        self.dtype = self.levels[0].dtype
+
+    @property
+    def n_levels(self) -> int:
+        return len(self.levels)
+
+    def get_level_shape(self, level: int) -> tuple[int, int]:
+        """Shape (height, width) of a pyramid level"""
+        return self.levels[level].shape[-2:]
+
+    def read(
+        self,
+        channel: Union[str, int],
+        y0: int = 0,
+        y1: Optional[int] = None,
+        x0: int = 0,
+        x1: Optional[int] = None,
+        level: int = 0,
+    ) -> np.ndarray:
+        """
+        Read the window [y0:y1, x0:x1] of a channel at a pyramid level,
+        clipped to the image
+
+        Parameters
+        ----------
+        channel : Union[str, int]
+            Channel name or index.
+        y0, y1, x0, x1 : int, optional
+            Window bounds in pixels of the level. By default the whole level.
+        level : int, optional
+            Pyramid level, by default 0 (full resolution).
+
+        Returns
+        -------
+        np.ndarray
+            Window of the channel.
+        """
+        c = channel if isinstance(channel, int) else self._channel_index[channel]
+        return self.levels[level][c, y0:y1, x0:x1]
+
+    def iter_tiles(self, channel: Union[str, int], level: int = 0):
+        """
+        Iterate over the chunks of a channel at a pyramid level
+
+        Yields
+        ------
+        tuple[int, int, np.ndarray]
+            Top left corner (y, x) of the tile in pixels of the level, and the
+            tile.
+        """
+        height, width = self.get_level_shape(level)
+        tile_h, tile_w = self.levels[level].chunks[-2:]
+        for y in range(0, height, tile_h):
+            for x in range(0, width, tile_w):
+                yield y, x, self.read(channel, y, y + tile_h, x, x + tile_w, level)
+
+    def read_dict(
+        self, channels: Optional[list[str]] = None, level: int = 0
+    ) -> dict[str, np.ndarray]:
+        """
+        Read whole channels at a pyramid level, like `load_tiff_to_dict`
+
+        Parameters
+        ----------
+        channels : list[str], optional
+            Channels to read, in order. If None, all channels are read.
+        level : int, optional
+            Pyramid level, by default 0 (full resolution).
+
+        Returns
+        -------
+        dict[str, np.ndarray]
+            Image of each channel, keyed by channel name.
+        """
+        if channels is None:
+            channels = self.channel_names
+        return {channel: self.read(channel, level=level) for channel in channels}
@@ -1,16 +1,110 @@
-import os
 import re
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
+from typing import Optional
 
+import matplotlib.pyplot as plt
 import pandas as pd
-from pyqupath.ometiff import export_ometiff_pyramid
 from tqdm import tqdm
 
-from pycodex.cls import MarkerMetadata
+from .catalog import DEFAULT_CACHE_DIR, KeyenceCatalog
+from .export import OUTPUT_EXTENSIONS, export_ometiff_atomic
+from .review import compute_dapi_review, plot_contact_sheet, save_thumbnail, score_dapi
+
+
+def is_dapi(x):
+    """Check if the marker is DAPI"""
+    return re.search(r"^Ch\d+Cy\d+$", x) is not None
+
+
+def _review_dapi(region: str, marker: str, path: str, max_dim_px: int) -> tuple:
+    """Compute the review metrics and thumbnail of one DAPI image"""
+    metrics, thumbnail = compute_dapi_review(path, max_dim_px=max_dim_px)
+    return region, marker, metrics, thumbnail
+
+
+def _export_region_ometiff(
+    region: str,
+    paths_tiff: list[str],
+    path_ometiff: str,
+    channel_names: list[str],
+    overwrite: bool = False,
+    encoding: Optional[dict] = None,
+) -> dict:
+    """
+    Export the OME-TIFF of one region, returning its status instead of raising
+    so that a failed region does not abort the others.
+    """
+    start = time.perf_counter()
+    try:
+        exported = export_ometiff_atomic(
+            paths_tiff=paths_tiff,
+            path_ometiff=path_ometiff,
+            channel_names=channel_names,
+            overwrite=overwrite,
+            encoding=encoding,
+        )
+        status, error = ("success" if exported else "skipped"), ""
+    except Exception:
+        status, error = "failed", traceback.format_exc()
+    return {
+        "region": region,
+        "status": status,
+        "error": error,
+        "path_ometiff": path_ometiff,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def _export_region_isolated(job: tuple) -> dict:
+    """
+    Export one region in its own worker process, so a crash of the process
+    (e.g. killed when out of memory) fails only this region
+    """
+    try:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            return executor.submit(_export_region_ometiff, *job).result()
+    except Exception:
+        return {
+            "region": job[0],
+            "status": "failed",
+            "error": traceback.format_exc(),
+            "path_ometiff": job[2],
+            "seconds": 0.0,
+        }
+
+
+def _export_regions_pool(jobs: list[tuple], n_workers: int) -> list[dict]:
+    """
+    Export regions on a pool of worker processes, returning one status per
+    region even if a worker crashes.
+
+    A crashed worker breaks the whole pool and every region still pending
+    fails with `BrokenProcessPool`, without telling which region crashed.
+    These regions are exported again one at a time, each in its own process,
+    so only the region that crashes again is reported as failed.
+    """
+    results, retry_jobs = [], []
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(_export_region_ometiff, *job): job for job in jobs}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            try:
+                results.append(future.result())
+            except BrokenProcessPool:
+                retry_jobs.append(futures[future])
+
+    if len(retry_jobs) > 0:
+        print(f"Worker pool crashed, retry {len(retry_jobs)} regions one at a time")
+        for job in tqdm(retry_jobs):
+            results.append(_export_region_isolated(job))
+    return results
 
 
 class KeyencePreprocessor:
-    def __init__(self, dir_root):
+    def __init__(self, dir_root, cache_dir=DEFAULT_CACHE_DIR):
         """
         Initialize the Keyence data preprocessing.
 
@@ -18,15 +112,16 @@ class KeyencePreprocessor:
         ----------
         dir_root : str
             Root directory of the organized images of the Keyence data.
+        cache_dir : str, optional
+            Directory of saved image catalogs, by default
+            ~/.cache/codex/keyence_catalog. The directory tree is only scanned
+            again when it changed since the last run. If None, the tree is
+            always scanned.
         """
         self.dir_root = Path(dir_root)
+        self.metadatas = KeyenceCatalog.load(dir_root, cache_dir=cache_dir)
 
-        metadatas = MarkerMetadata(dir_root)
-        metadatas.organize_metadata(platform="keyence", subfolders=True)
-        metadatas.summary_metadata()
-        self.metadatas = metadatas
-
-    def export_dapi_ometiff_and_metadata(self, dir_output):
+    def export_dapi_ometiff_and_metadata(self, dir_output, overwrite=False):
         """
         Export DAPI OME-TIFF and metadata for each region.
 
@@ -34,6 +129,9 @@ class KeyencePreprocessor:
         ----------
         dir_output : str
             Output directory for the DAPI OME-TIFF and metadata.
+        overwrite : bool, optional
+            Whether to export OME-TIFF files whose inputs did not change since
+            the last export, by default False.
         """
         dir_output = Path(dir_output)
         dir_output.mkdir(exist_ok=True, parents=True)
@@ -43,43 +141,150 @@ class KeyencePreprocessor:
         for region in tqdm(self.metadatas.regions):
             print(f"Exporting DAPI OME-TIFF for: {region}")
 
-            def is_dapi(x):
-                """Check if the marker is DAPI"""
-                return re.search(r"^Ch\d+Cy\d+$", x) is not None
-
             metadata_region = self.metadatas.metadata[region]
             idx = metadata_region["marker"].apply(is_dapi)
             paths_dapi = metadata_region["path"][idx].tolist()
             names_dapi = metadata_region["marker"][idx].tolist()
 
             path_ometiff = dir_output_ometiff / f"{region}_dapi.ome.tiff"
-            if path_ometiff.exists():
-                os.remove(path_ometiff)
-            export_ometiff_pyramid(
+            if not export_ometiff_atomic(
                 paths_tiff=paths_dapi,
-                path_ometiff=str(path_ometiff),
+                path_ometiff=path_ometiff,
                 channel_names=names_dapi,
-            )
+                overwrite=overwrite,
+            ):
+                print(f"OME-TIFF is up to date and skip: {region}")
 
         # Export metadata
         df_dapi = pd.DataFrame({"region": self.metadatas.regions, "dapi": ""})
         df_dapi.to_csv(dir_output / "metadata_dapi.csv", index=False)
+        self._write_metadata_marker(dir_output)
 
+    def _write_metadata_marker(self, dir_output: Path):
+        """Write the marker metadata template to fill in"""
         valid_markers = [
             marker for marker in self.metadatas.unique_markers if not is_dapi(marker)
         ]
         df_marker = pd.DataFrame({"marker": valid_markers, "channel_name": ""})
         df_marker.to_csv(dir_output / "metadata_marker.csv", index=False)
 
+    def export_dapi_review_and_metadata(
+        self, dir_output, max_dim_px: int = 1024, n_workers: int = 1
+    ) -> pd.DataFrame:
+        """
+        Export DAPI review thumbnails, quality metrics and metadata for each
+        region, a lightweight alternative to `export_dapi_ometiff_and_metadata`.
+
+        Each DAPI image is read once to compute its thumbnail and metrics
+        (focus, saturation and intensity percentiles, see
+        `compute_dapi_review`). The best scoring cycle of each region is
+        pre-filled in "metadata_dapi.csv".
+
+        Parameters
+        ----------
+        dir_output : str
+            Output directory for the thumbnails, contact sheets and metadata.
+        max_dim_px : int, optional
+            Maximum size of the largest dimension of the thumbnails, by default
+            1024.
+        n_workers : int, optional
+            Number of DAPI images processed concurrently, by default 1. Each
+            worker streams its image one block of rows at a time, so memory per
+            worker is a few blocks of about 1024 full width rows, not a whole
+            image.
+
+        Returns
+        -------
+        pd.DataFrame
+            Metrics of every DAPI cycle, also written to
+            "metadata_dapi_metrics.csv".
+        """
+        dir_output = Path(dir_output)
+        dir_output.mkdir(exist_ok=True, parents=True)
+
+        jobs = []
+        for region in self.metadatas.regions:
+            metadata_region = self.metadatas.metadata[region]
+            idx = metadata_region["marker"].apply(is_dapi)
+            for marker, path in zip(
+                metadata_region["marker"][idx], metadata_region["path"][idx]
+            ):
+                jobs.append((region, marker, str(path), max_dim_px))
+
+        # Metrics and thumbnails of each DAPI image
+        if n_workers <= 1:
+            results = [_review_dapi(*job) for job in tqdm(jobs)]
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                futures = [executor.submit(_review_dapi, *job) for job in jobs]
+                results = [
+                    future.result()
+                    for future in tqdm(as_completed(futures), total=len(futures))
+                ]
+
+        df_metrics = pd.DataFrame(
+            [
+                {"region": region, "dapi": marker, **metrics}
+                for region, marker, metrics, _ in results
+            ]
+        )
+        df_metrics["score"] = score_dapi(df_metrics)
+        df_metrics = df_metrics.sort_values(["region", "dapi"]).reset_index(drop=True)
+        df_metrics.to_csv(dir_output / "metadata_dapi_metrics.csv", index=False)
+
+        # Thumbnails and contact sheet of each region
+        thumbnails = {
+            (region, marker): thumbnail for region, marker, _, thumbnail in results
+        }
+        for region, df_region in df_metrics.groupby("region"):
+            df_region = df_region.set_index("dapi")
+            thumbnails_region = {
+                marker: thumbnails[(region, marker)] for marker in df_region.index
+            }
+            for marker, thumbnail in thumbnails_region.items():
+                save_thumbnail(
+                    thumbnail,
+                    dir_output / "thumbnail" / region / f"{marker}.png",
+                    vmin=df_region.loc[marker, "p1"],
+                    vmax=df_region.loc[marker, "p99"],
+                )
+            fig, _ = plot_contact_sheet(thumbnails_region, df_region)
+            (dir_output / "contact_sheet").mkdir(exist_ok=True, parents=True)
+            fig.savefig(dir_output / "contact_sheet" / f"{region}.png")
+            plt.close(fig)
+
+        # Export metadata with the best cycle of each region
+        best = df_metrics.loc[df_metrics.groupby("region")["score"].idxmax()]
+        best = best.set_index("region")["dapi"]
+        df_dapi = pd.DataFrame(
+            {
+                "region": self.metadatas.regions,
+                "dapi": [best.get(region, "") for region in self.metadatas.regions],
+            }
+        )
+        df_dapi.to_csv(dir_output / "metadata_dapi.csv", index=False)
+        self._write_metadata_marker(dir_output)
+        return df_metrics
+
     def export_ometiff(
         self,
         dir_output: str,
         df_metadata_dapi: pd.DataFrame,
         df_metadata_marker: pd.DataFrame,
-    ):
+        n_workers: int = 1,
+        overwrite: bool = False,
+        output_format: str = "ometiff",
+        encoding: Optional[dict] = None,
+    ) -> pd.DataFrame:
         """
         Export OME-TIFF files for each region based on metadata.
 
+        Regions are independent and can be exported on a pool of processes.
+        A failed region is reported in the summary and does not abort the
+        others, even if its worker process crashes. Regions whose input
+        files, channel order and channel names did not change since the last
+        export are skipped.
+
         Parameters
         ----------
         dir_output : str
@@ -90,8 +295,33 @@ class KeyencePreprocessor:
         df_metadata_marker : pd.DataFrame
             DataFrame containing marker order and corresponding names.
             - Columns: ["marker", "channel_name"]
+        n_workers : int, optional
+            Number of regions exported concurrently, by default 1. Regions are
+            written tile by tile, so each worker holds a few tiles in memory
+            rather than a whole region.
+        overwrite : bool, optional
+            Whether to export regions that are up to date, by default False.
+        output_format : str, optional
+            Output format, by default "ometiff".
+            - "ometiff": one pyramidal OME-TIFF file per region.
+            - "zarr": one chunked OME-Zarr store per region.
+        encoding : dict, optional
+            Compression keywords, e.g. {"compression": "zstd",
+            "compression_level": 5, "predictor": True, "n_encode_threads": 4}.
+            See `export_pyramid_from_dict`. If None, the defaults of the
+            output format. Changing it re-exports the regions.
+
+        Returns
+        -------
+        pd.DataFrame
+            Summary with one row per region.
+            - Columns: ["region", "status", "error", "path_ometiff", "seconds"]
+            - Status: "success", "skipped" or "failed"
         """
         dir_output = Path(dir_output)
+        if output_format not in OUTPUT_EXTENSIONS:
+            raise ValueError(f"Unknown output format: {output_format}")
+        extension = OUTPUT_EXTENSIONS[output_format]
 
         # Channel order and names
         channels_name = df_metadata_marker["marker"].str.strip()
@@ -111,32 +341,57 @@ class KeyencePreprocessor:
             for _, row in df_metadata_dapi.iterrows()
         }
 
-        # Iterate through each region and export OME-TIFF
-        for region, channel_info in tqdm(channels_dict.items()):
-            print(f"Exporting OME-TIFF for: {region}")
-
+        # Parameters for exporting OME-TIFF of each region
+        jobs, results = [], []
+        for region, channel_info in channels_dict.items():
             dir_region = dir_output / region
             dir_region.mkdir(parents=True, exist_ok=True)
+            path_region_ometiff = dir_region / f"{region}{extension}"
 
-            # Extract channel names and renames
-            channels_name = channel_info["channels_name"]
-            channels_rename = channel_info["channels_rename"]
-
-            # Parameters for exporting OME-TIFF
-            region_metadata = self.metadatas.metadata[region]
-            paths_tiff = [
-                region_metadata["path"][
-                    region_metadata["marker"].tolist().index(marker)
+            try:
+                paths_tiff = [
+                    self.metadatas.get_path(region, marker)
+                    for marker in channel_info["channels_name"]
                 ]
-                for marker in channels_name
-            ]
-            path_region_ometiff = dir_region / f"{region}.ome.tiff"
-
-            # Export OME-TIFF
-            if path_region_ometiff.exists():
-                os.remove(path_region_ometiff)
-            export_ometiff_pyramid(
-                paths_tiff=paths_tiff,
-                path_ometiff=str(path_region_ometiff),
-                channel_names=channels_rename,
+            except KeyError:
+                results.append(
+                    {
+                        "region": region,
+                        "status": "failed",
+                        "error": traceback.format_exc(),
+                        "path_ometiff": str(path_region_ometiff),
+                        "seconds": 0.0,
+                    }
+                )
+                continue
+            jobs.append(
+                (
+                    region,
+                    paths_tiff,
+                    str(path_region_ometiff),
+                    channel_info["channels_rename"],
+                    overwrite,
+                    encoding,
+                )
             )
+
+        # Export OME-TIFF of each region
+        if n_workers <= 1:
+            for job in tqdm(jobs):
+                print(f"Exporting OME-TIFF for: {job[0]}")
+                results.append(_export_region_ometiff(*job))
+        else:
+            results.extend(_export_regions_pool(jobs, n_workers))
+
+        # Summary of exported regions
+        df_summary = pd.DataFrame(results)
+        df_summary = df_summary.set_index("region").loc[list(channels_dict)]
+        df_summary = df_summary.reset_index()
+        for _, row in df_summary[df_summary.status == "failed"].iterrows():
+            print(f"Failed to export OME-TIFF for: {row['region']}\n{row['error']}")
+        print(
+            f"Exported {(df_summary.status == 'success').sum()}, skipped "
+            f"{(df_summary.status == 'skipped').sum()} and failed "
+            f"{(df_summary.status == 'failed').sum()} regions"
+        )
+        return df_summary
@@ -0,0 +1,195 @@
+import math
+from pathlib import Path
+from typing import Union
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from chalign.histogram import is_histogram_dtype
+from chalign.ometiff import TiffWindowReader
+
+PERCENTILES = [1, 50, 99, 99.9]
+
+
+def _percentiles_from_counts(counts: np.ndarray, percentiles: list[float]) -> list:
+    """
+    Percentiles (nearest rank) of integer values from their histogram
+    """
+    cdf = np.cumsum(counts)
+    ranks = np.ceil(np.asarray(percentiles) / 100 * cdf[-1]).clip(1, None)
+    return np.searchsorted(cdf, ranks).tolist()
+
+
+def compute_dapi_review(
+    path: Union[str, Path], max_dim_px: int = 1024, block_rows: int = 1024
+) -> tuple[dict, np.ndarray]:
+    """
+    Compute quality metrics and a thumbnail of a DAPI image in a single pass
+
+    The image is read once, one block of rows at a time, decoding only the
+    tiles or strips of that block, so memory stays bounded whatever the image
+    size.
+
+    Parameters
+    ----------
+    path : Union[str, Path]
+        Path to the DAPI TIFF file.
+    max_dim_px : int, optional
+        Maximum size of the largest dimension of the thumbnail, by default
+        1024.
+    block_rows : int, optional
+        Approximate number of rows processed at a time, by default 1024.
+
+    Returns
+    -------
+    tuple[dict, np.ndarray]
+        Metrics and thumbnail (block mean, float32).
+        - focus: variance of the Laplacian, higher is sharper.
+        - focus_norm: focus divided by the squared mean intensity, comparable
+          across cycles of different brightness.
+        - saturation: fraction of pixels at the maximum value of the dtype.
+        - mean, p1, p50, p99, p99.9: intensity statistics.
+    """
+    with TiffWindowReader(path) as reader:
+        h, w = reader.shape
+        dtype = reader.dtype
+        factor = max(1, math.ceil(max(h, w) / max_dim_px))
+        block = factor * max(1, block_rows // factor)
+
+        # Exact percentiles from a histogram for uint8 / uint16 images
+        use_counts = is_histogram_dtype(dtype)
+        counts = np.zeros(2 ** (8 * dtype.itemsize), np.int64) if use_counts else None
+        integer = np.issubdtype(dtype, np.integer)
+        max_value = np.iinfo(dtype).max if integer else None
+
+        thumbnail_rows = []
+        lap_sum, lap_sumsq, lap_n = 0.0, 0.0, 0
+        value_sum, n_saturated = 0.0, 0
+        tail = None
+        for y0 in range(0, h, block):
+            y1 = min(h, y0 + block)
+            tile = reader.read(y0, y1, 0, w)
+
+            ## Thumbnail by block mean
+            th, tw = (y1 - y0) // factor, w // factor
+            if th > 0 and tw > 0:
+                thumbnail_rows.append(
+                    tile[: th * factor, : tw * factor]
+                    .reshape(th, factor, tw, factor)
+                    .mean(axis=(1, 3), dtype=np.float32)
+                )
+
+            ## Laplacian, continued from the last two rows of the previous block
+            ext = tile if tail is None else np.concatenate([tail, tile])
+            tail = ext[-2:].copy()
+            if ext.shape[0] > 2 and w > 2:
+                lap_ext = ext.astype(np.float32)
+                lap = (
+                    lap_ext[:-2, 1:-1]
+                    + lap_ext[2:, 1:-1]
+                    + lap_ext[1:-1, :-2]
+                    + lap_ext[1:-1, 2:]
+                    - 4 * lap_ext[1:-1, 1:-1]
+                )
+                lap_sum += float(lap.sum(dtype=np.float64))
+                lap_sumsq += float(np.square(lap, dtype=np.float64).sum())
+                lap_n += lap.size
+
+            ## Intensity statistics
+            value_sum += float(tile.sum(dtype=np.float64))
+            if integer:
+                n_saturated += int(np.count_nonzero(tile >= max_value))
+            else:
+                # Float images saturate at their running maximum
+                tile_max = tile.max()
+                if max_value is None or tile_max > max_value:
+                    max_value, n_saturated = tile_max, 0
+                n_saturated += int(np.count_nonzero(tile >= max_value))
+            if use_counts:
+                counts += np.bincount(tile.ravel(), minlength=counts.size)
+
+    n = h * w
+    mean = value_sum / n
+    focus = lap_sumsq / max(lap_n, 1) - (lap_sum / max(lap_n, 1)) ** 2
+    thumbnail = np.concatenate(thumbnail_rows, axis=0)
+    if use_counts:
+        percentiles = _percentiles_from_counts(counts, PERCENTILES)
+    else:
+        percentiles = np.percentile(thumbnail, PERCENTILES).tolist()
+
+    metrics = {
+        "focus": focus,
+        "focus_norm": focus / max(mean**2, 1e-12),
+        "saturation": n_saturated / n,
+        "mean": mean,
+        **{f"p{p:g}": v for p, v in zip(PERCENTILES, percentiles)},
+    }
+    return metrics, thumbnail
+
+
+def score_dapi(df_metrics: pd.DataFrame) -> pd.Series:
+    """
+    Score DAPI cycles, higher is better: normalized focus, penalized by the
+    fraction of saturated pixels.
+    """
+    return df_metrics["focus_norm"] * (1 - df_metrics["saturation"])
+
+
+def save_thumbnail(
+    thumbnail: np.ndarray, path: Union[str, Path], vmin: float, vmax: float
+):
+    """
+    Save a thumbnail as a grayscale PNG, contrast stretched to [vmin, vmax]
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    plt.imsave(path, thumbnail, cmap="gray", vmin=vmin, vmax=max(vmax, vmin + 1))
+
+
+def plot_contact_sheet(
+    thumbnails: dict[str, np.ndarray],
+    df_metrics: pd.DataFrame,
+    n_cols: int = 4,
+    w_sub: float = 4,
+    h_sub: float = 4,
+) -> tuple[plt.Figure, np.ndarray]:
+    """
+    Plot the DAPI thumbnails of one region side by side with their metrics
+
+    Parameters
+    ----------
+    thumbnails : dict[str, np.ndarray]
+        Thumbnail of each DAPI cycle.
+    df_metrics : pd.DataFrame
+        Metrics indexed by DAPI cycle, with "score", "focus_norm",
+        "saturation", "p1" and "p99" columns.
+    n_cols : int, optional
+        Number of columns, by default 4.
+    w_sub : float, optional
+        Figure width for each subplot, by default 4.
+    h_sub : float, optional
+        Figure height for each subplot, by default 4.
+
+    Returns
+    -------
+    tuple[plt.Figure, np.ndarray]
+        Figure and Axes objects
+    """
+    n_cols = min(n_cols, len(thumbnails))
+    n_rows = math.ceil(len(thumbnails) / n_cols)
+    fig, axs = plt.subplots(
+        n_rows, n_cols, figsize=(n_cols * w_sub, n_rows * h_sub), squeeze=False
+    )
+    axs = axs.flatten()
+    best = df_metrics["score"].idxmax()
+    for ax, (name, thumbnail) in zip(axs, thumbnails.items()):
+        row = df_metrics.loc[name]
+        ax.imshow(thumbnail, cmap="gray", vmin=row["p1"], vmax=row["p99"])
+        ax.set_title(
+            f"{name}{' (best)' if name == best else ''}\n"
+            f"focus {row['focus_norm']:.3g}, saturated {row['saturation']:.2%}"
+        )
+    for ax in axs:
+        ax.axis("off")
+    plt.tight_layout()
+    return fig, axs
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# codex/src is imported as `src` from the codex directory, as in the docs
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,116 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+import tifffile
+
+pytest.importorskip("pycodex.cls")
+
+from src.catalog import KeyenceCatalog  # noqa: E402
+
+
+def bump_mtime(path):
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+
+def write_image(path, shape=(4, 6)):
+    tifffile.imwrite(path, np.zeros(shape, np.uint16))
+
+
+@pytest.fixture
+def dir_root(tmp_path):
+    dir_root = tmp_path / "keyence"
+    for region, markers in {"reg001": ["CD3", "DAPI"], "reg002": ["CD4"]}.items():
+        (dir_root / region).mkdir(parents=True)
+        for marker in markers:
+            write_image(dir_root / region / f"{marker}.tif")
+    return dir_root.resolve()
+
+
+@pytest.fixture
+def scans(monkeypatch):
+    """Replace the MarkerMetadata scan by one region per directory and one
+    marker per file stem, recording the scanned region directories"""
+    scans = []
+
+    def scan(cls, dir_root, region_dirs=None):
+        scans.append(region_dirs)
+        if region_dirs is None:
+            region_dirs = sorted(d.name for d in dir_root.iterdir() if d.is_dir())
+        records, dir_mtimes = {}, {str(dir_root): os.stat(dir_root).st_mtime_ns}
+        for region_dir in region_dirs:
+            records[region_dir] = [
+                {"marker": f.stem, "path": str(f), "shape": [4, 6], "dtype": "uint16"}
+                for f in sorted((dir_root / region_dir).glob("*.tif"))
+            ]
+            d = dir_root / region_dir
+            dir_mtimes[str(d)] = os.stat(d).st_mtime_ns
+        markers = sorted({r["marker"] for rs in records.values() for r in rs})
+        return cls(dir_root, records, markers, dir_mtimes)
+
+    monkeypatch.setattr(KeyenceCatalog, "scan", classmethod(scan))
+    return scans
+
+
+def test_write_and_read(tmp_path, dir_root):
+    catalog = KeyenceCatalog(
+        dir_root,
+        {"reg001": [{"marker": "CD3", "path": "p", "shape": [4, 6], "dtype": "u2"}]},
+        ["CD3"],
+        {str(dir_root): 1},
+    )
+    catalog.write(tmp_path / "catalog.json")
+    loaded = KeyenceCatalog.read(tmp_path / "catalog.json")
+    assert loaded.records == catalog.records
+    assert loaded.unique_markers == ["CD3"]
+    assert loaded.get_path("reg001", "CD3") == "p"
+    with pytest.raises(KeyError, match="Marker CD4 not found"):
+        loaded.get_path("reg001", "CD4")
+
+    (tmp_path / "catalog.json").write_text('{"version": 0}')
+    with pytest.raises(ValueError, match="Unsupported catalog version"):
+        KeyenceCatalog.read(tmp_path / "catalog.json")
+
+
+def test_load_reuses_the_saved_catalog(tmp_path, dir_root, scans):
+    catalog = KeyenceCatalog.load(dir_root, tmp_path / "cache")
+    assert scans == [None]
+    assert catalog.regions == ["reg001", "reg002"]
+
+    catalog = KeyenceCatalog.load(dir_root, tmp_path / "cache")
+    assert scans == [None]
+    assert catalog.get_path("reg002", "CD4") == str(dir_root / "reg002" / "CD4.tif")
+    assert catalog.unique_markers == ["CD3", "CD4", "DAPI"]
+
+
+def test_load_rescans_only_changed_regions(tmp_path, dir_root, scans):
+    catalog = KeyenceCatalog.load(dir_root, tmp_path / "cache")
+    records_reg001 = catalog.records["reg001"]
+
+    write_image(dir_root / "reg002" / "CD8.tif")
+    bump_mtime(dir_root / "reg002")
+    catalog = KeyenceCatalog.load(dir_root, tmp_path / "cache")
+    assert scans == [None, ["reg002"]]
+    assert catalog.records["reg001"] == records_reg001
+    assert [r["marker"] for r in catalog.records["reg002"]] == ["CD4", "CD8"]
+    assert catalog.unique_markers == ["CD3", "CD4", "CD8", "DAPI"]
+
+    (dir_root / "reg003").mkdir()
+    write_image(dir_root / "reg003" / "CD20.tif")
+    bump_mtime(dir_root)
+    catalog = KeyenceCatalog.load(dir_root, tmp_path / "cache")
+    assert scans[-1] == ["reg003"]
+    assert catalog.regions == ["reg001", "reg002", "reg003"]
+
+    shutil.rmtree(dir_root / "reg001")
+    bump_mtime(dir_root)
+    catalog = KeyenceCatalog.load(dir_root, tmp_path / "cache")
+    assert len(scans) == 3
+    assert catalog.regions == ["reg002", "reg003"]
+    assert catalog.unique_markers == ["CD20", "CD4", "CD8"]
+
+    # The updated catalog is saved
+    assert KeyenceCatalog.load(dir_root, tmp_path / "cache").records == catalog.records
+    assert len(scans) == 3
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("tqdm")
+
+from chalign.histogram import ChannelHistograms  # noqa: E402
+from src.combination import (  # noqa: E402
+    QuantileCache,
+    combine_markers,
+    scale_marker_sum_quantile,
+)
+
+
+@pytest.fixture
+def marker_dict():
+    rng = np.random.default_rng(0)
+    return {
+        "CD3": rng.gamma(2.0, 300.0, (60, 80)).astype(np.uint16),
+        "CD4": rng.integers(0, 256, (60, 80), dtype=np.uint8),
+        "CD8": rng.normal(0.0, 1.0, (60, 80)).astype(np.float32),
+    }
+
+
+@pytest.mark.parametrize("q", [0.0, 0.01, 0.5, 0.9, 0.999, 1.0])
+def test_quantiles_match_numpy(marker_dict, q):
+    cache = QuantileCache(marker_dict)
+    for marker, img in marker_dict.items():
+        assert cache.get(marker, q) == pytest.approx(np.quantile(img, q))
+    assert cache.get_counts("CD8") is None
+
+
+def test_quantiles_from_saved_histograms(marker_dict):
+    histograms = ChannelHistograms(["CD3"])
+    histograms.add("CD3", marker_dict["CD3"])
+    cache = QuantileCache({}, histograms)
+    assert cache.get("CD3", 0.9) == np.quantile(marker_dict["CD3"], 0.9)
+
+
+def test_scale_marker_sum_quantile(marker_dict):
+    markers, q_min, q_max = ["CD3", "CD4"], 0.05, 0.9
+    expected = np.zeros((60, 80))
+    for marker in markers:
+        img = marker_dict[marker].astype(np.float64)
+        lo, hi = np.quantile(img, q_min), np.quantile(img, q_max)
+        expected += (np.clip(img, lo, hi) - lo) / (hi - lo)
+    expected = (expected - expected.min()) / (expected.max() - expected.min())
+
+    cache = QuantileCache(marker_dict)
+    marker_sum = scale_marker_sum_quantile(markers, marker_dict, q_min, q_max, cache)
+    np.testing.assert_allclose(marker_sum, expected)
+
+
+def test_combine_markers_shares_the_cache(marker_dict):
+    cache = QuantileCache(marker_dict)
+    combined = combine_markers(
+        marker_dict, [["CD3", "CD4"], ["CD3"]], [(0.0, 1.0), (0.0, 0.9)], cache
+    )
+    assert list(combined) == [
+        "(0.00,1.00) CD3,CD4",
+        "(0.00,0.90) CD3,CD4",
+        "(0.00,1.00) CD3",
+        "(0.00,0.90) CD3",
+    ]
+    assert all(img.dtype == np.uint16 for img in combined.values())
+    assert combined["(0.00,1.00) CD3"].max() == 65535
+    assert set(cache._quantiles) == {
+        (marker, q) for marker in ["CD3", "CD4"] for q in [0.0, 0.9, 1.0]
+    }
@@ -0,0 +1,81 @@
+import os
+
+import numpy as np
+import pytest
+import tifffile
+
+pytest.importorskip("pyqupath")
+
+from src import export  # noqa: E402
+from src.export import (  # noqa: E402
+    export_ometiff_atomic,
+    get_fingerprint,
+    is_up_to_date,
+)
+
+
+@pytest.fixture
+def paths_tiff(tmp_path):
+    rng = np.random.default_rng(0)
+    paths_tiff = []
+    for name in ["a", "b"]:
+        path = tmp_path / f"{name}.tif"
+        tifffile.imwrite(path, rng.integers(0, 4096, (150, 200), dtype=np.uint16))
+        paths_tiff.append(str(path))
+    return paths_tiff
+
+
+def touch(path):
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+
+def test_get_fingerprint(paths_tiff):
+    fingerprint = get_fingerprint(paths_tiff, ["A", "B"])
+    assert fingerprint == get_fingerprint(paths_tiff, ["A", "B"])
+    assert fingerprint != get_fingerprint(paths_tiff, ["A", "C"])
+    assert fingerprint != get_fingerprint(paths_tiff[::-1], ["A", "B"])
+    encoding = {"compression": "zstd"}
+    assert fingerprint != get_fingerprint(paths_tiff, ["A", "B"], encoding)
+    touch(paths_tiff[1])
+    assert fingerprint != get_fingerprint(paths_tiff, ["A", "B"])
+
+
+def test_export_skips_unchanged_outputs(tmp_path, paths_tiff):
+    path_ometiff = tmp_path / "out" / "region.ome.tiff"
+    path_ometiff.parent.mkdir()
+    assert export_ometiff_atomic(paths_tiff, path_ometiff, ["A", "B"])
+    assert is_up_to_date(path_ometiff, paths_tiff, ["A", "B"])
+    assert sorted(os.listdir(path_ometiff.parent)) == [
+        ".region.ome.tiff.fingerprint",
+        "region.ome.tiff",
+        "region.ome.tiff.histogram.npz",
+    ]
+    np.testing.assert_array_equal(
+        tifffile.imread(path_ometiff),
+        np.stack([tifffile.imread(path) for path in paths_tiff]),
+    )
+
+    assert not export_ometiff_atomic(paths_tiff, path_ometiff, ["A", "B"])
+    assert export_ometiff_atomic(paths_tiff, path_ometiff, ["A", "B"], overwrite=True)
+    assert export_ometiff_atomic(paths_tiff, path_ometiff, ["A", "C"])
+    touch(paths_tiff[0])
+    assert export_ometiff_atomic(paths_tiff, path_ometiff, ["A", "C"])
+    os.remove(path_ometiff.with_name("region.ome.tiff.histogram.npz"))
+    assert export_ometiff_atomic(paths_tiff, path_ometiff, ["A", "C"])
+
+
+def test_interrupted_export_leaves_no_output(tmp_path, paths_tiff, monkeypatch):
+    path_ometiff = tmp_path / "region.ome.tiff"
+
+    def write_and_crash(paths_tiff, path_tmp, *args, **kwargs):
+        tifffile.imwrite(path_tmp, np.zeros((2, 2), np.uint16))
+        raise RuntimeError("crash")
+
+    monkeypatch.setattr(export, "write_ometiff_from_tiffs", write_and_crash)
+    with pytest.raises(RuntimeError):
+        export_ometiff_atomic(paths_tiff, path_ometiff, ["A", "B"])
+    assert sorted(os.listdir(tmp_path)) == ["a.tif", "b.tif"]
+
+    monkeypatch.undo()
+    assert export_ometiff_atomic(paths_tiff, path_ometiff, ["A", "B"])